@@ -17,8 +17,12 @@
 # USA.
 
 
+from bisect import bisect
 from datetime import datetime
+from hashlib import md5, sha1
+from multiprocessing import Process
 import os
+import socket
 import sys
 from threading import Thread
 import time
@@ -34,7 +38,9 @@ if not os.environ.has_key('DJANGO_SETTINGS_MODULE'):
 
 
 from django.conf import settings
-from ganeti.models import Cluster, VirtualMachine
+from ganeti.models import Cluster, VirtualMachine, VirtualMachineChange, Job, \
+    Lease, CacheRefresh, VNCPortLease
+from util.client import GanetiApiError
 
 
 class Timer():
@@ -60,88 +66,561 @@ class Timer():
         self.ticks.append(duration.seconds + duration.microseconds/1000000.0)
 
 
-def _update_cache():
+# keys of instance info that ganeti changes without a visible change
+VOLATILE_INFO = ('mtime', 'serial_no', 'ctime')
+
+# digests of the normalized info last written, by Cluster id and then by
+# VirtualMachine id.  Digests are only merged after the transaction that wrote
+# the info committed, see update_cluster_by_id().
+INFO_DIGESTS = {}
+
+
+def normalize(value):
+    """
+    Converts info to a structure with a stable repr, dicts become sorted lists
+    of items
+    """
+    if isinstance(value, (dict,)):
+        return [(k, normalize(v)) for k, v in sorted(value.items())]
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    return value
+
+
+def info_digest(info):
     """
-    Updates the cache for all all VirtualMachines in all clusters.  This method
+    Returns a digest of instance info, ignoring VOLATILE_INFO
+    """
+    info = dict((k, v) for k, v in info.items() if k not in VOLATILE_INFO)
+    return sha1(repr(normalize(info))).hexdigest()
+
+
+def update_cluster(cluster, timer=None, refresh=None, digests=None):
+    """
+    Updates the cache for all VirtualMachines in a cluster.  This method
     processes the data in bulk, where possible, to reduce runtime.  Generally
     this should be faster than refreshing individual VirtualMachines.
+
+    Writes are skipped when the digest of the info, without VOLATILE_INFO,
+    did not change since it was last written by this process.  If only the
+    status column is out of date, just the persistent columns are updated.
+
+    @param refresh - CacheRefresh that timings and counts are recorded in, it
+        is not saved by this function
+    @param digests - dict that the digest of every VirtualMachine in ganeti is
+        stored in.  The caller replaces INFO_DIGESTS[cluster.id] with it once
+        the transaction committed, which also drops deleted VirtualMachines.
+    @return tuple of (VirtualMachines updated, VirtualMachines in ganeti)
     """
-    timer = Timer()
-    print '------[cache update]-------------------------------'
-    for cluster in Cluster.objects.all():
-        print '%s:' % cluster.hostname
-        base = cluster.virtual_machines.all()
-        infos = cluster.instances(bulk=True)
-        timer.tick('info fetched from ganeti     ')
-        updated = 0
-        
-        mtimes = base.values_list('hostname', 'id', 'mtime', 'status')
-        d = {}
-        for name, id, mtime, status in mtimes:
-            d[name] = (id, float(mtime) if mtime else None, status)
-        timer.tick('mtimes fetched from db       ')
-        
-        for info in infos:
-            name = info['name']
-            if name in d:
-                id, mtime, status = d[name]
-                if not mtime or mtime < info['mtime'] \
-                or status != info['status']:
-                    #print '    Virtual Machine (updated) : %s' % name
-                    #print '        %s :: %s' % (mtime, datetime.fromtimestamp(info['mtime']))
-                    # only update the whole object if it is new or modified. 
-                    #
-                    # XXX status changes will not always be reflected in mtime
-                    # explicitly check status to see if it has changed.  failing
-                    # to check this would result in state changes being lost
+    if digests is None:
+        digests = {}
+    known_digests = INFO_DIGESTS.get(cluster.id, {})
+    timer = timer or Timer()
+    refresh = refresh or CacheRefresh(cluster=cluster)
+    print '%s:' % cluster.hostname
+    base = cluster.virtual_machines.all()
+    start = time.time()
+    updated = 0
+    inserted = 0
+    skipped = 0
+    total = 0
+    
+    # changes are written just before the transaction commits, so that their
+    # ids become visible within VM_CHANGES_LAG of being allocated
+    changes = []
+    
+    mtimes = base.values_list('hostname', 'id', 'mtime', 'status')
+    d = {}
+    for name, id, mtime, status in mtimes:
+        d[name] = (id, float(mtime) if mtime else None, status)
+    timer.tick('mtimes fetched from db       ')
+    db = time.time() - start
+    
+    # instances are processed while they are received from ganeti, so memory
+    # use does not grow with the size of the cluster
+    rapi = cluster.rapi
+    for info in rapi.GetInstancesIter(bulk=True):
+        received = time.time()
+        total += 1
+        name = info['name']
+        if name in d:
+            id, mtime, status = d[name]
+            digest = info_digest(info)
+            known = known_digests.get(id)
+            if known == digest:
+                if status != info['status']:
+                    # only the columns are out of date, skip pickling info
                     data = VirtualMachine.parse_persistent_info(info)
-                    VirtualMachine.objects.filter(pk=id) \
-                        .update(serialized_info=cPickle.dumps(info), **data)
+                    VirtualMachine.objects.filter(pk=id).update(**data)
                     updated += 1
-            else:
-                # new vm
-                vm = VirtualMachine(cluster=cluster, hostname=info['name'])
-                vm.info = info
-                vm.save() 
-        
-        # batch update the cache updated time for all VMs in this cluster. This
-        # will set the last updated time for both VMs that were modified and for
-        # those that weren't.  even if it wasn't modified we want the last
-        # updated time to be up to date.
-        #
-        # XXX don't bother checking to see whether this query needs to run.  It
-        # normal usage it will almost always need to
-        base.update(cached=datetime.now())
-        
-        timer.tick('records or timestamps updated')
-    print '    updated: %s out of %s' % (updated, len(infos))
-    timer.stop()
-    return timer.ticks
+                else:
+                    skipped += 1
+            elif known is not None or not mtime or mtime < info['mtime'] \
+            or status != info['status']:
+                #print '    Virtual Machine (updated) : %s' % name
+                #print '        %s :: %s' % (mtime, datetime.fromtimestamp(info['mtime']))
+                # only update the whole object if it is new or modified. 
+                #
+                # XXX status changes will not always be reflected in mtime
+                # explicitly check status to see if it has changed.  failing
+                # to check this would result in state changes being lost
+                data = VirtualMachine.parse_persistent_info(info)
+                VirtualMachine.objects.filter(pk=id) \
+                    .update(serialized_info=cPickle.dumps(info), **data)
+                changes.append((VirtualMachineChange.UPDATED, id, name, \
+                                info['status']))
+                updated += 1
+            digests[id] = digest
+        else:
+            # new vm, the change is recorded below instead of by the
+            # post_save signal
+            vm = VirtualMachine(cluster=cluster, hostname=info['name'])
+            vm.info = info
+            vm.record_created = False
+            vm.save()
+            changes.append((VirtualMachineChange.CREATED, vm.id, vm.hostname, \
+                            vm.status))
+            digests[vm.id] = info_digest(info)
+            updated += 1
+            inserted += 1
+        db += time.time() - received
+    
+    # batch update the cache updated time for all VMs in this cluster. This
+    # will set the last updated time for both VMs that were modified and for
+    # those that weren't.  even if it wasn't modified we want the last
+    # updated time to be up to date.
+    #
+    # XXX don't bother checking to see whether this query needs to run.  It
+    # normal usage it will almost always need to
+    received = time.time()
+    base.update(cached=datetime.now())
+    for action, id, name, status in changes:
+        VirtualMachineChange.record(action, id, cluster.id, name, status)
+    db += time.time() - received
+    
+    timer.tick('info fetched and records updated')
+    # fetching and writing are interleaved.  time spent between receiving an
+    # instance and waiting for the next one is attributed to the database
+    stats = rapi.last_request or {}
+    refresh.decode = stats.get('timings', {}).get('decode', 0)
+    refresh.db = db
+    refresh.fetch = max(0, time.time() - start - db - refresh.decode)
+    refresh.bytes = stats.get('bytes_in', 0)
+    refresh.updated = updated - inserted
+    refresh.inserted = inserted
+    refresh.total = total
+    print '    updated: %s out of %s (%s unchanged)' % (updated, total, skipped)
+    return updated, total
 
 
 from django.db import transaction
 
-@transaction.commit_on_success()
 def update_cache():
-    #with transaction.commit_on_success():
-    return _update_cache()
+    """
+    Updates the cache for all all VirtualMachines in all clusters.  Each
+    cluster is updated in its own transaction, see update_cluster_by_id().
+    """
+    timer = Timer()
+    print '------[cache update]-------------------------------'
+    for id in list(Cluster.objects.values_list('id', flat=True)):
+        try:
+            update_cluster_by_id(id, timer)
+        except GanetiApiError, e:
+            print '    error: %s' % e
+        except Cluster.DoesNotExist:
+            # deleted in the meantime
+            pass
+    timer.stop()
+    return timer.ticks
+
+
+@transaction.commit_on_success()
+def _update_cluster_by_id(cluster, timer, refresh, digests):
+    return update_cluster(cluster, timer, refresh, digests)
+
+
+def update_cluster_by_id(id, timer=None):
+    """
+    Updates a single cluster in its own transaction.  The refresh is recorded
+    in the history even if the update failed and was rolled back.  Digests
+    are stored in INFO_DIGESTS once the transaction committed.
+    """
+    try:
+        cluster = Cluster.objects.get(pk=id)
+    except Cluster.DoesNotExist:
+        INFO_DIGESTS.pop(id, None)
+        raise
+    refresh = CacheRefresh(cluster=cluster)
+    digests = {}
+    try:
+        result = _update_cluster_by_id(cluster, timer, refresh, digests)
+        INFO_DIGESTS[cluster.id] = digests
+        return result
+    except Exception, e:
+        refresh.error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        refresh.save()
+
+
+class Leader(object):
+    """
+    Holds a Lease so that only one cache updater is active across all hosts.
+    The lease is renewed once half of its ttl passed.  If the leader dies,
+    another updater takes over once the lease expires.
+    """
+    def __init__(self, name='cache-updater', ttl=None, holder=None,
+                 clock=time.time):
+        self.name = name
+        self.ttl = ttl or getattr(settings, 'CACHE_UPDATER_LEASE_TTL', 30)
+        self.holder = holder or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.clock = clock
+        self.renewed = None
+
+    def hold(self):
+        """
+        Acquires or renews the lease if needed
+
+        @return True if this process is the leader
+        """
+        now = self.clock()
+        if self.renewed is not None and now - self.renewed < self.ttl / 2.0:
+            return True
+        if Lease.objects.acquire(self.name, self.holder, self.ttl):
+            if self.renewed is None:
+                print 'acquired lease %s as %s' % (self.name, self.holder)
+            self.renewed = now
+            return True
+        if self.renewed is not None:
+            print 'lost lease %s' % self.name
+        self.renewed = None
+        return False
+
+    def release(self):
+        Lease.objects.release(self.name, self.holder)
+        self.renewed = None
+
+
+class HashRing(object):
+    """
+    Consistent hash ring.  Every node is placed on the ring at several points
+    so that keys are spread evenly.  Adding or removing a node only moves the
+    keys of that node.
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def _hash(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def add(self, node):
+        for i in xrange(self.replicas):
+            point = self._hash('%s-%d' % (node, i))
+            index = bisect(self.points, point)
+            self.points.insert(index, point)
+            self.nodes.insert(index, node)
+
+    def remove(self, node):
+        ring = [(p, n) for p, n in zip(self.points, self.nodes) if n != node]
+        self.points = [p for p, n in ring]
+        self.nodes = [n for p, n in ring]
+
+    def get(self, key):
+        """
+        Returns the node a key is assigned to, or None if the ring is empty
+        """
+        if not self.points:
+            return None
+        index = bisect(self.points, self._hash(key)) % len(self.points)
+        return self.nodes[index]
+
+
+class Shard(object):
+    """
+    Membership of a worker in the set of cache updater workers.  Workers
+    announce themselves by holding a Lease, which acts as a heartbeat.
+    Clusters are assigned to the live workers by consistent hashing of
+    Cluster.hash, so when a worker joins or its lease expires only its share
+    of the clusters moves.
+    """
+    PREFIX = 'cache-updater-worker:'
+
+    def __init__(self, name=None, ttl=None, clock=time.time):
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.heartbeat = Leader(self.PREFIX + self.name, ttl, self.name, clock)
+        self.members = ()
+        self.ring = HashRing()
+
+    def refresh(self):
+        """
+        Renews the heartbeat and rebuilds the ring if workers joined or left
+        """
+        self.heartbeat.hold()
+        members = tuple(sorted(Lease.objects \
+            .filter(name__startswith=self.PREFIX, expires__gt=datetime.now()) \
+            .values_list('holder', flat=True)))
+        if members != self.members:
+            print 'shard %s: rebalancing over %d workers' % (self.name, \
+                                                              len(members))
+            self.members = members
+            self.ring = HashRing(members)
+
+    def owns(self, cluster_hash):
+        return self.ring.get(cluster_hash) == self.name
+
+
+class ClusterState(object):
+    """
+    Refresh statistics and schedule of a single cluster
+    """
+    def __init__(self, id, interval, now):
+        self.id = id
+        self.interval = interval
+        self.next_run = now
+        self.failures = 0
+        self.change_rate = 0.0  # moving average of the fraction of VMs changed
+        self.cost = 0.0         # moving average of seconds per refresh
+        self.urgent = set()     # pending Jobs and VMs seen so far
+        self.urgent_until = 0
+
+
+class Scheduler(object):
+    """
+    Schedules cache refreshes per cluster, instead of sweeping every cluster
+    at a fixed interval.
+
+    Each cluster has its own refresh interval, which starts at
+    PERIODIC_CACHE_REFRESH:
+        * halved when VMs changed, down to CACHE_REFRESH_MIN_INTERVAL
+        * grown by up to half when nothing changed, up to
+          CACHE_REFRESH_MAX_INTERVAL.  Growth is damped by the moving average
+          of the fraction of VMs changed per refresh and stops at BUSY_RATE,
+          so a cluster that was busy recently does not back off after a
+          single quiet refresh.
+        * doubled for each consecutive failure, up to the maximum
+        * at least COST_FACTOR times the duration of a refresh, so that a
+          slow cluster can not starve the others
+
+    Clusters with pending Jobs or VirtualMachines flagged with ignore_cache
+    are urgent: they are refreshed immediately when a new flag is seen and
+    then at the minimum interval for CACHE_REFRESH_URGENT_WINDOW seconds.
+
+    If a Leader is given, clusters are only refreshed while it holds the
+    lease.  If a Shard is given, only the clusters assigned to the shard are
+    refreshed.
+    """
+    REPORT_INTERVAL = 60
+
+    COST_FACTOR = 4
+    SMOOTHING = 0.3
+    BUSY_RATE = 0.1
+
+    def __init__(self, update=update_cluster_by_id, clock=time.time,
+                 leader=None, shard=None):
+        self.update = update
+        self.clock = clock
+        self.leader = leader
+        self.shard = shard
+        self.ticks = []
+        self.failed = 0
+        self.reported = clock()
+        self.base = settings.PERIODIC_CACHE_REFRESH
+        self.min_interval = getattr(settings, 'CACHE_REFRESH_MIN_INTERVAL', 5)
+        self.max_interval = getattr(settings, 'CACHE_REFRESH_MAX_INTERVAL', 300)
+        self.urgent_window = getattr(settings, 'CACHE_REFRESH_URGENT_WINDOW', 120)
+        self.states = {}
+
+    def sync(self):
+        """
+        Adds new clusters and removes deleted ones
+        """
+        now = self.clock()
+        if self.shard:
+            self.shard.refresh()
+            ids = set(id for id, hash in Cluster.objects.values_list('id', 'hash')
+                      if self.shard.owns(hash))
+        else:
+            ids = set(Cluster.objects.values_list('id', flat=True))
+        for id in ids.difference(self.states):
+            self.states[id] = ClusterState(id, self.base, now)
+        for id in set(self.states).difference(ids):
+            del self.states[id]
+
+    def flag_urgent(self):
+        """
+        Moves clusters with newly flagged Jobs or VirtualMachines to the front
+        of the queue
+        """
+        now = self.clock()
+        flagged = {}
+        for cluster_id, id in Job.objects.filter(ignore_cache=True) \
+                .values_list('cluster', 'id'):
+            flagged.setdefault(cluster_id, set()).add(('job', id))
+        for cluster_id, id in VirtualMachine.objects.filter(ignore_cache=True) \
+                .values_list('cluster', 'id'):
+            flagged.setdefault(cluster_id, set()).add(('vm', id))
+
+        for id, state in self.states.items():
+            current = flagged.get(id, set())
+            if current.difference(state.urgent):
+                state.next_run = now
+                state.urgent_until = now + self.urgent_window
+            state.urgent = current
+
+    def due(self):
+        """
+        Returns the states of clusters due for a refresh, most overdue first
+        """
+        now = self.clock()
+        due = [s for s in self.states.values() if s.next_run <= now]
+        return sorted(due, key=lambda s: s.next_run)
+
+    def record(self, state, duration, updated=0, total=0, error=None):
+        """
+        Records the result of a refresh and schedules the next one
+        """
+        now = self.clock()
+        self.ticks.append(duration)
+        a = self.SMOOTHING
+        state.cost = a * duration + (1 - a) * state.cost
+        if error is not None:
+            self.failed += 1
+            state.failures += 1
+            interval = self.base * 2 ** state.failures
+        else:
+            state.failures = 0
+            rate = float(updated) / total if total else 0.0
+            state.change_rate = a * rate + (1 - a) * state.change_rate
+            if updated:
+                interval = state.interval / 2.0
+            else:
+                quiet = max(0.0, 1 - state.change_rate / self.BUSY_RATE)
+                interval = state.interval * (1 + 0.5 * quiet)
+
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        if error is None and now < state.urgent_until:
+            interval = self.min_interval
+        state.interval = max(interval, state.cost * self.COST_FACTOR)
+        state.next_run = now + state.interval
+
+    def run_once(self):
+        """
+        Refreshes all clusters that are due
+
+        @return seconds until the next cluster is due
+        """
+        self.sync()
+        self.flag_urgent()
+        for state in self.due():
+            if self.leader and not self.leader.hold():
+                break
+            start = self.clock()
+            try:
+                updated, total = self.update(state.id)
+            except Cluster.DoesNotExist:
+                del self.states[state.id]
+            except Exception, e:
+                print '    refresh of cluster %s failed: %s' % (state.id, e)
+                self.record(state, self.clock() - start, error=e)
+            else:
+                self.record(state, self.clock() - start, updated, total)
+
+        if self.clock() - self.reported >= self.REPORT_INTERVAL:
+            self.report()
+        if not self.states:
+            return self.base
+        return max(0, min(s.next_run for s in self.states.values()) \
+                      - self.clock())
+
+    def report(self):
+        """
+        Prints refresh timings since the last report
+        """
+        name = self.shard.name if self.shard else 'updater'
+        if self.ticks:
+            print '%s: %d clusters, %d refreshes (%d failed), ' \
+                  'avg %.3fs, max %.3fs, busy %.1f%%' % (name, \
+                len(self.states), len(self.ticks), self.failed, \
+                sum(self.ticks) / len(self.ticks), max(self.ticks), \
+                100 * sum(self.ticks) / max(1, self.clock() - self.reported))
+        self.ticks = []
+        self.failed = 0
+        self.reported = self.clock()
+        CacheRefresh.objects.prune()
+        VirtualMachineChange.objects.prune()
+        VNCPortLease.objects.release_expired()
+
+    def run(self):
+        try:
+            while True:
+                if self.leader and not self.leader.hold():
+                    # standby, retry before the leader's lease could expire
+                    time.sleep(max(1, self.leader.ttl / 4.0))
+                    continue
+                # wake up at least every second to pick up urgent refreshes
+                time.sleep(min(1, self.run_once()))
+        finally:
+            if self.leader:
+                self.leader.release()
+            if self.shard:
+                self.shard.heartbeat.release()
 
 
 
 class CacheUpdateThread(Thread):
     def run(self):
-        while True:
-            update_cache()
-            time.sleep(settings.PERIODIC_CACHE_REFRESH)
+        Scheduler(leader=Leader()).run()
+
+
+def run_worker():
+    """
+    Runs a sharded cache updater worker.  Workers may run on any number of
+    hosts.
+    """
+    from django.db import connection
+    # never share the database connection inherited from the parent
+    connection.close()
+    Scheduler(shard=Shard()).run()
+
+
+def start_workers(count):
+    workers = [Process(target=run_worker) for i in xrange(count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def print_status():
+    """
+    Prints the holders of cache updater leases
+    """
+    now = datetime.now()
+    for lease in Lease.objects.filter(name__startswith='cache-updater') \
+            .order_by('name'):
+        state = 'expired' if lease.expired else 'active'
+        print '%s: %s (%s), held for %s, renewed %s ago' % (lease.name, \
+            lease.holder, state, lease.age, now - lease.renewed)
 
 
 if __name__ == '__main__':
     import getopt
     
-    optlist, args = getopt.getopt(sys.argv[1:], 'd')
+    optlist, args = getopt.getopt(sys.argv[1:], 'dsw:')
     if optlist and optlist[0][0] == '-d':
         #daemon
         CacheUpdateThread().start()
+    
+    elif optlist and optlist[0][0] == '-w':
+        # sharded daemon with N worker processes
+        start_workers(int(optlist[0][1]))
+    
+    elif optlist and optlist[0][0] == '-s':
+        print_status()
         
     else:
         update_cache()
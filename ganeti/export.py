@@ -0,0 +1,109 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Streaming export of the virtual machine inventory.  Rows are read in keyset
+batches with values queries, so memory usage is constant regardless of the
+number of virtual machines and serialized_info is never loaded.
+"""
+
+import csv
+import json
+
+from ganeti.models import VirtualMachine
+
+
+# (name, column) pairs of exported fields
+EXPORT_FIELDS = (
+    ('hostname', 'hostname'),
+    ('cluster', 'cluster__hostname'),
+    ('owner', 'owner__name'),
+    ('ram', 'ram'),
+    ('disk_size', 'disk_size'),
+    ('virtual_cpus', 'virtual_cpus'),
+    ('operating_system', 'operating_system'),
+    ('status', 'status'),
+)
+
+BATCH_SIZE = 1000
+
+
+def inventory(queryset=None, batch_size=BATCH_SIZE):
+    """
+    Iterates over rows of the virtual machine inventory.  Rows are tuples of
+    values in the order of EXPORT_FIELDS.
+
+    @param queryset - VirtualMachines to export, defaults to all
+    """
+    if queryset is None:
+        queryset = VirtualMachine.objects.all()
+    columns = ['id'] + [column for name, column in EXPORT_FIELDS]
+
+    last = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last).order_by('id') \
+                    .values_list(*columns)[:batch_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < batch_size:
+            break
+        last = rows[-1][0]
+
+
+class LineBuffer(object):
+    """
+    File-like object that holds the last line written by csv.writer
+    """
+    line = None
+
+    def write(self, line):
+        self.line = line
+
+
+def encode(value):
+    if isinstance(value, (unicode,)):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(rows):
+    """
+    Generates lines of CSV, starting with a header
+    """
+    buffer = LineBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, column in EXPORT_FIELDS])
+    yield buffer.line
+    for row in rows:
+        writer.writerow([encode(value) for value in row])
+        yield buffer.line
+
+
+def ndjson_lines(rows):
+    """
+    Generates lines of newline delimited JSON, one object per row
+    """
+    names = [name for name, column in EXPORT_FIELDS]
+    for row in rows:
+        yield '%s\n' % json.dumps(dict(zip(names, row)))
+
+
+FORMATS = {
+    'csv':(csv_lines, 'text/csv'),
+    'ndjson':(ndjson_lines, 'application/x-ndjson'),
+}
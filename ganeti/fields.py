@@ -45,20 +45,23 @@ class PreciseDateTimeField(DecimalField):
         """
         convert decimal value to a datetime
         """
+        # fast path for REAL columns (sqlite) which are returned as floats
+        if isinstance(value, (float,)):
+            return datetime.fromtimestamp(value)
         if not value:
             return None
         if isinstance(value, (datetime,)):
             return value
-        if isinstance(value, (Decimal, str, unicode)):
-            value = float(value)
-        if isinstance(value, (float,)):
-            return datetime.fromtimestamp(value)
+        if isinstance(value, (Decimal, str, unicode, int, long)):
+            return datetime.fromtimestamp(float(value))
         
         raise ValidationError('Unable to convert %s to datetime.' % value)
 
     def get_db_prep_value(self, value, **kwargs):
         if value:
-            return time.mktime(value.timetuple()) + value.microsecond/(10**self.decimal_places)
+            if isinstance(value, (datetime,)):
+                return time.mktime(value.timetuple()) + value.microsecond/self.shifter
+            return float(value)
         return None
     
     def get_db_prep_save(self, value, connection):
@@ -67,7 +70,7 @@ class PreciseDateTimeField(DecimalField):
                 return Decimal('%f' % (time.mktime(value.timetuple()) + value.microsecond/self.shifter))
             
             if isinstance(value, (float,)):
-                return Decimal(float)
+                return Decimal('%f' % value)
             
             if isinstance(value, (Decimal,)):
                 return value
@@ -82,4 +85,8 @@ class PreciseDateTimeField(DecimalField):
         elif engine in ('django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'):
             return 'numeric(%s, %s)' % (self.max_digits, self.decimal_places)
         elif  engine == 'django.db.backends.sqlite3':
-            return 'character'
+            # a double keeps microsecond precision for unix timestamps.  It is
+            # compared numerically, so range lookups can use an index.
+            # Databases created with the former 'character' type can be
+            # converted with "manage.py convert_timestamps".
+            return 'real'
@@ -0,0 +1,158 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+In-process statistics of RAPI requests.  Every client created by get_rapi()
+reports its requests to RAPI_STATS, which aggregates them per endpoint so
+that slow or frequent RAPI calls can be found.  Statistics are kept per
+process and are lost on restart.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+from util.client import RequestHook
+
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """
+    Histogram with fixed buckets.  The last count is for values greater than
+    the last bucket.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket containing the percentile, or
+        None if it is greater than the last bucket
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def cumulative(self):
+        """
+        Returns (upper bound, count of values <= bound) pairs
+        """
+        seen = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            pairs.append((bound, seen))
+        return pairs
+
+
+class Endpoint(object):
+    """
+    Statistics of requests to one RAPI endpoint
+    """
+    TIMINGS = ('total', 'connect', 'tls', 'first_byte', 'decode')
+
+    def __init__(self, method, template):
+        self.method = method
+        self.template = template
+        self.timings = dict((name, Histogram()) for name in self.TIMINGS)
+        self.codes = {}
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_wire = 0
+        self.bytes_out = 0
+
+    @property
+    def count(self):
+        return self.timings['total'].count
+
+    @property
+    def compression(self):
+        """ percentage of the response size saved by compression """
+        if not self.bytes_in:
+            return 0
+        return 100.0 * (self.bytes_in - self.bytes_wire) / self.bytes_in
+
+    def add(self, request):
+        for name, value in request['timings'].items():
+            if name in self.timings:
+                self.timings[name].observe(value)
+        code = request['code']
+        self.codes[code] = self.codes.get(code, 0) + 1
+        if request['error']:
+            self.errors += 1
+        self.bytes_in += request['bytes_in']
+        self.bytes_wire += request['bytes_wire']
+        self.bytes_out += request['bytes_out']
+
+
+class RapiStats(RequestHook):
+    """
+    RequestHook aggregating requests per (method, path template)
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.endpoints = {}
+
+    def AfterRequest(self, request):
+        key = (request['method'], request['template'])
+        self.lock.acquire()
+        try:
+            try:
+                endpoint = self.endpoints[key]
+            except KeyError:
+                endpoint = self.endpoints[key] = Endpoint(*key)
+            endpoint.add(request)
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Returns all endpoints, the ones that took the most time in total first
+        """
+        return sorted(self.endpoints.values(), \
+                      key=lambda e: e.timings['total'].sum, reverse=True)
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.endpoints = {}
+        finally:
+            self.lock.release()
+
+
+RAPI_STATS = RapiStats()
@@ -0,0 +1,74 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+from optparse import make_option
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from ganeti.tests.rapi_proxy import INSTANCES_BULK
+from util.client import GetJsonCodec, JSON_CODECS
+
+
+def measure(codec, data, repeat):
+    """
+    Times encoding and decoding of data
+
+    @return tuple of (size in bytes, dumps seconds, loads seconds), the
+        seconds being the best of repeat runs
+    """
+    text = codec.dumps(data)
+    dumps = loads = None
+    for i in xrange(repeat):
+        start = time.time()
+        codec.dumps(data)
+        elapsed = time.time() - start
+        dumps = elapsed if dumps is None else min(dumps, elapsed)
+
+        start = time.time()
+        codec.loads(text)
+        elapsed = time.time() - start
+        loads = elapsed if loads is None else min(loads, elapsed)
+    return len(text), dumps, loads
+
+
+class Command(NoArgsCommand):
+    help = 'Compares the JSON implementations available for RAPI requests ' \
+           'on the recorded bulk instance list.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('-n', '--repeat', dest='repeat', type='int', default=10,
+            help='Runs per implementation, the best is reported (default 10)'),
+        make_option('--scale', dest='scale', type='int', default=500,
+            help='Copies of each recorded instance, to approximate a large '
+                 'cluster (default 500)'),
+    )
+
+    def handle_noargs(self, **options):
+        data = list(INSTANCES_BULK) * options['scale']
+        default = GetJsonCodec()
+
+        print '%-12s %12s %10s %10s %12s' % ('', 'bytes', 'dumps MB/s', \
+                                            'loads MB/s', 'accelerated')
+        for codec in JSON_CODECS:
+            size, dumps, loads = measure(codec, data, options['repeat'])
+            name = codec.name + (' *' if codec is default else '')
+            print '%-12s %12d %10.1f %10.1f %12s' % (name, size, \
+                size / max(dumps, 1e-9) / 1048576, \
+                size / max(loads, 1e-9) / 1048576, \
+                'yes' if codec.accelerated else 'no')
+        print '* used unless RAPI_JSON_CODEC is set'
@@ -0,0 +1,87 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+
+from ganeti.fields import PreciseDateTimeField
+
+
+class Command(NoArgsCommand):
+    help = 'Converts PreciseDateTimeField columns of SQLite databases created ' \
+           'with the former character type to real.'
+
+    def handle_noargs(self, **options):
+        verbose = int(options.get('verbosity', 1))
+        if connection.settings_dict['ENGINE'] != 'django.db.backends.sqlite3':
+            if verbose:
+                print 'Only SQLite databases need to be converted.'
+            return
+
+        for model in models.get_models():
+            fields = [f for f in model._meta.local_fields \
+                      if isinstance(f, (PreciseDateTimeField,))]
+            if fields and self.needs_conversion(model, fields):
+                if verbose:
+                    print 'Converting %s' % model._meta.db_table
+                self.convert(model, fields)
+
+    def needs_conversion(self, model, fields):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA table_info(%s)' % \
+                       connection.ops.quote_name(model._meta.db_table))
+        types = dict((row[1], row[2].lower()) for row in cursor.fetchall())
+        return any(types.get(f.column) not in (None, 'real') for f in fields)
+
+    @transaction.commit_on_success()
+    def convert(self, model, fields):
+        """
+        SQLite can not change the type of a column.  The table is renamed,
+        recreated with the current schema, and the rows are copied.  Timestamps
+        are cast to real, empty strings become NULL.
+        """
+        qn = connection.ops.quote_name
+        style = no_style()
+        table = model._meta.db_table
+        old = '%s__old' % table
+        converted = set(f.column for f in fields)
+        columns = [f.column for f in model._meta.local_fields]
+        select = [('CAST(NULLIF(%s, \'\') AS real)' if c in converted else '%s') \
+                  % qn(c) for c in columns]
+
+        cursor = connection.cursor()
+        # keep newer SQLite from rewriting foreign keys to the renamed table
+        cursor.execute('PRAGMA legacy_alter_table = ON')
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(table), qn(old)))
+        # indexes keep their names when the table is renamed
+        for index in self.indexes(old):
+            cursor.execute('DROP INDEX %s' % qn(index))
+        create, references = connection.creation.sql_create_model(model, style)
+        for sql in create + connection.creation.sql_indexes_for_model(model, style):
+            cursor.execute(sql)
+        cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (qn(table),
+            ', '.join([qn(c) for c in columns]), ', '.join(select), qn(old)))
+        cursor.execute('DROP TABLE %s' % qn(old))
+
+    def indexes(self, table):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' " \
+                       "AND tbl_name=%s AND sql IS NOT NULL", [table])
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,54 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ganeti.export import FORMATS, inventory
+from ganeti.models import VirtualMachine
+
+
+class Command(BaseCommand):
+    help = 'Exports the virtual machine inventory as CSV or NDJSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            help='Output format: csv or ndjson (default csv)'),
+        make_option('--output', dest='output', default=None,
+            help='File to write to (default stdout)'),
+        make_option('--cluster', dest='cluster', default=None,
+            help='Only export virtual machines of this cluster (slug)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['format'] not in FORMATS:
+            raise CommandError('Unknown format: %s' % options['format'])
+        lines, mimetype = FORMATS[options['format']]
+
+        queryset = VirtualMachine.objects.all()
+        if options['cluster']:
+            queryset = queryset.filter(cluster__slug=options['cluster'])
+
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            for line in lines(inventory(queryset)):
+                out.write(line)
+        finally:
+            if options['output']:
+                out.close()
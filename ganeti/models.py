@@ -20,7 +20,7 @@
 import cPickle
 from datetime import datetime, timedelta
 from hashlib import sha1
-from subprocess import Popen
+import socket
 
 from django.conf import settings
 
@@ -34,15 +34,18 @@ from django.core.validators import RegexValidator
 from django.utils.translation import ugettext_lazy as _
 import re
 
-from django.db import models
-from django.db.models import Sum
-from django.db.models.signals import post_save, post_syncdb
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.db.models.signals import pre_save, post_save, post_delete, \
+    post_syncdb, m2m_changed
 
 from object_permissions.registration import register
 from ganeti import constants, management
 from ganeti.fields import PreciseDateTimeField
+from ganeti.instrumentation import RAPI_STATS
 from util import client
 from util.client import GanetiApiError
+from util.portforwarder import send_command, CONTROL_SOCKET
 
 if settings.VNC_PROXY:
     from vncauthproxy.vapclient import request_forwarding
@@ -89,7 +92,21 @@ def get_rapi(hash, cluster):
     if cluster in RAPI_CACHE_HASHES:
         del RAPI_CACHE[RAPI_CACHE_HASHES[cluster]]
 
-    rapi = client.GanetiRapiClient(host, port, user, password)
+    breaker = client.CircuitBreaker(
+        getattr(settings, 'RAPI_CIRCUIT_FAILURES', 5),
+        getattr(settings, 'RAPI_CIRCUIT_RESET', 30))
+    timeouts = client.AdaptiveTimeouts(
+        getattr(settings, 'RAPI_CONNECT_TIMEOUT', 10),
+        getattr(settings, 'RAPI_TIMEOUT', 300))
+    rapi = client.GanetiRapiClient(host, port, user, password,
+                                   hooks=[RAPI_STATS],
+                                   circuit_breaker=breaker, timeouts=timeouts,
+                                   retry_policy=client.RetryPolicy(
+                                       getattr(settings, 'RAPI_RETRIES', 2)),
+                                   compression=getattr(settings, \
+                                       'RAPI_COMPRESSION', False),
+                                   json_codec=client.GetJsonCodec(getattr( \
+                                       settings, 'RAPI_JSON_CODEC', None)))
     RAPI_CACHE[hash] = rapi
     RAPI_CACHE_HASHES[cluster] = hash
     return rapi
@@ -117,7 +134,7 @@ class CachedClusterObject(models.Model):
     """
     serialized_info = models.TextField(null=True, default=None, editable=False)
     mtime = PreciseDateTimeField(null=True, editable=False)
-    cached = PreciseDateTimeField(null=True, editable=False)
+    cached = PreciseDateTimeField(null=True, editable=False, db_index=True)
     ignore_cache = models.BooleanField(default=False)
     
     __info = None
@@ -203,6 +220,7 @@ class CachedClusterObject(models.Model):
                 self.info = info_
                 self.check_job_status()
                 self.save()
+                self.info_updated()
             else:
                 # There was no change on the server.  Only update the cache
                 # time. This bypasses the info serialization mechanism and
@@ -229,6 +247,14 @@ class CachedClusterObject(models.Model):
     def check_job_status(self):
         pass
 
+    def info_updated(self):
+        """
+        Called by refresh() after new info was saved.
+
+        This method is specific to the child object.
+        """
+        pass
+
     def parse_transient_info(self):
         """
         Parse properties from cached info that is stored on the class but not in
@@ -492,6 +518,14 @@ class VirtualMachine(CachedClusterObject):
             elif status == 'error':
                 return dict(ignore_cache=False)
 
+    def info_updated(self):
+        """
+        Records info loaded by a lazy refresh in the change log.  The cache
+        updater would find the row up to date and not record it.
+        """
+        VirtualMachineChange.record(VirtualMachineChange.UPDATED, self.id,
+                                    self.cluster_id, self.hostname, self.status)
+
     def _refresh(self):
         return self.rapi.GetInstance(self.hostname)
 
@@ -520,13 +554,34 @@ class VirtualMachine(CachedClusterObject):
         return job
 
     def setup_vnc_forwarding(self):
+        """
+        Leases a local port from the VNC port pool and maps it to the VNC
+        server of this VirtualMachine in the port forwarder daemon.
+
+        @return tuple of (local port, password)
+        @raises PortPoolExhausted if there are no free ports
+        @raises PortForwardingError if the forwarder daemon refused the mapping
+        @raises socket.error if the forwarder daemon is not reachable
+        """
         #password = self.set_random_vnc_password(instance)
         password = 'none'
         info_ = self.info
         port = info_['network_port']
         node = info_['pnode']
-        Popen(['util/portforwarder.py', '%d'%port, '%s:%d'%(node, port)])
-        return port, password
+        lport, created = VNCPortLease.objects.lease(self, node, port)
+        control = getattr(settings, 'VNC_CONTROL_SOCKET', CONTROL_SOCKET)
+        try:
+            reply = send_command('open %d %s %d' % (lport, node, port), control)
+        except socket.error:
+            if created:
+                VNCPortLease.objects.release(lport)
+            raise
+        if not reply.startswith('ok'):
+            # a reused lease may still serve another console, leave it alone
+            if created:
+                VNCPortLease.objects.release(lport)
+            raise PortForwardingError(reply)
+        return lport, password
 
     def __repr__(self):
         return "<VirtualMachine: '%s'>" % self.hostname
@@ -535,6 +590,187 @@ class VirtualMachine(CachedClusterObject):
         return self.hostname
 
 
+class VirtualMachineChangeManager(models.Manager):
+
+    def committed(self, lag=None):
+        """
+        Returns changes recorded at least lag seconds ago, VM_CHANGES_LAG by
+        default.  Ids are assigned on insert, not on commit, so a change may
+        become visible after changes with greater ids.  Changes are written
+        shortly before their transaction commits, so once lag seconds passed
+        no change with a lower id can still appear.
+        """
+        if lag is None:
+            lag = getattr(settings, 'VM_CHANGES_LAG', 10)
+        return self.filter(timestamp__lte=datetime.now()-timedelta(seconds=lag))
+
+    def prune(self, age=None):
+        """
+        Deletes changes older than age seconds, VM_CHANGES_HISTORY by default
+        """
+        if age is None:
+            age = getattr(settings, 'VM_CHANGES_HISTORY', 604800)
+        self.filter(timestamp__lt=datetime.now()-timedelta(seconds=age)) \
+            .delete()
+
+
+class VirtualMachineChange(models.Model):
+    """
+    Append-only log of changes to VirtualMachines.  The id is a monotonically
+    increasing sequence number that clients can poll from to receive only the
+    changes since their last poll.  Clients must only be given committed()
+    changes, see VirtualMachineChangeManager.
+
+    The VirtualMachine is not a foreign key so that changes are kept after the
+    VirtualMachine has been deleted.
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+
+    virtual_machine_id = models.IntegerField()
+    cluster_id = models.IntegerField()
+    hostname = models.CharField(max_length=128)
+    action = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, blank=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = VirtualMachineChangeManager()
+
+    @classmethod
+    def record(cls, action, id, cluster_id, hostname, status=''):
+        """
+        Appends a change to the log
+        """
+        cls.objects.create(action=action, virtual_machine_id=id, \
+                           cluster_id=cluster_id, hostname=hostname, \
+                           status=status or '')
+
+    class Meta:
+        ordering = ('id',)
+
+
+class PortPoolExhausted(Exception):
+    """
+    Raised when every port in VNC_PORT_RANGE is leased
+    """
+    pass
+
+
+class PortForwardingError(Exception):
+    """
+    Raised when the port forwarder daemon replies to a command with an error
+    """
+    pass
+
+
+class VNCPortLeaseManager(models.Manager):
+    """
+    Custom manager for VNCPortLease.  Ports are claimed with unique inserts and
+    conditional deletes so that multiple web workers can share the pool.
+    """
+    def lease(self, vm, host, port):
+        """
+        Leases a local port forwarded to host:port.  A live lease for the same
+        destination is extended and reused, otherwise the lowest free port is
+        claimed.
+
+        @return tuple of (local port, True if the lease was created)
+        """
+        now = datetime.now()
+        timeout = getattr(settings, 'VNC_LEASE_TIMEOUT', 300)
+        expires = now + timedelta(seconds=timeout)
+
+        live = self.filter(remote_host=host, remote_port=port, expires__gt=now)
+        if live.update(expires=expires, virtual_machine=vm):
+            return live.values_list('port', flat=True)[0], False
+
+        self.release_expired()
+        first, last = getattr(settings, 'VNC_PORT_RANGE', (12000, 12999))
+        used = set(self.values_list('port', flat=True))
+        for lport in xrange(first, last+1):
+            if lport in used:
+                continue
+            sid = transaction.savepoint()
+            try:
+                self.create(port=lport, remote_host=host, remote_port=port, \
+                            virtual_machine=vm, expires=expires)
+                transaction.savepoint_commit(sid)
+                return lport, True
+            except IntegrityError:
+                # claimed by another worker in the meantime
+                transaction.savepoint_rollback(sid)
+        raise PortPoolExhausted()
+
+    def release_expired(self):
+        """
+        Deletes expired leases and closes their mappings in the forwarder
+        daemon.  Closing is best effort, an unreachable daemon has no mappings
+        to close.
+
+        Leases that were marked as released but never deleted, e.g. because
+        the releasing worker died, are released again once they are
+        VNC_LEASE_TIMEOUT seconds past their expiry.
+        """
+        now = datetime.now()
+        control = getattr(settings, 'VNC_CONTROL_SOCKET', CONTROL_SOCKET)
+        timeout = getattr(settings, 'VNC_LEASE_TIMEOUT', 300)
+        cutoff = now - timedelta(seconds=timeout)
+        stale = self.filter(remote_port=0, expires__lte=cutoff) \
+                    .values_list('port', flat=True)
+        for lport in list(stale):
+            # claim the stale lease by moving its expiry out of the stale
+            # window, only the worker whose update succeeds closes it.
+            if not self.filter(port=lport, remote_port=0, expires__lte=cutoff) \
+                    .update(expires=now):
+                continue
+            try:
+                send_command('close %d' % lport, control)
+            except socket.error:
+                pass
+            self.filter(port=lport, remote_port=0).delete()
+
+        expired = self.filter(expires__lte=now).values_list('port', flat=True)
+        for lport in list(expired):
+            # mark the lease as released first, only the worker whose update
+            # succeeds closes the mapping.
+            if not self.filter(port=lport, expires__lte=now, remote_port__gt=0) \
+                    .update(remote_port=0):
+                continue
+            try:
+                send_command('close %d' % lport, control)
+            except socket.error:
+                pass
+            self.filter(port=lport, remote_port=0).delete()
+
+    def release(self, lport):
+        """
+        Deletes the lease of a local port and closes its mapping in the
+        forwarder daemon.  Closing is best effort, like in release_expired().
+        """
+        self.filter(port=lport).delete()
+        control = getattr(settings, 'VNC_CONTROL_SOCKET', CONTROL_SOCKET)
+        try:
+            send_command('close %d' % lport, control)
+        except socket.error:
+            pass
+
+
+class VNCPortLease(models.Model):
+    """
+    Lease of a local port that the port forwarder daemon maps to the VNC server
+    of a VirtualMachine.  Leases are shared across web workers through the
+    database and expire after VNC_LEASE_TIMEOUT seconds.
+    """
+    port = models.PositiveIntegerField(unique=True)
+    remote_host = models.CharField(max_length=128)
+    remote_port = models.PositiveIntegerField()
+    virtual_machine = models.ForeignKey(VirtualMachine, related_name='vnc_leases')
+    expires = models.DateTimeField(db_index=True)
+
+    objects = VNCPortLeaseManager()
+
+
 class Cluster(CachedClusterObject):
     """
     A Ganeti cluster that is being tracked by this manager tool
@@ -793,6 +1029,150 @@ class SSHKey(models.Model):
     user = models.ForeignKey(User)
 
 
+class PermissionVersionManager(models.Manager):
+    """
+    Custom manager for PermissionVersion
+    """
+    def get_version(self, user):
+        """
+        Get the permission version for a user.  Users that have never had their
+        permissions modified do not have a row and are at version 0.
+
+        @return tuple of (version, modified), modified may be None
+        """
+        id = user.id if isinstance(user, (User,)) else user
+        values = self.filter(user=id).values_list('version', 'modified')
+        return values[0] if values else (0, None)
+
+    def bump(self, user_ids):
+        """
+        Increment the permission version for a list of user ids
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        for id in user_ids:
+            self.get_or_create(user_id=id)
+        self.filter(user__in=user_ids) \
+            .update(version=F('version')+1, modified=datetime.now())
+
+
+class PermissionVersion(models.Model):
+    """
+    Counter that is incremented whenever the permissions of a User may have
+    changed.  The version is used as part of cache keys and ETags so that
+    cached pages are never served to a User whose access has changed.
+
+    XXX object_permissions does not send signals when permissions are granted
+        or revoked.  Code granting permissions must call
+        PermissionVersion.objects.bump() itself.
+    """
+    user = models.OneToOneField(User, related_name='permission_version')
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(null=True)
+
+    objects = PermissionVersionManager()
+
+
+class LeaseManager(models.Manager):
+    """
+    Custom manager for Lease.  Leases are acquired and renewed with
+    conditional updates, so at most one holder succeeds even when several
+    processes on different hosts race for the same lease.
+    """
+    def acquire(self, name, holder, ttl):
+        """
+        Acquires or renews a lease.  The lease is taken over if it expired.
+
+        @param ttl  seconds the lease is valid for after acquiring it
+        @return True if holder holds the lease
+        """
+        now = datetime.now()
+        expires = now + timedelta(seconds=ttl)
+        lease = self.filter(name=name)
+        if lease.filter(holder=holder).update(renewed=now, expires=expires):
+            return True
+        if lease.filter(expires__lt=now).update(holder=holder, acquired=now, \
+                                                renewed=now, expires=expires):
+            return True
+        if lease.exists():
+            return False
+
+        sid = transaction.savepoint()
+        try:
+            self.create(name=name, holder=holder, acquired=now, renewed=now, \
+                        expires=expires)
+            transaction.savepoint_commit(sid)
+            return True
+        except IntegrityError:
+            # created by another holder in the meantime
+            transaction.savepoint_rollback(sid)
+            return False
+
+    def release(self, name, holder):
+        """
+        Releases a lease so that another holder can take over immediately
+        """
+        self.filter(name=name, holder=holder).update(expires=datetime.now())
+
+
+class Lease(models.Model):
+    """
+    Named lease used for electing a single leader among processes that may
+    run on several hosts, such as the cache updater.  The leader must renew
+    the lease before it expires, otherwise another process takes over.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    holder = models.CharField(max_length=128)
+    acquired = models.DateTimeField()
+    renewed = models.DateTimeField()
+    expires = models.DateTimeField()
+
+    objects = LeaseManager()
+
+    @property
+    def age(self):
+        """ time since the current holder acquired the lease """
+        return datetime.now() - self.acquired
+
+    @property
+    def expired(self):
+        return self.expires < datetime.now()
+
+
+class CacheRefreshManager(models.Manager):
+
+    def prune(self, age=None):
+        """
+        Deletes history older than age seconds, CACHE_REFRESH_HISTORY by
+        default
+        """
+        if age is None:
+            age = getattr(settings, 'CACHE_REFRESH_HISTORY', 86400)
+        self.filter(started__lt=datetime.now()-timedelta(seconds=age)).delete()
+
+
+class CacheRefresh(models.Model):
+    """
+    Rolling history of cache refreshes, one row per refresh of a cluster.
+    Durations are split into fetching from ganeti, decoding the response and
+    writing to the database so that a slow RAPI can be told from a slow
+    database.
+    """
+    cluster = models.ForeignKey(Cluster, related_name='cache_refreshes')
+    started = models.DateTimeField(default=datetime.now, db_index=True)
+    fetch = models.FloatField(default=0)
+    decode = models.FloatField(default=0)
+    db = models.FloatField(default=0)
+    bytes = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    inserted = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    error = models.TextField(null=True)
+
+    objects = CacheRefreshManager()
+
+
 def create_profile(sender, instance, **kwargs):
     """
     Create a profile object whenever a new user is created, also keeps the
@@ -812,6 +1192,24 @@ def update_cluster_hash(sender, instance, **kwargs):
     instance.jobs.all().update(cluster_hash=instance.hash)
 
 
+def record_virtual_machine_created(sender, instance, created, **kwargs):
+    """
+    Records newly created VirtualMachines in the change log.  Callers that
+    record the change themselves set record_created to False on the instance.
+    """
+    if created and getattr(instance, 'record_created', True):
+        VirtualMachineChange.record(VirtualMachineChange.CREATED, instance.id,
+                    instance.cluster_id, instance.hostname, instance.status)
+
+
+def record_virtual_machine_deleted(sender, instance, **kwargs):
+    """
+    Records deleted VirtualMachines in the change log
+    """
+    VirtualMachineChange.record(VirtualMachineChange.DELETED, instance.id,
+                                instance.cluster_id, instance.hostname)
+
+
 def update_organization(sender, instance, **kwargs):
     """
     Creates a Organizations whenever a contrib.auth.models.Group is created
@@ -820,9 +1218,50 @@ def update_organization(sender, instance, **kwargs):
     org.name = instance.name
     org.save()
 
+def bump_user_permission_version(sender, instance, **kwargs):
+    """
+    Superuser and active flags change what a User may access.  Other fields,
+    such as last_login which is saved on every login, do not bump the version.
+    """
+    if instance.id is None:
+        return
+    flags = User.objects.filter(id=instance.id) \
+        .values_list('is_superuser', 'is_active')
+    if flags and flags[0] != (instance.is_superuser, instance.is_active):
+        PermissionVersion.objects.bump([instance.id])
+
+
+def bump_group_permission_version(sender, instance, action, reverse, pk_set,
+                                  **kwargs):
+    """
+    Changing group membership changes the permissions a User inherits
+    """
+    if isinstance(instance, (User,)):
+        if action.startswith('post_'):
+            PermissionVersion.objects.bump([instance.id])
+    elif action == 'pre_clear':
+        # members must be looked up before they are removed from the group
+        PermissionVersion.objects.bump( \
+            instance.user_set.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        PermissionVersion.objects.bump(pk_set)
+
+def bump_ssh_key_permission_version(sender, instance, **kwargs):
+    """
+    SSHKeys are served with the permissions of their User, changing them
+    invalidates cached key sets.
+    """
+    PermissionVersion.objects.bump([instance.user_id])
+
 post_save.connect(create_profile, sender=User)
 post_save.connect(update_cluster_hash, sender=Cluster)
 post_save.connect(update_organization, sender=Group)
+post_save.connect(record_virtual_machine_created, sender=VirtualMachine)
+post_delete.connect(record_virtual_machine_deleted, sender=VirtualMachine)
+pre_save.connect(bump_user_permission_version, sender=User)
+m2m_changed.connect(bump_group_permission_version, sender=User.groups.through)
+post_save.connect(bump_ssh_key_permission_version, sender=SSHKey)
+post_delete.connect(bump_ssh_key_permission_version, sender=SSHKey)
 
 # Disconnect create_default_site from django.contrib.sites so that
 #  the useless table for sites is not created. This will be
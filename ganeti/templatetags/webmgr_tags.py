@@ -21,11 +21,17 @@ import re
 import json as json_lib
 
 from django import template
-from django.template import Library, Node, TemplateSyntaxError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.query import QuerySet
+from django.template import Library, Node, TemplateSyntaxError, Variable, \
+    VariableDoesNotExist
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
 
-from ganeti.models import Cluster
+from ganeti.models import Cluster, VirtualMachine
+from ganeti.versioning import make_etag, permission_version, queryset_digest
 
 
 register = Library()
@@ -226,6 +232,71 @@ class GetterNode(Node):
         context[self.res_name] = context[self.item_name][self.attr_name]
         return ''
 
+
+@register.tag
+def cachefragment(parser, token):
+    """
+    Caches the enclosed template fragment.  The cache key is built from the
+    fragment name and the versions of the objects it varies on:
+
+        {% cachefragment "node_table" cluster %} ... {% endcachefragment %}
+
+    Supported objects are versioned as follows, anything else is used as is:
+        * Cluster: hash, mtime, and the mtime and status of its VMs
+        * User: id and permission version
+        * QuerySet: mtime and status of the virtual machines
+    """
+    bits = token.contents.split()
+    if len(bits) < 2:
+        raise TemplateSyntaxError, "%r tag requires arguments" % bits[0]
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    name = bits[1].strip('"\'')
+    return CacheFragmentNode(nodelist, name, bits[2:])
+
+
+# columns of virtual machines displayed in cached tables
+FRAGMENT_VM_COLUMNS = ('mtime', 'status')
+
+
+def fragment_version(obj):
+    """
+    Returns the version of an object a cached fragment varies on.  Cached
+    timestamps are left out, they change on every refresh of the cache.
+    """
+    if isinstance(obj, (Cluster,)):
+        vms = VirtualMachine.objects.filter(cluster=obj.id)
+        return (obj.hash, obj.mtime, \
+                queryset_digest(vms, *FRAGMENT_VM_COLUMNS))
+    if isinstance(obj, (User,)):
+        return (obj.id, permission_version(obj)[0])
+    if isinstance(obj, (QuerySet,)):
+        return queryset_digest(obj, *FRAGMENT_VM_COLUMNS)
+    return obj
+
+
+class CacheFragmentNode(Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = [Variable(v) for v in vary_on]
+
+    def render(self, context):
+        parts = []
+        for var in self.vary_on:
+            try:
+                parts.append(fragment_version(var.resolve(context)))
+            except VariableDoesNotExist:
+                parts.append(None)
+        key = 'webmgr.fragment.%s.%s' % (self.name, make_etag(*parts))
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            timeout = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60)
+            cache.set(key, value, timeout)
+        return value
+
+
 # These filters were created by Corbin Simpson IN THE NAME OF AWESOME!
 # Just kidding. Created for ganeti-webmgr at Oregon State University.
 
@@ -17,13 +17,20 @@
 # USA.
 
 from ganeti.tests.accounts import *
+from ganeti.tests.api import *
 from ganeti.tests.cache_updater import *
 from ganeti.tests.cached_cluster_object import *
 from ganeti.tests.cluster import *
 from ganeti.tests.cluster_user import *
+from ganeti.tests.conditional_get import *
+from ganeti.tests.fragment_cache import *
 from ganeti.tests.importing import *
+from ganeti.tests.instrumentation import *
 from ganeti.tests.job import *
+from ganeti.tests.port_forwarder import *
 from ganeti.tests.rapi_cache import *
+from ganeti.tests.rapi_client import *
 from ganeti.tests.ssh_keys import *
 from ganeti.tests.users import *
 from ganeti.tests.virtual_machine import *
+from ganeti.tests.vnc_lease import *
@@ -0,0 +1,377 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.test import TestCase
+from django.test.client import Client
+
+from object_permissions import *
+
+from ganeti.export import inventory
+from ganeti.tests.rapi_proxy import RapiProxy, INSTANCE, NODES_BULK
+from ganeti import models
+from logs.models import LogItem
+Cluster = models.Cluster
+VirtualMachine = models.VirtualMachine
+VirtualMachineChange = models.VirtualMachineChange
+CacheRefresh = models.CacheRefresh
+
+
+__all__ = ('TestJSONAPI', )
+
+
+KEY = 'test-key'
+
+
+class TestJSONAPI(TestCase):
+    
+    def setUp(self):
+        self.tearDown()
+        models.client.GanetiRapiClient = RapiProxy
+        self.api_keys = getattr(settings, 'API_KEYS', {})
+        settings.API_KEYS = {KEY:('read', 'history', 'metrics')}
+        self.vm_changes_lag = getattr(settings, 'VM_CHANGES_LAG', 10)
+        settings.VM_CHANGES_LAG = 0
+        
+        User(id=1, username='anonymous').save()
+        settings.ANONYMOUS_USER_ID=1
+        
+        user = User(id=2, username='tester0')
+        user.set_password('secret')
+        user.save()
+        
+        cluster = Cluster(hostname='test.osuosl.test', slug='OSL_TEST')
+        cluster.save()
+        vm = VirtualMachine(cluster=cluster, hostname='vm1.osuosl.bak')
+        vm.save()
+        vm1 = VirtualMachine(cluster=cluster, hostname='vm2.osuosl.bak')
+        vm1.save()
+        # cache info, the API reads it from the database
+        vm.refresh()
+        vm1.refresh()
+        
+        dict_ = globals()
+        dict_['user'] = user
+        dict_['cluster'] = cluster
+        dict_['vm'] = vm
+        dict_['vm1'] = vm1
+        dict_['c'] = Client()
+    
+    def tearDown(self):
+        if hasattr(self, 'api_keys'):
+            settings.API_KEYS = self.api_keys
+            settings.VM_CHANGES_LAG = self.vm_changes_lag
+        CacheRefresh.objects.all().delete()
+        LogItem.objects.all().delete()
+        VirtualMachineChange.objects.all().delete()
+        VirtualMachine.objects.all().delete()
+        Cluster.objects.all().delete()
+        Group.objects.all().delete()
+        User.objects.all().delete()
+    
+    def get_key(self, url, status=200, key=KEY):
+        return self.get(url, status, HTTP_AUTHORIZATION='Bearer %s' % key)
+    
+    def get(self, url, status=200, **kwargs):
+        response = c.get(url, **kwargs)
+        self.assertEqual(status, response.status_code)
+        if status == 200:
+            self.assertEqual('application/json', response['content-type'])
+            return json.loads(response.content)
+        return response
+    
+    def test_authentication(self):
+        """
+        Verifies:
+            * anonymous users are denied
+            * api keys grant access to their scopes only
+            * the ssh keys api key grants no access
+            * users only see objects they have permissions on
+        """
+        self.get('/api/vms/', 403)
+        
+        data = self.get_key('/api/vms/')
+        self.assertEqual(2, len(data['results']))
+        self.get_key('/api/vms/', 403, 'unknown')
+        self.get_key('/api/changes/', 403)
+        self.get_key('/api/export/vms.csv', 403)
+        self.get('/api/vms/?api_key=%s' % settings.WEB_MGR_API_KEY, 403)
+        
+        self.assert_(c.login(username=user.username, password='secret'))
+        data = self.get('/api/vms/')
+        self.assertEqual([], data['results'])
+        grant(user, 'admin', vm)
+        data = self.get('/api/vms/')
+        self.assertEqual([vm.id], [v['id'] for v in data['results']])
+        
+        self.get('/api/cluster/%s/' % cluster.slug, 404)
+        self.get('/api/cluster/%s/nodes/' % cluster.slug, 404)
+    
+    def test_fields(self):
+        """
+        Verifies:
+            * fields parameter limits fields returned
+            * info is loaded from cached info
+            * unknown fields are rejected
+        """
+        user.is_superuser = True
+        user.save()
+        self.assert_(c.login(username=user.username, password='secret'))
+        
+        data = self.get('/api/cluster/%s/%s/?fields=hostname,status' \
+                        % (cluster.slug, vm.hostname))
+        self.assertEqual({'hostname':vm.hostname, 'status':'ADMIN_down'}, data)
+        
+        data = self.get('/api/cluster/%s/%s/?fields=id,info' \
+                        % (cluster.slug, vm.hostname))
+        self.assertEqual(INSTANCE['pnode'], data['info']['pnode'])
+        
+        self.get('/api/vms/?fields=password', 400)
+    
+    def test_pagination(self):
+        """
+        Verifies:
+            * limit and after paginate results
+            * bulk requests return the requested objects
+            * limits less than 1 are rejected
+        """
+        user.is_superuser = True
+        user.save()
+        self.assert_(c.login(username=user.username, password='secret'))
+        
+        data = self.get('/api/vms/?limit=1')
+        self.assertEqual([vm.id], [v['id'] for v in data['results']])
+        data = self.get('/api/vms/?limit=1&after=%s' % data['next'])
+        self.assertEqual([vm1.id], [v['id'] for v in data['results']])
+        data = self.get('/api/vms/?limit=1&after=%s' % data['next'])
+        self.assertEqual([], data['results'])
+        self.assertEqual(None, data['next'])
+        
+        data = self.get('/api/vms/?id=%s&id=%s' % (vm.id, vm1.id))
+        self.assertEqual(2, len(data['results']))
+        
+        self.get('/api/vms/?limit=0', 400)
+        self.get('/api/vms/?limit=-1', 400)
+        self.get('/api/changes/?limit=0', 400)
+    
+    def test_etag(self):
+        """
+        Verifies:
+            * an ETag is returned and Last-Modified is not
+            * If-None-Match returns 304 when nothing changed
+            * editing a served column changes the ETag
+            * deleting a row changes the ETag
+            * selecting other fields changes the ETag
+            * permission changes change the ETag
+        """
+        user.is_superuser = True
+        user.save()
+        self.assert_(c.login(username=user.username, password='secret'))
+        
+        def etag(url):
+            response = c.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertFalse(response.has_header('Last-Modified'))
+            self.get(url, 304, HTTP_IF_NONE_MATCH=response['ETag'])
+            return response['ETag']
+        
+        url = '/api/vms/'
+        detail = '/api/cluster/%s/%s/' % (cluster.slug, vm.hostname)
+        etags = [etag(url), etag(detail)]
+        self.assertEqual(etags[0], etag(url))
+        
+        # editing without changing mtime or cached
+        VirtualMachine.objects.filter(pk=vm.pk) \
+            .update(owner=user.get_profile())
+        self.get(url, 200, HTTP_IF_NONE_MATCH=etags[0])
+        self.get(detail, 200, HTTP_IF_NONE_MATCH=etags[1])
+        etags = [etag(url), etag(detail)]
+        
+        # the cluster's cached timestamp does not move when it is edited
+        cluster_url = '/api/cluster/%s/' % cluster.slug
+        cluster_etag = etag(cluster_url)
+        Cluster.objects.filter(pk=cluster.pk).update(description='edited')
+        self.get(cluster_url, 200, HTTP_IF_NONE_MATCH=cluster_etag)
+        
+        self.get(url + '?fields=id', 200, HTTP_IF_NONE_MATCH=etags[0])
+        
+        VirtualMachine.objects.filter(pk=vm1.pk).delete()
+        self.get(url, 200, HTTP_IF_NONE_MATCH=etags[0])
+        etags[0] = etag(url)
+        
+        user.is_superuser = False
+        user.save()
+        self.get(detail, 404, HTTP_IF_NONE_MATCH=etags[1])
+        user.grant('admin', vm)
+        models.PermissionVersion.objects.bump([user.id])
+        self.get(url, 200, HTTP_IF_NONE_MATCH=etags[0])
+    
+    def test_nodes(self):
+        """
+        Tests listing nodes of a cluster
+        """
+        user.is_superuser = True
+        user.save()
+        self.assert_(c.login(username=user.username, password='secret'))
+        cluster.rapi.GetNodes.response = NODES_BULK
+        
+        data = self.get('/api/cluster/%s/nodes/' % cluster.slug)
+        self.assertEqual(len(NODES_BULK), len(data['results']))
+        data = self.get('/api/cluster/%s/nodes/?name=%s' \
+                        % (cluster.slug, NODES_BULK[0]['name']))
+        self.assertEqual(1, len(data['results']))
+    
+    def test_export(self):
+        """
+        Tests exporting the virtual machine inventory
+        
+        Verifies:
+            * csv includes a header and one line per vm
+            * ndjson includes one object per vm
+            * inventory iterates over all batches
+        """
+        user.is_superuser = True
+        user.save()
+        self.assert_(c.login(username=user.username, password='secret'))
+        
+        response = c.get('/api/export/vms.csv')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/csv', response['content-type'])
+        lines = response.content.splitlines()
+        self.assertEqual(3, len(lines))
+        self.assert_(lines[0].startswith('hostname,cluster,owner'))
+        
+        response = c.get('/api/export/vms.ndjson')
+        self.assertEqual(200, response.status_code)
+        rows = [json.loads(l) for l in response.content.splitlines()]
+        self.assertEqual([vm.hostname, vm1.hostname], \
+                         [r['hostname'] for r in rows])
+        
+        rows = list(inventory(batch_size=1))
+        self.assertEqual(2, len(rows))
+    
+    def test_changes(self):
+        """
+        Tests the change feed
+        
+        Verifies:
+            * only superusers may read changes
+            * created and deleted vms are recorded
+            * since returns only newer changes
+            * changes are only returned once they are VM_CHANGES_LAG old
+        """
+        self.assert_(c.login(username=user.username, password='secret'))
+        self.get('/api/changes/', 403)
+        user.is_superuser = True
+        user.save()
+        
+        data = self.get('/api/changes/')
+        # info cached in setUp is recorded as updated
+        self.assertEqual(['created', 'created', 'updated', 'updated'], \
+                         [change['action'] for change in data['changes']])
+        last = data['last']
+        
+        data = self.get('/api/changes/?since=%s' % last)
+        self.assertEqual([], data['changes'])
+        self.assertEqual(last, data['last'])
+        
+        vm1.delete()
+        data = self.get('/api/changes/?since=%s' % last)
+        self.assertEqual(1, len(data['changes']))
+        self.assertEqual('deleted', data['changes'][0]['action'])
+        self.assertEqual(vm1.hostname, data['changes'][0]['hostname'])
+        
+        settings.VM_CHANGES_LAG = 60
+        data = self.get('/api/changes/?since=%s' % last)
+        self.assertEqual([], data['changes'])
+        self.assertEqual(last, data['last'])
+    
+    def test_history(self):
+        """
+        Verifies:
+            * history is limited to the object or user
+            * history is paginated newest first with the before cursor
+            * users may only view their own history
+        """
+        user1 = User(id=3, username='tester1')
+        user1.save()
+        for action in ('created', 'stopped', 'started'):
+            LogItem.objects.log_action(user, vm, action)
+        LogItem.objects.log_action(user1, vm1, 'created')
+        LogItem.objects.log_action(user1, cluster, 'modified permissions')
+        
+        url = '/api/cluster/%s/%s/history/' % (cluster.slug, vm.hostname)
+        self.get(url, 403)
+        self.assert_(c.login(username=user.username, password='secret'))
+        self.get(url, 404)
+        grant(user, 'admin', vm)
+        
+        data = self.get(url + '?limit=2')
+        self.assertEqual(['started', 'stopped'], \
+                         [l['action'] for l in data['results']])
+        self.assertEqual(user.username, data['results'][0]['user'])
+        data = self.get(url + '?limit=2&before=%s' % data['next'])
+        self.assertEqual(['created'], [l['action'] for l in data['results']])
+        self.assertEqual(None, data['next'])
+        
+        data = self.get('/api/user/%s/history/' % user.id)
+        self.assertEqual(3, len(data['results']))
+        self.get('/api/user/%s/history/' % user1.id, 403)
+        self.get('/api/cluster/%s/history/' % cluster.slug, 404)
+        
+        c.logout()
+        data = self.get_key('/api/user/%s/history/' % user1.id)
+        self.assertEqual(2, len(data['results']))
+        data = self.get_key('/api/cluster/%s/history/' % cluster.slug)
+        self.assertEqual(['modified permissions'], \
+                         [l['action'] for l in data['results']])
+    
+    def test_metrics(self):
+        """
+        Verifies:
+            * only superusers and keys with the metrics scope may read metrics
+            * the last refresh of each cluster is exported
+            * failed refreshes are counted
+        """
+        url = '/api/metrics/'
+        CacheRefresh(cluster=cluster, fetch=1.5, bytes=2048, updated=1, \
+                     total=2).save()
+        CacheRefresh(cluster=cluster, error='timeout').save()
+        CacheRefresh(cluster=cluster, fetch=0.5, bytes=1024, total=2).save()
+        
+        self.get('/api/metrics/', 403)
+        self.assert_(c.login(username=user.username, password='secret'))
+        self.get('/api/metrics/', 403)
+        c.logout()
+        
+        response = c.get(url, HTTP_AUTHORIZATION='Bearer %s' % KEY)
+        self.assertEqual(200, response.status_code)
+        self.assert_(response['content-type'].startswith('text/plain'))
+        lines = response.content.splitlines()
+        self.assert_('ganeti_cache_refresh_fetch_seconds{cluster="OSL_TEST"} 0.5' in lines)
+        self.assert_('ganeti_cache_refresh_bytes{cluster="OSL_TEST"} 1024.0' in lines)
+        self.assert_('ganeti_cache_refresh_virtual_machines{cluster="OSL_TEST"} 2.0' in lines)
+        self.assert_('ganeti_cache_refreshes{cluster="OSL_TEST"} 3.0' in lines)
+        self.assert_('ganeti_cache_refresh_errors{cluster="OSL_TEST"} 1.0' in lines)
+        self.assert_('ganeti_cache_refresh_failing{cluster="OSL_TEST"} 0.0' in lines)
+        self.assert_('# TYPE ganeti_cache_refresh_lag_seconds gauge' in lines)
+        self.assert_('# TYPE ganeti_rapi_request_errors_total counter' in lines)
@@ -16,13 +16,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 import time
 
+from django.db.models.signals import post_save
 from django.test import TestCase
 
 from ganeti import models
-from ganeti.cache import update_cache
+from ganeti import cache
+from ganeti.cache import update_cache, update_cluster_by_id, Scheduler, \
+    Leader, HashRing, Shard, ClusterState
 from ganeti.tests.rapi_proxy import RapiProxy, INSTANCES_BULK
 from ganeti.tests.utils import MuteStdout
 from ganeti.tests.virtual_machine import VirtualMachineTestCaseMixin
@@ -30,6 +33,10 @@ from ganeti.tests.virtual_machine import VirtualMachineTestCaseMixin
 
 VirtualMachine = models.VirtualMachine
 Cluster = models.Cluster
+VirtualMachineChange = models.VirtualMachineChange
+Job = models.Job
+Lease = models.Lease
+CacheRefresh = models.CacheRefresh
 
 
 class TestCacheUpdater(TestCase, VirtualMachineTestCaseMixin):
@@ -37,8 +44,13 @@ class TestCacheUpdater(TestCase, VirtualMachineTestCaseMixin):
     def setUp(self):
         self.tearDown()
         models.client.GanetiRapiClient = RapiProxy
+        cache.INFO_DIGESTS.clear()
 
     def tearDown(self):
+        CacheRefresh.objects.all().delete()
+        Lease.objects.all().delete()
+        Job.objects.all().delete()
+        VirtualMachineChange.objects.all().delete()
         VirtualMachine.objects.all().delete()
         Cluster.objects.all().delete()
     
@@ -249,4 +261,386 @@ class TestCacheUpdater(TestCase, VirtualMachineTestCaseMixin):
             self.fail('cache is not newer: %s, %s' % (cached, vm0.cached))
         
         if cached > datetime.fromtimestamp(float(vm1['cached'])):
-            self.fail('cache is not newer: %s, %s' % (cached, vm1.cached))
\ No newline at end of file
+            self.fail('cache is not newer: %s, %s' % (cached, vm1.cached))
+    
+    def test_change_log(self):
+        """
+        Tests that the updater records updated and new vms in the change log
+        """
+        vm0, cluster = self.create_virtual_machine()
+        last = VirtualMachineChange.objects.order_by('-id')[0].id
+        
+        data = list(INSTANCES_BULK)
+        data[0]['mtime'] = 1999999999.8692000
+        cluster.rapi.GetInstances.response = data
+        VirtualMachine.objects.all().update(mtime=None)
+        
+        with MuteStdout():
+            update_cache()
+        changes = VirtualMachineChange.objects.filter(id__gt=last) \
+            .values_list('hostname', 'action')
+        self.assertEqual(set([(u'vm1.osuosl.bak', u'updated'), \
+                              (u'vm2.osuosl.bak', u'created')]), set(changes))
+    
+    def test_change_log_end_of_transaction(self):
+        """
+        Tests that the updater writes its changes, including those of new vms,
+        after all other writes of the refresh
+        """
+        vm0, cluster = self.create_virtual_machine()
+        last = VirtualMachineChange.objects.order_by('-id')[0].id
+        cluster.rapi.GetInstances.response = INSTANCES_BULK
+        VirtualMachine.objects.all().update(mtime=None)
+        
+        counts = []
+        def saved(sender, instance, **kwargs):
+            counts.append(VirtualMachineChange.objects.filter(id__gt=last) \
+                          .count())
+        post_save.connect(saved, sender=VirtualMachine)
+        try:
+            with MuteStdout():
+                update_cluster_by_id(cluster.id)
+        finally:
+            post_save.disconnect(saved, sender=VirtualMachine)
+        self.assertEqual([0] * (len(INSTANCES_BULK) - 1), counts)
+        self.assertEqual(len(INSTANCES_BULK), \
+            VirtualMachineChange.objects.filter(id__gt=last).count())
+    
+    def test_change_log_refresh(self):
+        """
+        Tests that info loaded by a lazy refresh is recorded in the change log
+        and that old changes are pruned
+        """
+        vm0, cluster = self.create_virtual_machine()
+        last = VirtualMachineChange.objects.order_by('-id')[0].id
+        
+        vm0.mtime = None
+        vm0.refresh()
+        changes = VirtualMachineChange.objects.filter(id__gt=last) \
+            .values_list('hostname', 'action', 'status')
+        self.assertEqual([(vm0.hostname, u'updated', vm0.status)], \
+                         list(changes))
+        
+        old = datetime.now() - timedelta(days=8)
+        VirtualMachineChange.objects.filter(id=last).update(timestamp=old)
+        VirtualMachineChange.objects.prune()
+        self.assertFalse(VirtualMachineChange.objects.filter(id=last).exists())
+        self.assertEqual(1, VirtualMachineChange.objects.count())
+    
+    def test_unchanged_digest(self):
+        """
+        Tests that writes are skipped when only volatile info changed
+
+        Verifies:
+            * mtime advancing with the same info does not rewrite the object
+            * a status column that is out of date gets a narrow update
+            * a change to the info rewrites the object
+        """
+        vm0, cluster = self.create_virtual_machine()
+        data = [dict(INSTANCES_BULK[0], mtime=1285883000.1234000)]
+        cluster.rapi.GetInstances.response = data
+        with MuteStdout():
+            update_cache()
+        changes = VirtualMachineChange.objects.count()
+        
+        # only mtime changed, marker should survive
+        data[0] = dict(data[0], mtime=1285883999.1234000)
+        cluster.rapi.GetInstances.response = data
+        VirtualMachine.objects.all().update(operating_system='image+fake')
+        with MuteStdout():
+            update_cache()
+        values = VirtualMachine.objects.values('operating_system','status')[0]
+        self.assertEqual('image+fake', values['operating_system'])
+        self.assertEqual(changes, VirtualMachineChange.objects.count())
+        
+        # status column out of date, only columns are updated
+        VirtualMachine.objects.all().update(status='unknown')
+        with MuteStdout():
+            update_cache()
+        values = VirtualMachine.objects.values('operating_system','status')[0]
+        self.assertEqual(data[0]['status'], values['status'])
+        self.assertEqual(changes, VirtualMachineChange.objects.count())
+        
+        # info changed, whole object is rewritten
+        data[0] = dict(data[0], oper_ram=512)
+        cluster.rapi.GetInstances.response = data
+        with MuteStdout():
+            update_cache()
+        values = VirtualMachine.objects.values('operating_system','status')[0]
+        self.assertEqual(data[0]['os'], values['operating_system'])
+        self.assertEqual(changes+1, VirtualMachineChange.objects.count())
+
+    def test_digests_after_commit(self):
+        """
+        Tests that digests are only kept for info that was committed
+
+        Verifies:
+            * a rolled back refresh keeps the previous digests
+            * VirtualMachines that are gone from ganeti are evicted
+            * deleted clusters are evicted
+        """
+        vm0, cluster = self.create_virtual_machine()
+        data = [dict(INSTANCES_BULK[0]), dict(INSTANCES_BULK[1])]
+        cluster.rapi.GetInstances.response = data
+        with MuteStdout():
+            update_cluster_by_id(cluster.id)
+        digests = dict(cache.INFO_DIGESTS[cluster.id])
+        self.assertEqual(2, len(digests))
+        
+        # the rolled back info must be rewritten by the next refresh
+        data[0] = dict(data[0], oper_ram=512)
+        record = VirtualMachineChange.__dict__['record']
+        def fail(*args, **kwargs):
+            raise Exception('failed')
+        VirtualMachineChange.record = staticmethod(fail)
+        try:
+            with MuteStdout():
+                self.assertRaises(Exception, update_cluster_by_id, cluster.id)
+        finally:
+            VirtualMachineChange.record = record
+        self.assertEqual(digests, cache.INFO_DIGESTS[cluster.id])
+        
+        del data[1]
+        with MuteStdout():
+            update_cluster_by_id(cluster.id)
+        self.assertEqual([vm0.id], cache.INFO_DIGESTS[cluster.id].keys())
+        self.assertNotEqual(digests[vm0.id], cache.INFO_DIGESTS[cluster.id][vm0.id])
+        
+        id = cluster.id
+        VirtualMachine.objects.all().delete()
+        cluster.delete()
+        self.assertRaises(Cluster.DoesNotExist, update_cluster_by_id, id)
+        self.assertFalse(id in cache.INFO_DIGESTS)
+    
+    def test_refresh_history(self):
+        """
+        Tests that refreshes are recorded in the history
+
+        Verifies:
+            * counts of updated, inserted and total VMs are recorded
+            * a failed refresh is recorded with its error
+            * old records are pruned
+        """
+        vm0, cluster = self.create_virtual_machine()
+        VirtualMachine.objects.all().update(mtime=None)
+        cluster.rapi.GetInstances.response = INSTANCES_BULK
+        with MuteStdout():
+            update_cache()
+        refresh = CacheRefresh.objects.get(cluster=cluster)
+        self.assertEqual(None, refresh.error)
+        self.assertEqual(1, refresh.updated)
+        self.assertEqual(len(INSTANCES_BULK)-1, refresh.inserted)
+        self.assertEqual(len(INSTANCES_BULK), refresh.total)
+        self.assert_(refresh.fetch >= 0 and refresh.db >= 0)
+        
+        cluster.rapi.error = models.GanetiApiError('timeout')
+        with MuteStdout():
+            self.assertRaises(models.GanetiApiError, update_cluster_by_id, \
+                              cluster.id)
+        cluster.rapi.error = None
+        refresh = CacheRefresh.objects.filter(cluster=cluster).latest('id')
+        self.assertEqual('timeout', refresh.error)
+        
+        CacheRefresh.objects.filter(pk=refresh.pk) \
+            .update(started=datetime.now()-timedelta(days=2))
+        CacheRefresh.objects.prune(86400)
+        self.assertEqual(1, CacheRefresh.objects.count())
+
+    def test_scheduler(self):
+        """
+        Tests scheduling refreshes per cluster
+        
+        Verifies:
+            * clusters with changes are refreshed more often
+            * quiet clusters back off
+            * failing clusters back off exponentially
+            * clusters with new pending jobs are refreshed immediately
+        """
+        vm0, cluster = self.create_virtual_machine()
+        vm1, cluster1 = self.create_virtual_machine( \
+            Cluster.objects.create(hostname='test2.osuosl.bak', slug='OSL_TEST2'))
+        clock = [1000.0]
+        results = {cluster.id:(1, 10), cluster1.id:(0, 10)}
+        def update(id):
+            result = results[id]
+            if isinstance(result, Exception):
+                raise result
+            return result
+        
+        scheduler = Scheduler(update, lambda: clock[0])
+        scheduler.base = 16
+        scheduler.min_interval = 2
+        scheduler.max_interval = 64
+        scheduler.urgent_window = 10
+        
+        with MuteStdout():
+            scheduler.run_once()
+        busy = scheduler.states[cluster.id]
+        quiet = scheduler.states[cluster1.id]
+        self.assertEqual(8, busy.interval)
+        self.assertEqual(24, quiet.interval)
+        self.assertEqual(1008, busy.next_run)
+        self.assertEqual([], scheduler.due())
+        
+        # failure backs off from the base interval
+        results[cluster.id] = Exception('unreachable')
+        clock[0] = 1008
+        with MuteStdout():
+            scheduler.run_once()
+        self.assertEqual(1, busy.failures)
+        self.assertEqual(32, busy.interval)
+        clock[0] = 1040
+        with MuteStdout():
+            scheduler.run_once()
+        self.assertEqual(64, busy.interval)
+        
+        # a new job on the quiet cluster makes it urgent
+        results[cluster.id] = (0, 10)
+        Job.objects.create(job_id=1, obj=vm1, cluster=cluster1)
+        clock[0] = 1041
+        with MuteStdout():
+            scheduler.run_once()
+        self.assertEqual(1041 + 2, quiet.next_run)
+        
+        # still urgent within the window, but the same job does not jump the
+        # queue again
+        clock[0] = 1042
+        with MuteStdout():
+            scheduler.run_once()
+        self.assertEqual(1043, quiet.next_run)
+    
+    def test_scheduler_change_rate(self):
+        """
+        Tests that the change rate damps the back off of quiet refreshes
+        
+        Verifies:
+            * the change rate is a moving average of the fraction changed
+            * a recently busy cluster backs off slower than a quiet one
+            * no back off at BUSY_RATE
+        """
+        scheduler = Scheduler(lambda id: (0, 0), lambda: 1000.0)
+        scheduler.min_interval = 1
+        scheduler.max_interval = 1000
+        busy = ClusterState(1, 16, 1000.0)
+        quiet = ClusterState(2, 16, 1000.0)
+        
+        scheduler.record(busy, 0, 1, 10)
+        self.assertAlmostEqual(0.03, busy.change_rate)
+        self.assertEqual(8, busy.interval)
+        
+        # the quiet record decays change_rate to 0.7 * 0.03 = 0.021, which is
+        # 21% of BUSY_RATE, so 79% of the growth is left
+        scheduler.record(busy, 0, 0, 10)
+        scheduler.record(quiet, 0, 0, 10)
+        self.assertAlmostEqual(0.021, busy.change_rate)
+        self.assertAlmostEqual(8 * (1 + 0.5 * 0.79), busy.interval)
+        self.assertEqual(24, quiet.interval)
+        
+        busy.change_rate = scheduler.BUSY_RATE / 0.7
+        interval = busy.interval
+        scheduler.record(busy, 0, 0, 10)
+        self.assertAlmostEqual(interval, busy.interval)
+    
+    def test_leader_election(self):
+        """
+        Tests electing a single cache updater with a Lease
+        
+        Verifies:
+            * only one holder acquires the lease
+            * the lease is taken over after it expired
+            * released leases are taken over immediately
+            * standby schedulers do not refresh clusters
+        """
+        self.assert_(Lease.objects.acquire('test', 'host1', 30))
+        self.assertFalse(Lease.objects.acquire('test', 'host2', 30))
+        self.assert_(Lease.objects.acquire('test', 'host1', 30))
+        
+        Lease.objects.filter(name='test') \
+            .update(expires=datetime.now()-timedelta(seconds=1))
+        self.assert_(Lease.objects.acquire('test', 'host2', 30))
+        self.assertFalse(Lease.objects.acquire('test', 'host1', 30))
+        self.assertEqual('host2', Lease.objects.get(name='test').holder)
+        
+        Lease.objects.release('test', 'host2')
+        self.assert_(Lease.objects.acquire('test', 'host1', 30))
+        
+        # the leader only renews after half of the ttl
+        clock = [1000.0]
+        leader = Leader('test-leader', 30, 'host1', lambda: clock[0])
+        standby = Leader('test-leader', 30, 'host2', lambda: clock[0])
+        self.assert_(leader.hold())
+        self.assertFalse(standby.hold())
+        renewed = Lease.objects.get(name='test-leader').renewed
+        clock[0] = 1014
+        self.assert_(leader.hold())
+        self.assertEqual(renewed, Lease.objects.get(name='test-leader').renewed)
+        
+        vm0, cluster = self.create_virtual_machine()
+        updated = []
+        def update(id):
+            updated.append(id)
+            return 0, 0
+        Scheduler(update, leader=standby).run_once()
+        self.assertEqual([], updated)
+        Scheduler(update, leader=leader).run_once()
+        self.assertEqual([cluster.id], updated)
+    
+    def test_hash_ring(self):
+        """
+        Tests assigning keys with consistent hashing
+        
+        Verifies:
+            * keys are spread over all nodes
+            * adding a node only moves keys to the new node
+            * removing it restores the previous assignment
+        """
+        keys = ['cluster%d' % i for i in range(300)]
+        ring = HashRing(['worker1', 'worker2', 'worker3'])
+        before = dict((key, ring.get(key)) for key in keys)
+        self.assertEqual(set(['worker1', 'worker2', 'worker3']), \
+                         set(before.values()))
+        
+        ring.add('worker4')
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        self.assert_(moved)
+        self.assertEqual(set(['worker4']), set([ring.get(k) for k in moved]))
+        
+        ring.remove('worker4')
+        self.assertEqual(before, dict((key, ring.get(key)) for key in keys))
+        self.assertEqual(None, HashRing().get('cluster1'))
+    
+    def test_shards(self):
+        """
+        Tests that sharded schedulers split the clusters between them
+        
+        Verifies:
+            * every cluster is refreshed by exactly one shard
+            * clusters are rebalanced when a worker leaves
+        """
+        for i in range(6):
+            Cluster.objects.create(hostname='test%d.osuosl.bak' % i, \
+                                   slug='OSL_TEST%d' % i)
+        shard1 = Shard('worker1')
+        shard2 = Shard('worker2')
+        shard1.heartbeat.hold()
+        shard2.heartbeat.hold()
+        
+        updated = []
+        def update(id):
+            updated.append(id)
+            return 0, 0
+        scheduler1 = Scheduler(update, shard=shard1)
+        scheduler2 = Scheduler(update, shard=shard2)
+        with MuteStdout():
+            scheduler1.run_once()
+            scheduler2.run_once()
+        ids = list(Cluster.objects.values_list('id', flat=True))
+        self.assertEqual(sorted(ids), sorted(updated))
+        self.assertEqual(('worker1', 'worker2'), shard1.members)
+        
+        # worker2 leaves, worker1 takes over all clusters
+        shard2.heartbeat.release()
+        with MuteStdout():
+            scheduler1.sync()
+        self.assertEqual(('worker1',), shard1.members)
+        self.assertEqual(set(ids), set(scheduler1.states))
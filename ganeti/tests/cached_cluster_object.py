@@ -124,6 +124,25 @@ class CachedClusterObjectBase(TestCase):
         self.assertEqual(timestamp, float(values['mtime']))
         self.assertEqual(timestamp, float(values['cached']))
     
+    def test_timestamp_lookup(self):
+        """
+        Tests range lookups on PreciseDateTimeField
+        
+        Verifies:
+            * comparisons are numeric
+            * microseconds are used in lookups
+        """
+        obj = self.create_model()
+        dt = datetime.fromtimestamp(1285883000.5)
+        obj.cached = dt
+        obj.save()
+        
+        query = TestModel.objects.filter(pk=obj.id)
+        self.assert_(query.filter(cached__lt=datetime.fromtimestamp(1285883000.6)).exists())
+        self.assertFalse(query.filter(cached__lt=datetime.fromtimestamp(1285883000.4)).exists())
+        # a shorter timestamp is smaller numerically but not lexicographically
+        self.assert_(query.filter(cached__gt=datetime.fromtimestamp(999999999)).exists())
+    
     def test_info(self):
         """
         Tests retrieving and setting info
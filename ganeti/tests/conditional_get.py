@@ -0,0 +1,216 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.test import TestCase
+from django.test.client import Client
+
+from object_permissions import *
+
+from ganeti.tests.rapi_proxy import RapiProxy, NODES_BULK
+from ganeti import models
+Cluster = models.Cluster
+VirtualMachine = models.VirtualMachine
+PermissionVersion = models.PermissionVersion
+
+
+__all__ = ('TestConditionalGet', )
+
+
+class TestConditionalGet(TestCase):
+    
+    def setUp(self):
+        self.tearDown()
+        models.client.GanetiRapiClient = RapiProxy
+        
+        User(id=1, username='anonymous').save()
+        settings.ANONYMOUS_USER_ID=1
+        
+        user = User(id=2, username='tester0')
+        user.set_password('secret')
+        user.save()
+        
+        cluster = Cluster(hostname='test.osuosl.test', slug='OSL_TEST')
+        cluster.save()
+        vm = VirtualMachine(cluster=cluster, hostname='vm1.osuosl.bak')
+        vm.save()
+        
+        dict_ = globals()
+        dict_['user'] = user
+        dict_['cluster'] = cluster
+        dict_['vm'] = vm
+        dict_['c'] = Client()
+    
+    def tearDown(self):
+        PermissionVersion.objects.all().delete()
+        VirtualMachine.objects.all().delete()
+        Cluster.objects.all().delete()
+        Group.objects.all().delete()
+        User.objects.all().delete()
+    
+    def validate_conditional(self, url, last_modified=True):
+        """
+        Validates conditional GETs for a url
+        
+        Verifies:
+            * unauthorized responses do not include validators
+            * authorized responses include ETag, and Last-Modified if the page
+              has one
+            * matching ETag results in 304
+            * modifying permissions results in a new ETag
+        """
+        self.assert_(c.login(username=user.username, password='secret'))
+        response = c.get(url)
+        self.assertEqual(403, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+        
+        user.is_superuser = True
+        user.save()
+        # first request may refresh the cache, second request is stable
+        c.get(url)
+        response = c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assert_(response.has_header('ETag'))
+        self.assertEqual(last_modified, response.has_header('Last-Modified'))
+        etag = response['ETag']
+        
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+        
+        PermissionVersion.objects.bump([user.id])
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        return response['ETag']
+    
+    def validate_stale(self, url, etag, model, object):
+        """
+        Verifies:
+            * pages are rendered if the object ignores its cache
+            * pages are rendered if the cache expired
+        """
+        model.objects.filter(id=object.id).update(ignore_cache=True)
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+        
+        expired = datetime.now() \
+            - timedelta(0, 0, 0, settings.LAZY_CACHE_REFRESH + 1000)
+        model.objects.filter(id=object.id) \
+            .update(ignore_cache=False, cached=expired)
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+    
+    def test_cluster_detail(self):
+        """
+        Tests conditional GET for cluster detail
+        
+        Verifies:
+            * editing the cluster changes the ETag
+        """
+        url = '/cluster/%s/' % cluster.slug
+        etag = self.validate_conditional(url, False)
+        
+        Cluster.objects.filter(id=cluster.id).update(description='edited')
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        etag = response['ETag']
+        
+        Cluster.objects.filter(id=cluster.id).update(ram=1024)
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.validate_stale(url, response['ETag'], Cluster, cluster)
+    
+    def test_cluster_nodes(self):
+        """
+        Tests that cluster nodes, which are not cached, have no validators
+        """
+        self.assert_(c.login(username=user.username, password='secret'))
+        user.is_superuser = True
+        user.save()
+        cluster.rapi.GetNodes.response = NODES_BULK
+        response = c.get('/cluster/%s/nodes/' % cluster.slug)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+    
+    def test_cluster_virtual_machines(self):
+        """
+        Tests conditional GET for cluster virtual machines
+        """
+        self.validate_conditional('/cluster/%s/virtual_machines/' % cluster.slug)
+    
+    def test_vm_detail(self):
+        """
+        Tests conditional GET for virtual machine detail
+        
+        Verifies:
+            * changing the owner changes the ETag
+        """
+        url = '/cluster/%s/%s/' % (cluster.slug, vm.hostname)
+        etag = self.validate_conditional(url, False)
+        
+        VirtualMachine.objects.filter(id=vm.id).update(owner=user.get_profile())
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        self.validate_stale(url, response['ETag'], VirtualMachine, vm)
+    
+    def test_vm_list(self):
+        """
+        Tests conditional GET for the virtual machine list
+        
+        Verifies:
+            * adding a virtual machine changes the ETag
+        """
+        url = '/vms/'
+        self.assert_(c.login(username=user.username, password='secret'))
+        user.is_superuser = True
+        user.save()
+        c.get(url)
+        response = c.get(url)
+        etag = response['ETag']
+        
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        
+        VirtualMachine(cluster=cluster, hostname='vm2.osuosl.bak').save()
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+    
+    def test_group_membership(self):
+        """
+        Tests that changing group membership increments the permission version
+        """
+        group = Group(name='testing_group')
+        group.save()
+        version, modified = PermissionVersion.objects.get_version(user)
+        
+        group.user_set.add(user)
+        new_version, modified = PermissionVersion.objects.get_version(user)
+        self.assert_(new_version > version)
+        
+        group.user_set.clear()
+        self.assert_(PermissionVersion.objects.get_version(user)[0] > new_version)
@@ -0,0 +1,136 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template import Context, Template
+from django.template.loader import get_template
+from django.test import TestCase
+
+from ganeti.tests.rapi_proxy import RapiProxy, NODES_BULK
+from ganeti import models
+Cluster = models.Cluster
+VirtualMachine = models.VirtualMachine
+PermissionVersion = models.PermissionVersion
+
+
+__all__ = ('TestFragmentCache', )
+
+
+TEMPLATE = Template('{% load webmgr_tags %}' \
+    '{% cachefragment "test" cluster user %}{{ value }}{% endcachefragment %}')
+
+
+class TestFragmentCache(TestCase):
+    
+    def setUp(self):
+        self.tearDown()
+        models.client.GanetiRapiClient = RapiProxy
+        
+        user = User(id=2, username='tester0')
+        user.save()
+        cluster = Cluster(hostname='test.osuosl.test', slug='OSL_TEST')
+        cluster.save()
+        
+        dict_ = globals()
+        dict_['user'] = user
+        dict_['cluster'] = cluster
+    
+    def tearDown(self):
+        cache.clear()
+        PermissionVersion.objects.all().delete()
+        VirtualMachine.objects.all().delete()
+        Cluster.objects.all().delete()
+        User.objects.all().delete()
+    
+    def render(self, value):
+        return TEMPLATE.render(Context({'cluster':cluster, 'user':user, \
+                                        'value':value}))
+    
+    def test_cached(self):
+        """
+        Tests that a fragment is served from the cache while versions are
+        unchanged
+        """
+        self.assertEqual('first', self.render('first'))
+        self.assertEqual('first', self.render('second'))
+    
+    def test_permission_version(self):
+        """
+        Tests that changing the user's permission version invalidates fragment
+        """
+        self.assertEqual('first', self.render('first'))
+        PermissionVersion.objects.bump([user.id])
+        self.assertEqual('second', self.render('second'))
+
+    def test_user_save(self):
+        """
+        Tests that saving a User only changes its permission version when the
+        superuser or active flag changed
+
+        Verifies:
+            * logging in (which saves last_login) keeps the version
+            * changing is_superuser bumps the version
+        """
+        version = PermissionVersion.objects.get_version(user)[0]
+        user.last_login = datetime.now()
+        user.save()
+        self.assertEqual(version, PermissionVersion.objects.get_version(user)[0])
+        self.assertEqual('first', self.render('first'))
+
+        user.is_superuser = not user.is_superuser
+        user.save()
+        self.assertEqual(version+1, \
+                         PermissionVersion.objects.get_version(user)[0])
+        self.assertEqual('second', self.render('second'))
+    
+    def test_virtual_machines(self):
+        """
+        Tests that adding a VirtualMachine to the cluster invalidates fragment
+        """
+        self.assertEqual('first', self.render('first'))
+        VirtualMachine(cluster=cluster, hostname='vm1.osuosl.bak').save()
+        self.assertEqual('second', self.render('second'))
+    
+    def test_refresh(self):
+        """
+        Tests that refreshing cached info does not invalidate the fragment,
+        but a status change does
+        """
+        vm = VirtualMachine(cluster=cluster, hostname='vm1.osuosl.bak')
+        vm.save()
+        self.assertEqual('first', self.render('first'))
+        VirtualMachine.objects.filter(id=vm.id).update(cached=datetime.now())
+        self.assertEqual('first', self.render('second'))
+        VirtualMachine.objects.filter(id=vm.id).update(status='running')
+        self.assertEqual('second', self.render('second'))
+    
+    def test_node_table(self):
+        """
+        Tests that nodes are only fetched from ganeti when the node table is
+        not cached
+        """
+        template = get_template('node/table.html')
+        cluster.rapi.GetNodes.reset()
+        cluster.rapi.GetNodes.response = NODES_BULK
+        template.render(Context({'cluster':cluster}))
+        template.render(Context({'cluster':cluster}))
+        self.assertEqual(1, len(cluster.rapi.GetNodes.calls))
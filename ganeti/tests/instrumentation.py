@@ -0,0 +1,142 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.client import Client
+
+from ganeti.instrumentation import Histogram, RapiStats, RAPI_STATS
+from ganeti.tests.utils import FakeCurl
+from util.client import GanetiRapiClient, GanetiApiError, PathTemplate, \
+    RequestHook
+
+
+__all__ = ('TestRapiInstrumentation', )
+
+
+class Recorder(RequestHook):
+    def __init__(self):
+        self.calls = []
+    
+    def BeforeRequest(self, request):
+        self.calls.append(('before', request['template'], request['code']))
+    
+    def AfterRequest(self, request):
+        self.calls.append(('after', request['template'], request['code']))
+
+
+class TestRapiInstrumentation(TestCase):
+    
+    def setUp(self):
+        self.tearDown()
+        RAPI_STATS.reset()
+    
+    def tearDown(self):
+        User.objects.all().delete()
+    
+    def test_path_template(self):
+        self.assertEqual('/2/instances', PathTemplate('/2/instances'))
+        self.assertEqual('/2/instances/%s', PathTemplate('/2/instances/vm1'))
+        self.assertEqual('/2/instances/%s/tags', \
+                         PathTemplate('/2/instances/vm1/tags'))
+        self.assertEqual('/2/nodes/%s/role', PathTemplate('/2/nodes/n1/role'))
+        self.assertEqual('/2/jobs/%s', PathTemplate('/2/jobs/42'))
+        self.assertEqual('/version', PathTemplate('/version'))
+    
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1, 10))
+        for value in (0.05, 0.05, 0.5, 5, 50):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1, 1], histogram.counts)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual(0.1, histogram.percentile(40))
+        self.assertEqual(1, histogram.percentile(50))
+        self.assertEqual(None, histogram.percentile(99))
+        self.assertEqual([(0.1, 2), (1, 3), (10, 4)], histogram.cumulative())
+    
+    def test_hooks(self):
+        """
+        Tests that hooks are called around requests
+
+        Verifies:
+            * hooks are called before and after each request
+            * failed requests are recorded as errors
+            * RapiStats aggregates requests per path template
+            * an error raised by a hook does not fail the request
+        """
+        error = '{"code": 404, "message": "Not Found", "explain": ""}'
+        curl = FakeCurl([(200, '[]'), (200, '{}'), (404, error)])
+        recorder = Recorder()
+        stats = RapiStats()
+        broken = RequestHook()
+        broken.AfterRequest = None
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                hooks=[recorder, stats, broken])
+        
+        self.assertEqual([], rapi.GetInstances())
+        rapi.GetInstance('vm1')
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'vm2')
+        
+        self.assertEqual([('before', '/2/instances', None), \
+                          ('after', '/2/instances', 200), \
+                          ('before', '/2/instances/%s', None), \
+                          ('after', '/2/instances/%s', 200), \
+                          ('before', '/2/instances/%s', None), \
+                          ('after', '/2/instances/%s', 404)], recorder.calls)
+        self.assertEqual(404, rapi.last_request['code'])
+        self.assertEqual('/2/instances/vm2', rapi.last_request['path'])
+        
+        endpoints = dict((e.template, e) for e in stats.summary())
+        self.assertEqual(1, endpoints['/2/instances'].count)
+        instance = endpoints['/2/instances/%s']
+        self.assertEqual(2, instance.count)
+        self.assertEqual(1, instance.errors)
+        self.assertEqual({200:1, 404:1}, instance.codes)
+        self.assertEqual(2 + len(error), instance.bytes_in)
+    
+    def test_view(self):
+        """
+        Verifies:
+            * only superusers may view RAPI statistics
+            * endpoints are listed
+        """
+        RAPI_STATS.AfterRequest(dict(method='GET', template='/2/nodes/%s', \
+            code=200, error=None, bytes_in=10, bytes_wire=4, bytes_out=0, \
+            timings={'total':0.2, 'first_byte':0.15, 'connect':0.01}))
+        
+        url = '/metrics/rapi/'
+        user = User(id=2, username='tester0')
+        user.set_password('secret')
+        user.save()
+        c = Client()
+        self.assertEqual(302, c.get(url).status_code)
+        
+        self.assert_(c.login(username=user.username, password='secret'))
+        self.assertEqual(403, c.get(url).status_code)
+        
+        user.is_superuser = True
+        user.save()
+        response = c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'metrics/rapi.html')
+        self.assertContains(response, '/2/nodes/%s')
+        
+        response = c.post(url, {'reset':'Reset'})
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([], RAPI_STATS.summary())
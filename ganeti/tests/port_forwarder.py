@@ -0,0 +1,249 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import os
+from socket import *
+import tempfile
+import time
+
+from django.test import TestCase
+
+from util import bench_portforwarder
+from util.portforwarder import Forwarder, RETRY
+
+
+__all__ = ('TestPortForwarder', 'TestForwarderControl')
+
+
+class TestPortForwarder(TestCase):
+
+    def test_benchmark(self):
+        """
+        Runs a short benchmark through the forwarder daemon
+
+        Verifies:
+            * data is echoed through the forwarder at every level
+            * no sessions fail
+        """
+        rows = bench_portforwarder.run(levels=(1, 10), duration=0.5, size=1024)
+        self.assertEqual([1, 10], [row['sessions'] for row in rows])
+        for row in rows:
+            self.assertEqual(0, row['errors'])
+            self.assertTrue(row['messages'] > 0)
+            self.assertTrue(row['p50'] <= row['p99'])
+
+
+class TestForwarderControl(TestCase):
+    """
+    Drives a Forwarder in this process by calling poll() directly
+    """
+
+    def setUp(self):
+        self.path = tempfile.mktemp(prefix='portforwarder-test-')
+        self.forwarder = Forwarder(self.path)
+        self.backend = socket(AF_INET, SOCK_STREAM)
+        self.backend.bind(('127.0.0.1', 0))
+        self.backend.listen(5)
+        self.backend.settimeout(5)
+        self.rport = self.backend.getsockname()[1]
+
+    def tearDown(self):
+        for lport in self.forwarder.listeners.keys():
+            self.forwarder.close(lport)
+        self.forwarder.control.close()
+        self.backend.close()
+        os.unlink(self.path)
+
+    def free_port(self):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def command(self, *lines):
+        """
+        Sends commands over a single control connection and polls the
+        forwarder until every reply arrived
+        """
+        sock = socket(AF_UNIX, SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(''.join(['%s\n' % line for line in lines]))
+        sock.setblocking(0)
+        replies = ''
+        deadline = time.time() + 10
+        while replies.count('\n') < len(lines) and time.time() < deadline:
+            self.forwarder.poll(0.05)
+            try:
+                replies += sock.recv(1024)
+            except error, e:
+                if e.args[0] not in RETRY:
+                    raise
+        sock.close()
+        replies = replies.splitlines()
+        return replies[0] if len(lines) == 1 else replies
+
+    def connect(self, lport):
+        """
+        Connects a client through the forwarder
+
+        @return tuple of (client, backend) sockets
+        """
+        client = create_connection(('127.0.0.1', lport), 5)
+        for i in range(5):
+            self.forwarder.poll(0.05)
+        server, address = self.backend.accept()
+        server.settimeout(5)
+        return client, server
+
+    def echo(self, client, server, data):
+        """
+        Sends data both ways through a forwarded session
+        """
+        client.sendall(data)
+        self.forwarder.poll(0.1)
+        self.assertEqual(data, server.recv(1024))
+        server.sendall(data[::-1])
+        self.forwarder.poll(0.1)
+        self.assertEqual(data[::-1], client.recv(1024))
+
+    def test_control_socket_private(self):
+        """
+        Tests that only the owner may connect to the control socket
+        """
+        self.assertEqual(0600, os.stat(self.path).st_mode & 0777)
+
+    def test_open(self):
+        """
+        Tests opening mappings
+
+        Verifies:
+            * numeric addresses are opened right away
+            * host names are resolved without blocking and then opened
+            * reopening with the same remote keeps the mapping
+            * list reports open mappings
+            * data is forwarded both ways
+        """
+        lport = self.free_port()
+        self.assertEqual('ok', self.command('open %d 127.0.0.1 %d' \
+                                            % (lport, self.rport)))
+        self.assertEqual('ok', self.command('open %d 127.0.0.1 %d' \
+                                            % (lport, self.rport)))
+        self.assertEqual(1, len(self.forwarder.listeners))
+        client, server = self.connect(lport)
+        self.echo(client, server, 'hello')
+        client.close()
+        server.close()
+
+        lport1 = self.free_port()
+        self.assertEqual('ok', self.command('open %d localhost %d' \
+                                            % (lport1, self.rport)))
+        listener = self.forwarder.listeners[lport1]
+        self.assertEqual(('localhost', self.rport), listener.remote)
+        self.assertEqual(('127.0.0.1', self.rport), listener.target)
+        client, server = self.connect(lport1)
+        self.echo(client, server, 'world')
+        client.close()
+        server.close()
+
+        reply = self.command('list')
+        self.assertTrue(reply.startswith('ok '))
+        self.assertTrue(('%d:127.0.0.1:%d:1:' % (lport, self.rport)) in reply)
+        self.assertTrue(('%d:localhost:%d:1:' % (lport1, self.rport)) in reply)
+
+    def test_close(self):
+        """
+        Tests closing mappings
+
+        Verifies:
+            * new connections to a closed port are refused
+            * established sessions stay open
+            * closing an unmapped port is an error
+        """
+        lport = self.free_port()
+        self.command('open %d 127.0.0.1 %d' % (lport, self.rport))
+        client, server = self.connect(lport)
+
+        self.assertEqual('ok', self.command('close %d' % lport))
+        self.assertEqual({}, self.forwarder.listeners)
+        self.assertRaises(error, create_connection, ('127.0.0.1', lport), 5)
+        self.echo(client, server, 'still open')
+        client.close()
+        server.close()
+
+        self.assertEqual('error port not mapped', \
+                         self.command('close %d' % lport))
+
+    def test_expiry(self):
+        """
+        Tests reusing the port of an expired lease for a new destination
+
+        Verifies:
+            * opening a mapped port with a different remote replaces it
+            * new sessions go to the new remote
+        """
+        lport = self.free_port()
+        other = socket(AF_INET, SOCK_STREAM)
+        other.bind(('127.0.0.1', 0))
+        other.listen(5)
+        other.settimeout(5)
+        try:
+            self.command('open %d 127.0.0.1 %d' % (lport, other.getsockname()[1]))
+            self.assertEqual('ok', self.command('open %d 127.0.0.1 %d' \
+                                                % (lport, self.rport)))
+            self.assertEqual(('127.0.0.1', self.rport), \
+                             self.forwarder.listeners[lport].remote)
+            client, server = self.connect(lport)
+            self.echo(client, server, 'new remote')
+            client.close()
+            server.close()
+        finally:
+            other.close()
+
+    def test_errors(self):
+        """
+        Tests error replies
+
+        Verifies:
+            * empty, unknown and malformed commands are errors
+            * a port that can not be bound is an error
+            * a host name that does not resolve is an error
+            * commands after a pending lookup are answered in order
+        """
+        self.assertEqual('error empty command', self.command(''))
+        self.assertEqual('error unknown command foo', self.command('foo'))
+        self.assertEqual('error unknown command open', self.command('open 1'))
+        self.assertTrue(self.command('open x 127.0.0.1 1').startswith('error'))
+
+        used = socket(AF_INET, SOCK_STREAM)
+        used.bind(('0.0.0.0', 0))
+        used.listen(1)
+        try:
+            reply = self.command('open %d 127.0.0.1 %d' \
+                                 % (used.getsockname()[1], self.rport))
+            self.assertTrue(reply.startswith('error'), reply)
+        finally:
+            used.close()
+
+        lport = self.free_port()
+        replies = self.command('open %d host.invalid 5900' % lport, 'list')
+        self.assertEqual(2, len(replies))
+        self.assertTrue(replies[0].startswith('error'), replies)
+        self.assertEqual('ok ', replies[1])
+        self.assertEqual({}, self.forwarder.listeners)
@@ -0,0 +1,366 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import json
+import time
+
+import pycurl
+
+from django.test import TestCase
+
+from ganeti.tests.rapi_proxy import INSTANCES_BULK
+from ganeti.tests.utils import FakeCurl, FakeCurlMulti
+from util.client import GanetiRapiClient, GanetiApiError, CircuitBreaker, \
+    CircuitOpenError, AdaptiveTimeouts, RetryPolicy, JsonArraySplitter, \
+    JsonCodec, GetJsonCodec, JSON_CODECS, Error
+
+
+__all__ = ('TestRapiClient', )
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+class TestRapiClient(TestCase):
+    
+    def test_circuit_breaker(self):
+        """
+        Verifies:
+            * breaker opens after consecutive failures
+            * a success resets the failure count
+            * a single probe is allowed after the reset timeout
+            * a failed probe opens the breaker again
+        """
+        clock = Clock()
+        breaker = CircuitBreaker(3, 30, clock)
+        breaker.RecordFailure()
+        breaker.RecordFailure()
+        breaker.RecordSuccess()
+        breaker.RecordFailure()
+        breaker.RecordFailure()
+        self.assert_(breaker.Allow())
+        breaker.RecordFailure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.Allow())
+        self.assertEqual(30, breaker.RetryAfter())
+        
+        clock.now += 30
+        self.assert_(breaker.Allow())
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertFalse(breaker.Allow())
+        breaker.RecordFailure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.Allow())
+        
+        clock.now += 30
+        self.assert_(breaker.Allow())
+        breaker.RecordSuccess()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assert_(breaker.Allow())
+        self.assert_(breaker.Allow())
+    
+    def test_adaptive_timeouts(self):
+        """
+        Verifies:
+            * maximum timeouts are used until enough requests were observed
+            * timeouts follow the latency of each path template
+            * timeouts stay within the limits
+        """
+        timeouts = AdaptiveTimeouts(10, 300, 1, 5, factor=4, min_samples=3)
+        self.assertEqual((10, 300), timeouts.Get('/2/instances'))
+        for i in range(3):
+            timeouts.Observe('/2/instances', {'connect':0.5, 'total':20})
+            timeouts.Observe('/2/info', {'connect':0.01, 'total':0.1})
+        self.assertEqual((2, 80), timeouts.Get('/2/instances'))
+        self.assertEqual((2, 5), timeouts.Get('/2/info'))
+        self.assertEqual((2, 300), timeouts.Get('/2/nodes'))
+        
+        for i in range(3):
+            timeouts.Observe('/2/instances', {'connect':5, 'total':100})
+        self.assertEqual((10, 300), timeouts.Get('/2/instances'))
+    
+    def test_client_circuit_breaker(self):
+        """
+        Verifies:
+            * network errors and server errors open the breaker
+            * requests fail fast without contacting the cluster while open
+            * client errors such as 404 do not count as failures
+        """
+        clock = Clock()
+        curl = FakeCurl([pycurl.error(7, 'connection refused'), \
+                         (502, '"bad gateway"'), \
+                         (404, '{"code":404, "message":"", "explain":""}')])
+        breaker = CircuitBreaker(2, 30, clock)
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                circuit_breaker=breaker)
+        
+        self.assertRaises(GanetiApiError, rapi.GetInfo)
+        self.assertRaises(GanetiApiError, rapi.GetInfo)
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertRaises(CircuitOpenError, rapi.GetInfo)
+        self.assertEqual(2, len(curl.requests))
+        
+        clock.now += 30
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'missing')
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertEqual(3, len(curl.requests))
+    
+    def test_client_timeouts(self):
+        """
+        Tests that adaptive timeouts are set on each request
+        """
+        curl = FakeCurl([(200, '{}')])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                timeouts=AdaptiveTimeouts(7, 60))
+        rapi.GetInfo()
+        if hasattr(pycurl, 'TIMEOUT_MS'):
+            self.assertEqual(7000, curl.opts[pycurl.CONNECTTIMEOUT_MS])
+            self.assertEqual(60000, curl.opts[pycurl.TIMEOUT_MS])
+        else:
+            self.assertEqual(7, curl.opts[pycurl.CONNECTTIMEOUT])
+            self.assertEqual(60, curl.opts[pycurl.TIMEOUT])
+    
+    def test_retry(self):
+        """
+        Verifies:
+            * GET requests are retried after network and gateway errors
+            * the backoff is jittered and grows exponentially
+            * requests submitting jobs are not retried
+            * client errors are not retried
+        """
+        sleeps = []
+        policy = RetryPolicy(retries=2, backoff=0.1, max_backoff=1, \
+                             sleep=sleeps.append, rand=lambda: 0.5)
+        curl = FakeCurl([pycurl.error(7, 'connection refused'), \
+                         (503, '"unavailable"'), (200, '{}'), \
+                         pycurl.error(7, 'connection refused'), \
+                         (404, '{"code":404, "message":"", "explain":""}')])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                retry_policy=policy)
+        
+        self.assertEqual({}, rapi.GetInfo())
+        self.assertEqual(3, len(curl.requests))
+        self.assertEqual([0.05, 0.1], sleeps)
+        
+        self.assertRaises(GanetiApiError, rapi.ShutdownInstance, 'vm1')
+        self.assertEqual(4, len(curl.requests))
+        
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'missing')
+        self.assertEqual(5, len(curl.requests))
+    
+    def test_html_error(self):
+        """
+        Tests error responses that are not JSON, such as a proxy's 503 page
+
+        Verifies:
+            * GanetiApiError is raised with the body as message
+            * the request is retried
+            * the failure is counted by the circuit breaker
+            * streamed requests raise GanetiApiError as well
+        """
+        html = '<html><body><h1>503 Service Unavailable</h1></body></html>'
+        policy = RetryPolicy(retries=1, sleep=lambda s: None)
+        breaker = CircuitBreaker(2, 30, Clock())
+        curl = FakeCurl([(503, html), (503, html), (502, html)])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                retry_policy=policy, circuit_breaker=breaker, \
+                                curl_multi_factory=lambda: FakeCurlMulti())
+        
+        try:
+            rapi.GetInfo()
+            self.fail('GanetiApiError was not raised')
+        except GanetiApiError, e:
+            self.assertEqual(503, e.code)
+            self.assertEqual(html, str(e))
+        self.assertEqual(2, len(curl.requests))
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        
+        breaker = CircuitBreaker(2, 30, Clock())
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                circuit_breaker=breaker, \
+                                curl_multi_factory=lambda: FakeCurlMulti())
+        self.assertRaises(GanetiApiError, list, rapi.GetInstancesIter())
+        self.assertEqual(1, breaker.failures)
+    
+    def test_retry_budget(self):
+        """
+        Tests that retries stop once the budget is spent, and resume when it
+        is refilled
+        """
+        clock = Clock()
+        policy = RetryPolicy(retries=2, budget_ratio=0.5, min_per_second=0.1, \
+                             max_tokens=1, clock=clock, sleep=lambda s: None)
+        error = pycurl.error(7, 'connection refused')
+        curl = FakeCurl([error] * 6)
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                retry_policy=policy)
+        
+        # one token, a single retry
+        self.assertRaises(GanetiApiError, rapi.GetInfo)
+        self.assertEqual(2, len(curl.requests))
+        
+        # deposit of the request is not enough for a retry
+        self.assertRaises(GanetiApiError, rapi.GetInfo)
+        self.assertEqual(3, len(curl.requests))
+        
+        # deposit and refill over time
+        clock.now += 5
+        self.assertRaises(GanetiApiError, rapi.GetInfo)
+        self.assertEqual(5, len(curl.requests))
+    
+    def test_compression(self):
+        """
+        Verifies:
+            * compressed responses are only accepted when enabled
+            * the size on the wire and the decompressed size are reported
+        """
+        body = '[%s]' % ', '.join(['{"name": "vm.osuosl.bak"}'] * 10)
+        curl = FakeCurl([(200, body), (200, body)])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl)
+        rapi.GetInstances(bulk=True)
+        self.assertFalse(pycurl.ENCODING in curl.opts)
+        self.assertEqual(len(body), rapi.last_request['bytes_wire'])
+        
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                compression=True)
+        curl.info[pycurl.SIZE_DOWNLOAD] = 60.0
+        rapi.GetInstances(bulk=True)
+        self.assertEqual('gzip, deflate', curl.opts[pycurl.ENCODING])
+        self.assertEqual(len(body), rapi.last_request['bytes_in'])
+        self.assertEqual(60, rapi.last_request['bytes_wire'])
+    
+    def test_json_codecs(self):
+        """
+        Verifies:
+            * every available codec round trips the bulk instance list
+            * the default codec is the first, and codecs are found by name
+            * unknown or missing codecs raise an error
+            * the client decodes responses with its codec
+        """
+        self.assertTrue(JSON_CODECS)
+        for codec in JSON_CODECS:
+            self.assertEqual(INSTANCES_BULK, \
+                             codec.loads(codec.dumps(INSTANCES_BULK)))
+            self.assertTrue(codec is GetJsonCodec(codec.name))
+        self.assertTrue(JSON_CODECS[0] is GetJsonCodec())
+        self.assertRaises(Error, GetJsonCodec, 'unknown')
+        
+        decoded = []
+        def loads(text):
+            decoded.append(text)
+            return json.loads(text)
+        codec = JsonCodec('test', json.dumps, loads, False)
+        body = '[{"id": "vm.osuosl.bak"}]'
+        curl = FakeCurl([(200, body)])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                json_codec=codec)
+        self.assertEqual(['vm.osuosl.bak'], rapi.GetInstances())
+        self.assertEqual([body], decoded)
+    
+    def test_json_array_splitter(self):
+        """
+        Verifies:
+            * items are split correctly regardless of chunk boundaries
+            * brackets, quotes and escapes inside strings are ignored
+            * responses that are not arrays or are incomplete are rejected
+        """
+        data = list(INSTANCES_BULK) + [{'name':'a]b", \\', 'x':[{'y':'}{'}]}]
+        text = json.dumps(data)
+        for size in (1, 2, 3, 7, 64, len(text)):
+            splitter = JsonArraySplitter()
+            items = []
+            for i in range(0, len(text), size):
+                items.extend(splitter.Feed(text[i:i+size]))
+            splitter.Close()
+            self.assertEqual(data, [json.loads(item) for item in items])
+        
+        splitter = JsonArraySplitter()
+        self.assertEqual([], splitter.Feed(' [ ] '))
+        splitter.Close()
+        
+        self.assertRaises(ValueError, JsonArraySplitter().Feed, '{"a": 1}')
+        splitter = JsonArraySplitter()
+        self.assertEqual(['1'], splitter.Feed('[1, 2'))
+        self.assertRaises(ValueError, splitter.Close)
+    
+    def test_get_instances_iter(self):
+        """
+        Verifies:
+            * instances are yielded before the whole response is received
+            * the result is the same as GetInstances
+            * error responses raise GanetiApiError
+        """
+        text = json.dumps(INSTANCES_BULK)
+        multi = FakeCurlMulti(chunk_size=64)
+        names = '[{"id": "vm1", "uri": "/2/instances/vm1"}, {"id": "vm2"}]'
+        curl = FakeCurl([(200, text), (200, names), \
+            (404, '{"code":404, "message":"", "explain":""}'), \
+            (200, '[{"name": "vm1"}, {"na')])
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                curl_multi_factory=lambda: multi)
+        
+        instances = rapi.GetInstancesIter(bulk=True)
+        self.assertEqual(INSTANCES_BULK[0], instances.next())
+        self.assert_(multi.chunks)
+        self.assertEqual(INSTANCES_BULK[1:], list(instances))
+        self.assertEqual(len(text), rapi.last_request['bytes_in'])
+        
+        self.assertEqual(['vm1', 'vm2'], list(rapi.GetInstancesIter()))
+        self.assertRaises(GanetiApiError, list, rapi.GetInstancesIter())
+        self.assertRaises(GanetiApiError, list, rapi.GetInstancesIter(True))
+    
+    def test_get_instances_iter_timeouts(self):
+        """
+        Verifies:
+            * streamed requests have a stall timeout instead of a total timeout
+            * time spent by the consumer is not observed as request time
+            * other requests get a total timeout again
+        """
+        text = json.dumps(INSTANCES_BULK)
+        multi = FakeCurlMulti(chunk_size=64)
+        curl = FakeCurl([(200, text), (200, '{}')])
+        curl.info[pycurl.TOTAL_TIME] = 1.0
+        timeouts = AdaptiveTimeouts(7, 60, min_samples=1)
+        rapi = GanetiRapiClient('test.osuosl.bak', curl_factory=lambda: curl, \
+                                curl_multi_factory=lambda: multi, \
+                                timeouts=timeouts)
+        
+        for instance in rapi.GetInstancesIter(bulk=True):
+            time.sleep(0.3 / len(INSTANCES_BULK))
+        self.assertEqual(1, curl.opts[pycurl.LOW_SPEED_LIMIT])
+        self.assertEqual(60, curl.opts[pycurl.LOW_SPEED_TIME])
+        if hasattr(pycurl, 'TIMEOUT_MS'):
+            self.assertEqual(0, curl.opts[pycurl.TIMEOUT_MS])
+        else:
+            self.assertEqual(0, curl.opts[pycurl.TIMEOUT])
+        timings = rapi.last_request['timings']
+        self.assert_(timings['consumer'] >= 0.3)
+        self.assertAlmostEqual(1.0 - timings['consumer'], timings['total'])
+        self.assertEqual([timings['total']], \
+                         timeouts._total[rapi.last_request['template']])
+        
+        rapi.GetInfo()
+        self.assertEqual(0, curl.opts[pycurl.LOW_SPEED_TIME])
+        if hasattr(pycurl, 'TIMEOUT_MS'):
+            self.assertNotEqual(0, curl.opts[pycurl.TIMEOUT_MS])
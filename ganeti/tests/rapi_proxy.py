@@ -461,6 +461,10 @@ class RapiProxy(client.GanetiRapiClient):
     def fail(self, *args, **kwargs):
         raise self.error
     
+    def GetInstancesIter(self, bulk=False):
+        """ streams the response patched on GetInstances """
+        return iter(self.GetInstances(bulk=bulk))
+    
     def __getattribute__(self, key):
         if key in ['GetInstances','GetInstance','GetNodes','GetNode', \
                    'GetInfo', 'StartupInstance', 'ShutdownInstance', \
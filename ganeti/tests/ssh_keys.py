@@ -18,6 +18,12 @@
 
 
 from datetime import datetime
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tempfile
+import urllib2
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
@@ -28,9 +34,10 @@ from django.test.client import Client
 
 from object_permissions import *
 from ganeti.models import SSHKey, validate_sshkey
+from util import sshkeys
 
 
-__all__ = ('TestSSHKeys', )
+__all__ = ('TestSSHKeys', 'TestSSHKeysClient')
 
 class TestSSHKeys(TestCase):
     
@@ -216,3 +223,178 @@ class TestSSHKeys(TestCase):
             self.assertEquals("application/json", response['content-type'])
             self.assertContains(response, "1", count=1)
             self.assertEqual(0, len(SSHKey.objects.filter(id=key_id)) )
+
+
+class Response(StringIO):
+    """
+    Stand-in for the response returned by urllib2.urlopen
+    """
+    def __init__(self, content, headers):
+        StringIO.__init__(self, content)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+
+class Stop(Exception):
+    pass
+
+
+class TestSSHKeysClient(TestCase):
+    """
+    Tests for util/sshkeys.py.  urlopen is replaced by a function returning
+    or raising the next item of self.responses.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'cache')
+        self.output = os.path.join(self.dir, 'authorized_keys')
+        self.responses = []
+        self.requests = []
+        self.urlopen = sshkeys.urllib2.urlopen
+        self.sleep = sshkeys.time.sleep
+        self.stderr = sys.stderr
+        sshkeys.urllib2.urlopen = self.fake_urlopen
+        sys.stderr = StringIO()
+        self.app = sshkeys.Application('localhost', 'key', 'cluster', 'vm', \
+                                       cache=self.cache)
+
+    def tearDown(self):
+        sshkeys.urllib2.urlopen = self.urlopen
+        sshkeys.time.sleep = self.sleep
+        sys.stderr = self.stderr
+        shutil.rmtree(self.dir)
+
+    def fake_urlopen(self, request):
+        self.requests.append(request)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def keys(self, content, etag='"1"'):
+        return Response(content, {'Content-Type':'application/json', \
+                                  'ETag':etag})
+
+    def http_error(self, code):
+        return urllib2.HTTPError('http://localhost/', code, 'error', {}, None)
+
+    def test_cache(self):
+        """
+        Tests caching the last response
+
+        Verifies:
+            * responses are stored with their ETag
+            * the ETag is sent and 304 returns the cached keys
+            * 5xx errors and unreachable servers return the cached keys
+            * other errors are raised
+        """
+        self.responses.append(self.keys('[["ssh-rsa a", "a"]]'))
+        self.assertEqual('[["ssh-rsa a", "a"]]', self.app.get())
+        self.assertEqual(('"1"', '[["ssh-rsa a", "a"]]'), self.app.load_cache())
+        self.assertFalse(self.requests[0].has_header('If-none-match'))
+
+        self.responses.append(self.http_error(304))
+        self.assertEqual('[["ssh-rsa a", "a"]]', self.app.get())
+        self.assertEqual('"1"', self.requests[1].get_header('If-none-match'))
+
+        for error in (self.http_error(500), self.http_error(503), \
+                      urllib2.URLError('connection refused')):
+            self.responses.append(error)
+            self.assertEqual('[["ssh-rsa a", "a"]]', self.app.get())
+
+        self.responses.append(self.http_error(403))
+        self.assertRaises(urllib2.HTTPError, self.app.get)
+
+        self.responses.append(self.keys('[]', '"2"'))
+        self.assertEqual('[]', self.app.get())
+        self.assertEqual(('"2"', '[]'), self.app.load_cache())
+
+    def test_no_cache(self):
+        """
+        Tests that errors are raised when there is no cached response
+        """
+        self.app.cache = None
+        for error in (self.http_error(500), urllib2.URLError('refused')):
+            self.responses.append(error)
+            self.assertRaises(urllib2.URLError, self.app.get)
+
+        open(self.cache, 'w').write('not json')
+        self.app.cache = self.cache
+        self.assertEqual((None, None), self.app.load_cache())
+        self.responses.append(self.http_error(502))
+        self.assertRaises(urllib2.HTTPError, self.app.get)
+
+    def test_write_file(self):
+        """
+        Tests replacing files
+
+        Verifies:
+            * the file is written with mode 0600
+            * unchanged content is not written again
+            * no temporary files are left behind
+        """
+        self.assertTrue(sshkeys.write_file(self.output, 'keys'))
+        self.assertEqual('keys', open(self.output).read())
+        self.assertEqual(0600, os.stat(self.output).st_mode & 0777)
+        self.assertFalse(sshkeys.write_file(self.output, 'keys'))
+        self.assertTrue(sshkeys.write_file(self.output, 'other keys'))
+        self.assertEqual('other keys', open(self.output).read())
+        self.assertEqual(['authorized_keys'], os.listdir(self.dir))
+
+    def test_write_file_error(self):
+        """
+        Tests that a failed write closes and removes the temporary file
+        """
+        fds = []
+        def fsync(fd):
+            fds.append(fd)
+            raise OSError(28, 'No space left on device')
+        sshkeys.os.fsync, fsync_ = fsync, os.fsync
+        try:
+            self.assertRaises(OSError, sshkeys.write_file, self.output, 'keys')
+        finally:
+            sshkeys.os.fsync = fsync_
+        self.assertRaises(OSError, os.fstat, fds[0])
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_daemon(self):
+        """
+        Tests daemon mode
+
+        Verifies:
+            * output is updated on every poll
+            * a failed poll keeps the previous output
+            * sleeps are randomized within the jitter
+        """
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                raise Stop()
+        sshkeys.time.sleep = sleep
+        self.app.cache = None
+        self.responses.extend([
+            self.keys('[["ssh-rsa a", "a"]]'),
+            urllib2.URLError('refused'),
+            self.keys('[["ssh-rsa b", "b"]]'),
+        ])
+
+        self.assertRaises(Stop, self.app.daemon, self.output, 100, 0.2)
+        self.assertEqual([], self.responses)
+        self.assertEqual('ssh-rsa b  added automatically for ganeti web ' \
+                         'manager user: b\n', open(self.output).read())
+        for seconds in sleeps:
+            self.assertTrue(80 <= seconds <= 120, seconds)
+
+    def test_run_error(self):
+        """
+        Tests that a failed run reports the error and keeps the output
+        """
+        sshkeys.write_file(self.output, 'keys')
+        self.responses.append(urllib2.URLError('refused'))
+        self.assertFalse(self.app.run(self.output))
+        self.assertEqual('keys', open(self.output).read())
+        self.assertTrue('refused' in sys.stderr.getvalue())
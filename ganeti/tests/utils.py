@@ -29,4 +29,89 @@ class MuteStdout(object):
     
     def write(self, str):
         """ ignore all calls to write """
-        pass
\ No newline at end of file
+        pass
+
+class FakeCurl(object):
+    """
+    Replacement for pycurl.Curl that returns canned responses.  Pass a factory
+    returning it as curl_factory to GanetiRapiClient.
+
+    @param responses - list of (http code, body) tuples or exceptions to raise,
+        used in order by each request
+    """
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.opts = {}
+        self.info = {}
+        self.requests = []
+    
+    def setopt(self, option, value):
+        self.opts[option] = value
+    
+    def perform(self):
+        import pycurl
+        self.requests.append((self.opts.get(pycurl.CUSTOMREQUEST), \
+                              self.opts.get(pycurl.URL)))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        code, body = response
+        self.info[pycurl.RESPONSE_CODE] = code
+        self.opts[pycurl.WRITEFUNCTION](body)
+    
+    def getinfo(self, info):
+        return self.info.get(info, 0)
+
+
+class FakeCurlMulti(object):
+    """
+    Replacement for pycurl.CurlMulti driving a FakeCurl.  The response body is
+    written in chunks of chunk_size bytes, one chunk per call to perform().
+    """
+    def __init__(self, chunk_size=16):
+        self.chunk_size = chunk_size
+        self.curl = None
+        self.chunks = None
+        self.failed = []
+    
+    def add_handle(self, curl):
+        self.curl = curl
+        self.chunks = None
+        self.failed = []
+    
+    def perform(self):
+        import pycurl
+        curl = self.curl
+        if self.chunks is None:
+            curl.requests.append((curl.opts.get(pycurl.CUSTOMREQUEST), \
+                                  curl.opts.get(pycurl.URL)))
+            response = curl.responses.pop(0)
+            if isinstance(response, Exception):
+                self.failed = [(curl,) + tuple(response.args)]
+                self.chunks = []
+                return 0, 0
+            code, body = response
+            curl.info[pycurl.RESPONSE_CODE] = code
+            size = self.chunk_size
+            self.chunks = [body[i:i+size] for i in range(0, len(body), size)]
+        
+        if self.chunks:
+            chunk = self.chunks.pop(0)
+            written = curl.opts[pycurl.WRITEFUNCTION](chunk)
+            if written is not None and written != len(chunk):
+                self.failed = [(curl, 23, 'Failed writing body')]
+                self.chunks = []
+        return 0, 1 if self.chunks else 0
+    
+    def select(self, timeout):
+        return 1
+    
+    def info_read(self):
+        ok = [] if self.failed else [self.curl]
+        return 0, ok, self.failed
+    
+    def remove_handle(self, curl):
+        self.curl = None
+    
+    def close(self):
+        pass
@@ -586,6 +586,58 @@ class TestVirtualMachineViews(TestCase, VirtualMachineTestCaseMixin):
         self.assertNotContains(response, "test@test")
         self.assertNotContains(response, "asd@asd")
 
+    def test_view_ssh_keys_bulk(self):
+        """
+        Test getting SSH keys for all virtual machines of a cluster
+
+        Verifies:
+            * keys are returned per hostname
+            * hostname parameters limit the virtual machines
+            * matching ETags return 304
+            * adding a key changes the ETag
+            * permission changes of users without keys keep the ETag
+            * logging in keeps the ETag
+        """
+        vm1, cluster1 = self.create_virtual_machine(cluster, 'vm2.osuosl.bak')
+        user.grant("admin", vm)
+        SSHKey(key="ssh-rsa test test@test", user=user).save()
+
+        import settings, json
+        key = settings.WEB_MGR_API_KEY
+        url = reverse("cluster-keys", args=[cluster.slug, key])
+
+        response = c.get(reverse("cluster-keys", args=[cluster.slug, key+"a"]))
+        self.assertEqual(403, response.status_code)
+        response = c.get(reverse("cluster-keys", args=[cluster.slug+"a", key]))
+        self.assertEqual(404, response.status_code)
+
+        response = c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEquals("application/json", response["content-type"])
+        data = json.loads(response.content)
+        self.assertEqual([["ssh-rsa test test@test", user.username]], \
+                         data[vm.hostname])
+        self.assertEqual([], data[vm1.hostname])
+
+        response = c.get(url, {'hostname':vm1.hostname})
+        self.assertEqual([vm1.hostname], json.loads(response.content).keys())
+
+        etag = c.get(url)['ETag']
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        user1.is_superuser = True
+        user1.save()
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        user.last_login = datetime.now()
+        user.save()
+        self.assertEqual(304, c.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        SSHKey(key="ssh-dsa test asd@asd", user=user).save()
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(json.loads(response.content)[vm.hostname]))
+
     def test_view_create_data(self):
         """
         Test creating a virtual machine
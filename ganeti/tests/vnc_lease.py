@@ -0,0 +1,198 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from datetime import datetime, timedelta
+import socket
+
+from django.conf import settings
+from django.test import TestCase
+
+from ganeti.tests.rapi_proxy import RapiProxy, INSTANCE
+from ganeti import models
+from ganeti.cache import Scheduler
+Cluster = models.Cluster
+VirtualMachine = models.VirtualMachine
+VNCPortLease = models.VNCPortLease
+PortPoolExhausted = models.PortPoolExhausted
+PortForwardingError = models.PortForwardingError
+
+
+__all__ = ('TestVNCPortLease', )
+
+
+class TestVNCPortLease(TestCase):
+
+    def setUp(self):
+        self.tearDown()
+        models.client.GanetiRapiClient = RapiProxy
+
+        # record commands instead of sending them to a forwarder daemon,
+        # replies maps a command name to its reply or an exception to raise
+        commands = []
+        replies = {}
+        def send_command(command, path):
+            commands.append(command)
+            reply = replies.get(command.split()[0], 'ok')
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        models.send_command = send_command
+        settings.VNC_PORT_RANGE = (12000, 12001)
+        settings.VNC_LEASE_TIMEOUT = 300
+
+        cluster = Cluster(hostname='test.osuosl.test', slug='OSL_TEST')
+        cluster.save()
+        vm = VirtualMachine(cluster=cluster, hostname='vm1.osuosl.bak')
+        vm.save()
+        vm1 = VirtualMachine(cluster=cluster, hostname='vm2.osuosl.bak')
+        vm1.save()
+
+        dict_ = globals()
+        dict_['cluster'] = cluster
+        dict_['vm'] = vm
+        dict_['vm1'] = vm1
+        dict_['commands'] = commands
+        dict_['replies'] = replies
+
+    def tearDown(self):
+        VNCPortLease.objects.all().delete()
+        VirtualMachine.objects.all().delete()
+        Cluster.objects.all().delete()
+
+    def test_lease(self):
+        """
+        Tests leasing ports from the pool
+
+        Verifies:
+            * the same destination reuses its lease
+            * only a new lease is reported as created
+            * destinations with the same port on different nodes do not collide
+            * PortPoolExhausted is raised when all ports are leased
+        """
+        self.assertEqual((12000, True), \
+                         VNCPortLease.objects.lease(vm, 'node1', 5900))
+        self.assertEqual((12000, False), \
+                         VNCPortLease.objects.lease(vm, 'node1', 5900))
+        self.assertEqual(1, VNCPortLease.objects.count())
+
+        self.assertEqual((12001, True), \
+                         VNCPortLease.objects.lease(vm1, 'node2', 5900))
+        self.assertRaises(PortPoolExhausted, VNCPortLease.objects.lease, \
+                          vm1, 'node3', 5900)
+
+    def test_expired(self):
+        """
+        Tests that expired leases are released and their ports reused
+        """
+        VNCPortLease.objects.lease(vm, 'node1', 5900)
+        VNCPortLease.objects.lease(vm1, 'node2', 5900)
+        VNCPortLease.objects.filter(port=12000) \
+            .update(expires=datetime.now()-timedelta(seconds=1))
+
+        port, created = VNCPortLease.objects.lease(vm1, 'node3', 5900)
+        self.assertEqual(12000, port)
+        self.assertEqual(['close 12000'], commands)
+        lease = VNCPortLease.objects.get(port=12000)
+        self.assertEqual('node3', lease.remote_host)
+
+    def test_setup_vnc_forwarding(self):
+        """
+        Tests that opening a console maps the leased port in the forwarder
+        """
+        vm.info = INSTANCE
+        port, password = vm.setup_vnc_forwarding()
+        self.assertEqual(12000, port)
+        self.assertEqual(['open 12000 gtest1.osuosl.bak 11165'], commands)
+
+    def test_setup_vnc_forwarding_error(self):
+        """
+        Tests that a failed mapping releases its lease
+
+        Verifies:
+            * an error reply raises PortForwardingError
+            * an unreachable daemon raises socket.error
+            * the lease is deleted and its port closed in both cases
+        """
+        vm.info = INSTANCE
+        replies['open'] = 'error [Errno 98] Address already in use'
+        self.assertRaises(PortForwardingError, vm.setup_vnc_forwarding)
+        self.assertFalse(VNCPortLease.objects.exists())
+        self.assertEqual(['open 12000 gtest1.osuosl.bak 11165', 'close 12000'], \
+                         commands)
+
+        replies['open'] = socket.error(111, 'Connection refused')
+        self.assertRaises(socket.error, vm.setup_vnc_forwarding)
+        self.assertFalse(VNCPortLease.objects.exists())
+
+        del replies['open']
+        port, password = vm.setup_vnc_forwarding()
+        self.assertEqual(12000, port)
+
+    def test_setup_vnc_forwarding_error_reused(self):
+        """
+        Tests that a failed mapping keeps a lease it reused, another console
+        may still be served by it
+        """
+        vm.info = INSTANCE
+        vm.setup_vnc_forwarding()
+        replies['open'] = 'error [Errno 98] Address already in use'
+        self.assertRaises(PortForwardingError, vm.setup_vnc_forwarding)
+        self.assertEqual([12000], \
+            list(VNCPortLease.objects.values_list('port', flat=True)))
+        self.assertEqual(['open 12000 gtest1.osuosl.bak 11165'] * 2, commands)
+
+        replies['open'] = socket.error(111, 'Connection refused')
+        self.assertRaises(socket.error, vm.setup_vnc_forwarding)
+        self.assertTrue(VNCPortLease.objects.filter(port=12000).exists())
+
+    def test_release_expired_stale(self):
+        """
+        Tests that leases left behind half released are deleted
+
+        Verifies:
+            * a lease released less than VNC_LEASE_TIMEOUT ago is left to the
+              worker releasing it
+            * a stale lease is closed and deleted
+        """
+        VNCPortLease.objects.lease(vm, 'node1', 5900)
+        VNCPortLease.objects.filter(port=12000).update(remote_port=0, \
+            expires=datetime.now()-timedelta(seconds=1))
+        VNCPortLease.objects.release_expired()
+        self.assertTrue(VNCPortLease.objects.filter(port=12000).exists())
+        self.assertEqual([], commands)
+
+        VNCPortLease.objects.filter(port=12000).update( \
+            expires=datetime.now()-timedelta(seconds=settings.VNC_LEASE_TIMEOUT+1))
+        VNCPortLease.objects.release_expired()
+        self.assertFalse(VNCPortLease.objects.exists())
+        self.assertEqual(['close 12000'], commands)
+
+    def test_release_expired_updater(self):
+        """
+        Tests that the cache updater releases expired leases
+        """
+        VNCPortLease.objects.lease(vm, 'node1', 5900)
+        VNCPortLease.objects.lease(vm1, 'node2', 5900)
+        VNCPortLease.objects.filter(port=12000) \
+            .update(expires=datetime.now()-timedelta(seconds=1))
+
+        Scheduler(lambda id: None).report()
+        self.assertEqual([12001], \
+            list(VNCPortLease.objects.values_list('port', flat=True)))
+        self.assertEqual(['close 12000'], commands)
@@ -91,6 +91,7 @@ urlpatterns += patterns('ganeti.views.virtual_machine',
 
     # SSH Keys
     url(r'^%s/keys/(?P<api_key>\w+)/?$' % vm_prefix, "ssh_keys", name="instance-keys"),
+    url(r'^%s/keys/(?P<api_key>\w+)/?$' % cluster, "cluster_ssh_keys", name="cluster-keys"),
 )
 
 
@@ -105,3 +106,27 @@ urlpatterns += patterns('ganeti.views.importing',
 urlpatterns += patterns('ganeti.views.jobs',
     url(r'^%s/job/(?P<job_id>\d+)/status' % cluster, 'status', name='job-status'),
 )
+
+# JSON API
+api_cluster = 'api/%s' % cluster
+urlpatterns += patterns('ganeti.views.api',
+    url(r'^api/clusters/?$', 'clusters', name='api-cluster-list'),
+    url(r'^api/vms/?$', 'virtual_machines', name='api-vm-list'),
+    url(r'^api/jobs/?$', 'jobs', name='api-job-list'),
+    url(r'^api/changes/?$', 'changes', name='api-changes'),
+    url(r'^api/export/vms\.(?P<format>csv|ndjson)$', 'export', name='api-export'),
+    url(r'^%s/?$' % api_cluster, 'cluster', name='api-cluster-detail'),
+    url(r'^%s/nodes/?$' % api_cluster, 'nodes', name='api-node-list'),
+    url(r'^%s/node/(?P<node>[^/]+)/?$' % api_cluster, 'node', name='api-node-detail'),
+    url(r'^%s/job/(?P<job_id>\d+)/?$' % api_cluster, 'job', name='api-job-detail'),
+    url(r'^api/user/(?P<user_id>\d+)/history/?$', 'user_history', name='api-user-history'),
+    url(r'^%s/history/?$' % api_cluster, 'cluster_history', name='api-cluster-history'),
+    url(r'^%s%s/history/?$' % (api_cluster, instance), 'virtual_machine_history', name='api-vm-history'),
+    url(r'^%s%s/?$' % (api_cluster, instance), 'virtual_machine', name='api-vm-detail'),
+)
+
+# Metrics
+urlpatterns += patterns('ganeti.views.metrics',
+    url(r'^api/metrics/?$', 'metrics', name='api-metrics'),
+    url(r'^metrics/rapi/?$', 'rapi', name='metrics-rapi'),
+)
@@ -0,0 +1,145 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Cheap version identifiers for cached cluster objects.  Versions are computed
+from the raw mtime and cached columns using values queries.  This avoids
+instantiating CachedClusterObjects, which would deserialize info and possibly
+trigger a refresh from the ganeti cluster.
+"""
+
+from datetime import datetime, timedelta
+from hashlib import sha1
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count, Max
+
+from ganeti.models import PermissionVersion, SSHKey
+
+
+def to_datetime(timestamp):
+    """
+    Converts a raw PreciseDateTimeField value (Decimal, float, or string) to a
+    datetime.
+    """
+    if timestamp is None or timestamp == '':
+        return None
+    return datetime.fromtimestamp(float(timestamp))
+
+
+def latest(*values):
+    """
+    Returns the latest of several datetimes, ignoring None
+    """
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def make_etag(*parts):
+    """
+    Builds an ETag from a list of version parts
+    """
+    return sha1(':'.join([str(p) for p in parts])).hexdigest()
+
+
+def permission_version(user):
+    """
+    Returns (version, modified) for a User's permissions.
+    """
+    return PermissionVersion.objects.get_version(user)
+
+
+def bump_permission_version(user_id=None, group_id=None):
+    """
+    Increments the permission version after the permissions of a User or of
+    all members of a Group were modified.
+    """
+    if user_id:
+        PermissionVersion.objects.bump([user_id])
+    if group_id:
+        PermissionVersion.objects.bump(User.objects.filter(groups=group_id) \
+                                       .values_list('id', flat=True))
+
+
+def ssh_key_version():
+    """
+    Returns a version covering the Users that have SSHKeys.  Only these Users
+    appear in key sets, so changes to the permissions of other Users do not
+    change it.  Adding or deleting a key bumps the version of its User.
+
+    @return tuple of ((user id, version), ...) ordered by user id
+    """
+    ids = set(SSHKey.objects.values_list('user', flat=True))
+    versions = dict(PermissionVersion.objects.filter(user__in=ids) \
+                    .values_list('user', 'version'))
+    return tuple(sorted((id, versions.get(id, 0)) for id in ids))
+
+
+def is_fresh(cached, ignore_cache):
+    """
+    Returns whether load_info() would use the cached info as is.  Otherwise
+    the object refreshes itself when it is loaded, so a page rendered from it
+    must not be answered with 304.
+    """
+    cached = to_datetime(cached)
+    if ignore_cache or cached is None:
+        return False
+    return datetime.now() <= cached \
+        + timedelta(0, 0, 0, settings.LAZY_CACHE_REFRESH)
+
+
+def object_version(queryset, *columns):
+    """
+    Returns the version of a single CachedClusterObject matched by a queryset.
+    Editable columns are not covered by mtime or cached, columns displayed by
+    the page must be passed so that editing them changes the version.
+
+    @return tuple of (id, mtime, cached, ignore_cache, *columns) as raw values
+    or None if the object does not exist or its cache is stale.
+    """
+    values = queryset.values_list('id', 'mtime', 'cached', 'ignore_cache', \
+                                  *columns)[:1]
+    if not values or not is_fresh(values[0][2], values[0][3]):
+        return None
+    return values[0]
+
+
+def queryset_version(queryset):
+    """
+    Returns an aggregate version for a set of CachedClusterObjects.  The count
+    is included so that removing an object changes the version.
+
+    @return tuple of (count, max mtime, max cached) as raw values
+    """
+    data = queryset.aggregate(count=Count('id'), mtime=Max('mtime'), \
+                              cached=Max('cached'))
+    return data['count'], data['mtime'], data['cached']
+
+
+def queryset_digest(queryset, *columns):
+    """
+    Returns a digest of the given columns of every object in a queryset.  This
+    reads a row per object but, unlike queryset_version(), it detects changes
+    that do not move max mtime, such as a status update, and is not changed by
+    refreshes that only touch cached.
+    """
+    digest = sha1()
+    for row in queryset.order_by('id').values_list('id', *columns):
+        digest.update(repr(row))
+    return digest.hexdigest()
@@ -16,9 +16,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+from functools import wraps
+
 from django.http import HttpResponseNotFound, HttpResponseForbidden
 from django.template import RequestContext
 from django.template import Context, loader
+from django.views.decorators import http
 
 
 def render_403(request, message):
@@ -44,4 +47,25 @@ def render_404(request, message):
 def view_500(request):
     template = loader.get_template('500.html')
     context = RequestContext(request)
-    return HttpResponseNotFound(template.render(context))
\ No newline at end of file
+    return HttpResponseNotFound(template.render(context))
+
+
+def condition(etag_func=None, last_modified_func=None):
+    """
+    Wrapper around django's condition decorator that only attaches validators
+    to successful responses.  A client must never be able to revalidate an
+    error page (403, 404) and receive a 304 once it becomes accessible.
+    """
+    def decorator(func):
+        conditional = http.condition(etag_func, last_modified_func)(func)
+
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            response = conditional(request, *args, **kwargs)
+            if response.status_code not in (200, 304):
+                for header in ('ETag', 'Last-Modified'):
+                    if response.has_header(header):
+                        del response[header]
+            return response
+        return inner
+    return decorator
@@ -0,0 +1,538 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Read only JSON API for clusters, virtual machines, nodes and jobs.
+
+All database backed resources are read with values queries.  Objects are never
+instantiated, so requests never trigger a refresh of cached info from ganeti.
+Common query parameters:
+
+    fields    - comma separated list of fields to return.  "info" includes the
+                cached info from ganeti.
+    after     - cursor, return objects with an id greater than this value
+    limit     - maximum number of objects returned (default 100, max 500)
+    id        - bulk request, may be repeated to request several objects
+
+List and detail responses include an ETag and honor If-None-Match.  The ETag
+covers the served columns of every returned object, the selected fields and
+the permission version of the user.
+
+Requests are authenticated with a session, or by scripts with one of the
+API_KEYS passed as "Authorization: Bearer <key>".  A key grants superuser
+access to the scopes it is configured for, and nothing else.
+"""
+
+import cPickle
+from datetime import datetime
+from decimal import Decimal
+from functools import wraps
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+
+from ganeti.export import FORMATS, inventory
+from ganeti.models import Cluster, VirtualMachine, VirtualMachineChange, \
+    Job, get_rapi
+from ganeti.versioning import to_datetime, make_etag, permission_version
+from logs.models import LogItem
+from util.client import GanetiApiError
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# (name, column) pairs of the fields available for each resource.  Only
+# persistent columns are listed here, info is loaded from serialized_info.
+CLUSTER_FIELDS = (
+    ('id', 'id'),
+    ('slug', 'slug'),
+    ('hostname', 'hostname'),
+    ('port', 'port'),
+    ('description', 'description'),
+    ('virtual_cpus', 'virtual_cpus'),
+    ('disk', 'disk'),
+    ('ram', 'ram'),
+    ('mtime', 'mtime'),
+    ('cached', 'cached'),
+)
+
+VIRTUAL_MACHINE_FIELDS = (
+    ('id', 'id'),
+    ('hostname', 'hostname'),
+    ('cluster', 'cluster__slug'),
+    ('owner', 'owner__name'),
+    ('virtual_cpus', 'virtual_cpus'),
+    ('disk_size', 'disk_size'),
+    ('ram', 'ram'),
+    ('operating_system', 'operating_system'),
+    ('status', 'status'),
+    ('mtime', 'mtime'),
+    ('cached', 'cached'),
+)
+
+JOB_FIELDS = (
+    ('id', 'id'),
+    ('job_id', 'job_id'),
+    ('cluster', 'cluster__slug'),
+    ('object_type', 'content_type__model'),
+    ('object_id', 'object_id'),
+    ('status', 'status'),
+    ('finished', 'finished'),
+    ('mtime', 'mtime'),
+    ('cached', 'cached'),
+)
+
+LOG_FIELDS = (
+    ('id', 'id'),
+    ('timestamp', 'timestamp'),
+    ('user', 'user__username'),
+    ('action', 'action__name'),
+    ('object_type', 'object_type__model'),
+    ('object_id', 'object_id'),
+    ('object_repr', 'object_repr'),
+    ('log_message', 'log_message'),
+)
+
+# timestamp columns stored with PreciseDateTimeField
+TIMESTAMP_COLUMNS = ('mtime', 'cached')
+
+
+class BadRequest(Exception):
+    """ Raised when a request contains invalid parameters """
+    pass
+
+
+def json_response(data, status=200):
+    """
+    Creates a JSON response
+    """
+    response = HttpResponse(json.dumps(data), mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+def api_key_scopes(request):
+    """
+    Returns the scopes granted by the API key of a request
+    """
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not header.startswith('Bearer '):
+        return ()
+    keys = getattr(settings, 'API_KEYS', {})
+    return keys.get(header[len('Bearer '):].strip(), ())
+
+
+def api_view(scope):
+    """
+    Decorator for API views.  Requires either an authenticated session or an
+    API key granting the scope.  Requests authenticated with a key have the
+    same access as a superuser.  BadRequest raised by the view is returned as
+    a 400 response.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            user = request.user
+            if user.is_authenticated():
+                superuser = user.is_superuser
+            elif scope in api_key_scopes(request):
+                superuser = True
+            else:
+                return json_response({'error':'authentication required'}, 403)
+
+            try:
+                return func(request, superuser, *args, **kwargs)
+            except BadRequest, e:
+                return json_response({'error':str(e)}, 400)
+        return inner
+    return decorator
+
+
+def parse_fields(request, available):
+    """
+    Parses the fields parameter.
+
+    @return tuple of ((name, column) pairs, include_info)
+    """
+    fields = request.GET.get('fields')
+    if not fields:
+        return available, False
+
+    columns = dict(available)
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in names if f != 'info' and f not in columns]
+    if unknown:
+        raise BadRequest('Unknown fields: %s' % ', '.join(unknown))
+    selected = [(name, columns[name]) for name in names if name != 'info']
+    return selected, 'info' in names
+
+
+def parse_int(request, name, default=None):
+    value = request.GET.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest('%s must be an integer' % name)
+
+
+def parse_limit(request, default=DEFAULT_LIMIT):
+    """
+    Parses the limit parameter, capped at MAX_LIMIT
+    """
+    limit = parse_int(request, 'limit', default)
+    if limit < 1:
+        raise BadRequest('limit must be at least 1')
+    return min(limit, MAX_LIMIT)
+
+
+def encode(column, value):
+    """
+    Encodes a raw database value for JSON
+    """
+    if column in TIMESTAMP_COLUMNS:
+        value = to_datetime(value)
+    if isinstance(value, (datetime,)):
+        return value.isoformat()
+    if isinstance(value, (Decimal,)):
+        return float(value)
+    return value
+
+
+def serialize(queryset, fields, include_info):
+    """
+    Serializes a queryset into a list of dictionaries, without instantiating
+    the objects.
+    """
+    columns = [column for name, column in fields]
+    if include_info:
+        columns.append('serialized_info')
+
+    data = []
+    for row in queryset.values(*columns):
+        obj = {}
+        for name, column in fields:
+            obj[name] = encode(column, row[column])
+        if include_info:
+            info = row['serialized_info']
+            obj['info'] = cPickle.loads(str(info)) if info else None
+        data.append(obj)
+    return data
+
+
+def versioned_rows(request, queryset, fields, include_info):
+    """
+    Reads the served columns of a queryset and builds an ETag from them.  Edits
+    to any served column, added or removed rows, a different field selection
+    and permission changes all change the ETag.  Info is covered by cached,
+    which is set whenever info is written.
+
+    @return tuple of (ETag, rows of (id, columns...))
+    """
+    columns = [column for name, column in fields]
+    if include_info:
+        columns.extend(('mtime', 'cached'))
+    rows = list(queryset.values_list('id', *columns))
+    user = request.user
+    if user.is_authenticated():
+        perms = permission_version(user)[0]
+    else:
+        perms = 'key'
+    etag = make_etag('api', perms, [name for name, column in fields], \
+                     include_info, repr(rows))
+    return '"%s"' % etag, rows
+
+
+def not_modified(request, etag):
+    """
+    Returns True if the client already has the version identified by etag
+    """
+    return etag in request.META.get('HTTP_IF_NONE_MATCH', '')
+
+
+def list_response(request, queryset, available):
+    """
+    Common handling for list and bulk requests of database backed resources.
+    """
+    fields, include_info = parse_fields(request, available)
+
+    ids = request.GET.getlist('id')
+    if ids:
+        try:
+            queryset = queryset.filter(id__in=[int(i) for i in ids])
+        except ValueError:
+            raise BadRequest('id must be an integer')
+
+    limit = parse_limit(request)
+    after = parse_int(request, 'after')
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    queryset = queryset.order_by('id')[:limit]
+
+    etag, rows = versioned_rows(request, queryset, fields, include_info)
+    if not_modified(request, etag):
+        response = HttpResponse(status=304)
+    else:
+        results = serialize(queryset, fields, include_info)
+        cursor = rows[-1][0] if len(rows) == limit else None
+        response = json_response({'results':results, 'next':cursor})
+    response['ETag'] = etag
+    return response
+
+
+def detail_response(request, queryset, available):
+    """
+    Common handling for requests of a single database backed resource.
+    """
+    fields, include_info = parse_fields(request, available)
+    queryset = queryset.order_by('id')[:1]
+    etag, rows = versioned_rows(request, queryset, fields, include_info)
+    if not rows:
+        return json_response({'error':'not found'}, 404)
+    if not_modified(request, etag):
+        response = HttpResponse(status=304)
+    else:
+        response = json_response(serialize(queryset, fields, include_info)[0])
+    response['ETag'] = etag
+    return response
+
+
+def user_clusters(user, superuser, perms=('admin', 'create_vm')):
+    if superuser:
+        return Cluster.objects.all()
+    return user.get_objects_any_perms(Cluster, list(perms))
+
+
+def user_vms(user, superuser):
+    if superuser:
+        return VirtualMachine.objects.all()
+    return user.get_objects_any_perms(VirtualMachine, ['admin', 'power', \
+                                                       'remove'])
+
+
+@api_view('read')
+def clusters(request, superuser):
+    """
+    List clusters
+    """
+    query = user_clusters(request.user, superuser)
+    return list_response(request, query, CLUSTER_FIELDS)
+
+
+@api_view('read')
+def cluster(request, superuser, cluster_slug):
+    """
+    Details of a single cluster
+    """
+    query = user_clusters(request.user, superuser).filter(slug=cluster_slug)
+    return detail_response(request, query, CLUSTER_FIELDS)
+
+
+@api_view('read')
+def virtual_machines(request, superuser):
+    """
+    List virtual machines, optionally filtered by cluster (slug) or hostname.
+    """
+    query = user_vms(request.user, superuser)
+    if 'cluster' in request.GET:
+        query = query.filter(cluster__slug=request.GET['cluster'])
+    hostnames = request.GET.getlist('hostname')
+    if hostnames:
+        query = query.filter(hostname__in=hostnames)
+    return list_response(request, query, VIRTUAL_MACHINE_FIELDS)
+
+
+@api_view('read')
+def virtual_machine(request, superuser, cluster_slug, instance):
+    """
+    Details of a single virtual machine
+    """
+    query = user_vms(request.user, superuser) \
+        .filter(cluster__slug=cluster_slug, hostname=instance)
+    return detail_response(request, query, VIRTUAL_MACHINE_FIELDS)
+
+
+@api_view('export')
+def export(request, superuser, format):
+    """
+    Streams the inventory of virtual machines visible to the user as CSV or
+    NDJSON.  Optionally filtered by cluster (slug).
+    """
+    query = user_vms(request.user, superuser)
+    if 'cluster' in request.GET:
+        query = query.filter(cluster__slug=request.GET['cluster'])
+    lines, mimetype = FORMATS[format]
+    response = HttpResponse(lines(inventory(query)), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=vms.%s' % format
+    return response
+
+
+@api_view('changes')
+def changes(request, superuser):
+    """
+    Returns changes to virtual machines with a sequence number greater than
+    the since parameter.  Clients should pass the returned last value as since
+    in their next request.  Changes are returned once they are VM_CHANGES_LAG
+    seconds old, so that changes committed late are not skipped.  Changes
+    include deleted virtual machines so this is only available to superusers.
+    """
+    if not superuser:
+        return json_response({'error':'superuser required'}, 403)
+
+    since = parse_int(request, 'since', 0)
+    limit = parse_limit(request, MAX_LIMIT)
+    rows = VirtualMachineChange.objects.committed().filter(id__gt=since) \
+        .order_by('id') \
+        .values_list('id', 'virtual_machine_id', 'cluster_id', 'hostname', \
+                     'action', 'status', 'timestamp')[:limit]
+
+    results = []
+    for seq, id, cluster_id, hostname, action, status, timestamp in rows:
+        results.append({'seq':seq, 'id':id, 'cluster':cluster_id, \
+                        'hostname':hostname, 'action':action, \
+                        'status':status, 'timestamp':timestamp.isoformat()})
+    last = results[-1]['seq'] if results else since
+    return json_response({'changes':results, 'last':last, \
+                          'more':len(results) == limit})
+
+
+def history_response(request, **kwargs):
+    """
+    Common handling for audit log history requests.  Pages are requested with
+    the before parameter, set to the next value of the previous page.
+    """
+    limit = parse_limit(request)
+    before = parse_int(request, 'before')
+    query = LogItem.objects.history(before=before, **kwargs)[:limit]
+    results = serialize(query, LOG_FIELDS, False)
+    cursor = results[-1]['id'] if len(results) == limit else None
+    return json_response({'results':results, 'next':cursor})
+
+
+@api_view('history')
+def cluster_history(request, superuser, cluster_slug):
+    """
+    Audit log of a cluster, newest first
+    """
+    ids = user_clusters(request.user, superuser, ['admin']) \
+        .filter(slug=cluster_slug).values_list('id', flat=True)
+    if not ids:
+        return json_response({'error':'not found'}, 404)
+    return history_response(request, model=Cluster, object_id=ids[0])
+
+
+@api_view('history')
+def virtual_machine_history(request, superuser, cluster_slug, instance):
+    """
+    Audit log of a virtual machine, newest first
+    """
+    ids = user_vms(request.user, superuser) \
+        .filter(cluster__slug=cluster_slug, hostname=instance) \
+        .values_list('id', flat=True)
+    if not ids:
+        return json_response({'error':'not found'}, 404)
+    return history_response(request, model=VirtualMachine, object_id=ids[0])
+
+
+@api_view('history')
+def user_history(request, superuser, user_id):
+    """
+    Actions performed by a user, newest first.  Users may only view their own
+    history.
+    """
+    user_id = int(user_id)
+    if not (superuser or request.user.id == user_id):
+        return json_response({'error':'permission denied'}, 403)
+    if not User.objects.filter(id=user_id).exists():
+        return json_response({'error':'not found'}, 404)
+    return history_response(request, user=user_id)
+
+
+@api_view('read')
+def jobs(request, superuser):
+    """
+    List jobs of clusters the user is an admin of
+    """
+    clusters = user_clusters(request.user, superuser, ['admin'])
+    query = Job.objects.filter(cluster__in=clusters.values_list('id', flat=True))
+    if 'cluster' in request.GET:
+        query = query.filter(cluster__slug=request.GET['cluster'])
+    return list_response(request, query, JOB_FIELDS)
+
+
+@api_view('read')
+def job(request, superuser, cluster_slug, job_id):
+    """
+    Details of a single job
+    """
+    clusters = user_clusters(request.user, superuser, ['admin'])
+    query = Job.objects.filter(cluster__in=clusters.values_list('id', flat=True),
+                               cluster__slug=cluster_slug, job_id=job_id)
+    return detail_response(request, query, JOB_FIELDS)
+
+
+def cluster_rapi(request, superuser, cluster_slug):
+    """
+    Returns the rapi client for a cluster the user is an admin of, or None
+    """
+    values = user_clusters(request.user, superuser, ['admin']) \
+        .filter(slug=cluster_slug).values_list('id', 'hash')
+    if not values:
+        return None
+    id, hash = values[0]
+    return get_rapi(hash, id)
+
+
+@api_view('read')
+def nodes(request, superuser, cluster_slug):
+    """
+    List nodes of a cluster.  Nodes are not cached in the database, they are
+    always fetched from ganeti.  Bulk requests may pass node names as the
+    name parameter.
+    """
+    rapi = cluster_rapi(request, superuser, cluster_slug)
+    if rapi is None:
+        return json_response({'error':'not found'}, 404)
+    try:
+        nodes = rapi.GetNodes(bulk=True)
+    except GanetiApiError, e:
+        return json_response({'error':str(e)}, 502)
+    names = request.GET.getlist('name')
+    if names:
+        nodes = [n for n in nodes if n['name'] in names]
+    return json_response({'results':nodes, 'next':None})
+
+
+@api_view('read')
+def node(request, superuser, cluster_slug, node):
+    """
+    Details of a single node
+    """
+    rapi = cluster_rapi(request, superuser, cluster_slug)
+    if rapi is None:
+        return json_response({'error':'not found'}, 404)
+    try:
+        return json_response(rapi.GetNode(node))
+    except GanetiApiError, e:
+        if e.code == 404:
+            return json_response({'error':'not found'}, 404)
+        return json_response({'error':str(e)}, 502)
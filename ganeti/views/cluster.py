@@ -39,14 +39,56 @@ from logs.models import LogItem
 log_action = LogItem.objects.log_action
 
 from ganeti.models import *
-from ganeti.views import render_403, render_404
+from ganeti.versioning import make_etag, to_datetime, latest, \
+    permission_version, bump_permission_version, object_version, \
+    queryset_version
+from ganeti.views import render_403, render_404, condition
 from util.portforwarder import forward_port
 
 # Regex for a resolvable hostname
 FQDN_RE = r'^[\w]+(\.[\w]+)*$'
 
 
+# columns of a cluster displayed on its detail page
+CLUSTER_COLUMNS = ('hostname', 'port', 'description', 'username', 'ram', \
+                   'disk', 'virtual_cpus')
+
+
+def cluster_etag(request, cluster_slug):
+    """
+    ETag for pages rendered from the cluster's cached info.  There is no
+    Last-Modified, edits of the cluster do not change mtime or cached.
+    """
+    version = object_version(Cluster.objects.filter(slug=cluster_slug), \
+                             *CLUSTER_COLUMNS)
+    if version is None:
+        return None
+    perms, modified = permission_version(request.user)
+    return make_etag('cluster', request.user.id, perms, *version)
+
+
+def cluster_vms_etag(request, cluster_slug):
+    """
+    ETag for the list of virtual machines in a cluster
+    """
+    query = VirtualMachine.objects.filter(cluster__slug=cluster_slug)
+    perms, modified = permission_version(request.user)
+    return make_etag('cluster-vms', cluster_slug, request.user.id, perms, \
+                     *queryset_version(query))
+
+
+def cluster_vms_last_modified(request, cluster_slug):
+    """
+    Last-Modified for the list of virtual machines in a cluster
+    """
+    query = VirtualMachine.objects.filter(cluster__slug=cluster_slug)
+    count, mtime, cached = queryset_version(query)
+    perms, modified = permission_version(request.user)
+    return latest(to_datetime(mtime), to_datetime(cached), modified)
+
+
 @login_required
+@condition(cluster_etag)
 def detail(request, cluster_slug):
     """
     Display details of a cluster
@@ -69,20 +111,23 @@ def detail(request, cluster_slug):
 @login_required
 def nodes(request, cluster_slug):
     """
-    Display all nodes in a cluster
+    Display all nodes in a cluster.  Nodes are not cached in the database, so
+    there are no validators for conditional requests.
     """
     cluster = get_object_or_404(Cluster, slug=cluster_slug)
     user = request.user
     if not (user.is_superuser or user.has_perm('admin', cluster)):
         return render_403(request, "You do not have sufficient privileges")
     
-    return render_to_response("node/table.html", \
-                        {'cluster': cluster, 'nodes':cluster.nodes(True)}, \
+    # nodes are fetched by the template, only if the cached node table is
+    # missing or expired
+    return render_to_response("node/table.html", {'cluster': cluster}, \
         context_instance=RequestContext(request),
     )
 
 
 @login_required
+@condition(cluster_vms_etag, cluster_vms_last_modified)
 def virtual_machines(request, cluster_slug):
     """
     Display all virtual machines in a cluster.  Filtered by access the user
@@ -193,6 +238,7 @@ def permissions(request, cluster_slug, user_id=None, group_id=None):
     
     # log changes if any.
     if modified:
+        bump_permission_version(user_id, group_id)
         # log information about creating the machine
         log_action(user, cluster, "modified permissions")
     
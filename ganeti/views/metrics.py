@@ -0,0 +1,214 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Metrics in the Prometheus text exposition format, and a page summarizing RAPI
+requests.  Cache updater values are computed from the CacheRefresh history,
+so they can be served by any web node regardless of where the updater runs.
+RAPI request histograms are those of the process serving the request.
+"""
+
+from datetime import datetime
+
+from django.contrib.auth.decorators import login_required
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+
+from ganeti.instrumentation import RAPI_STATS
+from ganeti.models import Cluster, CacheRefresh
+from ganeti.views import render_403
+from ganeti.views.api import api_view, json_response
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# (name, type, help, column) of the metrics taken from the last refresh
+LAST_REFRESH = (
+    ('ganeti_cache_refresh_fetch_seconds', 'gauge',
+     'Seconds waiting for ganeti in the last refresh', 'fetch'),
+    ('ganeti_cache_refresh_decode_seconds', 'gauge',
+     'Seconds decoding the response in the last refresh', 'decode'),
+    ('ganeti_cache_refresh_db_seconds', 'gauge',
+     'Seconds writing to the database in the last refresh', 'db'),
+    ('ganeti_cache_refresh_bytes', 'gauge',
+     'Size of the response in the last refresh', 'bytes'),
+    ('ganeti_cache_refresh_updated', 'gauge',
+     'Virtual machines updated in the last refresh', 'updated'),
+    ('ganeti_cache_refresh_inserted', 'gauge',
+     'Virtual machines inserted in the last refresh', 'inserted'),
+    ('ganeti_cache_refresh_virtual_machines', 'gauge',
+     'Virtual machines in ganeti in the last refresh', 'total'),
+)
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Exposition(object):
+    """
+    Builds a response in the Prometheus text format
+    """
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, type, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, type))
+
+    def sample(self, name, labels, value):
+        """
+        @param labels - list of (name, value) tuples
+        """
+        labels = ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+        self.lines.append('%s{%s} %s' % (name, labels, float(value)))
+
+    def metric(self, name, type, help, samples):
+        """
+        @param samples - list of (cluster slug, value) tuples
+        """
+        self.header(name, type, help)
+        for slug, value in samples:
+            self.sample(name, [('cluster', slug)], value)
+
+    def histogram(self, name, help, samples):
+        """
+        @param samples - list of (labels, Histogram) tuples
+        """
+        self.header(name, 'histogram', help)
+        for labels, histogram in samples:
+            for bound, count in histogram.cumulative():
+                self.sample(name + '_bucket', labels + [('le', bound)], count)
+            self.sample(name + '_bucket', labels + [('le', '+Inf')], \
+                        histogram.count)
+            self.sample(name + '_sum', labels, histogram.sum)
+            self.sample(name + '_count', labels, histogram.count)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+@api_view('metrics')
+def metrics(request, superuser):
+    """
+    Cache updater metrics for all clusters and RAPI request metrics of this
+    process.  Requires superuser access or an API key with the metrics scope.
+    """
+    if not superuser:
+        return json_response({'error':'superuser access required'}, 403)
+
+    slugs = dict(Cluster.objects.values_list('id', 'slug'))
+    history = CacheRefresh.objects.values('cluster')
+
+    last = history.annotate(last=Max('id')).values_list('last', flat=True)
+    refreshes = CacheRefresh.objects.filter(id__in=list(last)) \
+        .values('cluster', 'started', 'error', \
+                *[column for name, type, help, column in LAST_REFRESH])
+    refreshes = [r for r in refreshes if r['cluster'] in slugs]
+
+    now = datetime.now()
+    succeeded = history.filter(error=None).annotate(started=Max('started'))
+    counts = history.annotate(count=Count('id'))
+    errors = history.filter(error__isnull=False).annotate(count=Count('id'))
+
+    def seconds(delta):
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    exposition = Exposition()
+    exposition.metric('ganeti_cache_refresh_lag_seconds', 'gauge',
+        'Seconds since the last successful refresh',
+        [(slugs[r['cluster']], seconds(now - r['started'])) \
+         for r in succeeded if r['cluster'] in slugs])
+    exposition.metric('ganeti_cache_refresh_failing', 'gauge',
+        'Whether the last refresh failed',
+        [(slugs[r['cluster']], r['error'] is not None) for r in refreshes])
+    exposition.metric('ganeti_cache_refreshes', 'gauge',
+        'Refreshes in the history window',
+        [(slugs[r['cluster']], r['count']) for r in counts \
+         if r['cluster'] in slugs])
+    exposition.metric('ganeti_cache_refresh_errors', 'gauge',
+        'Failed refreshes in the history window',
+        [(slugs[r['cluster']], r['count']) for r in errors \
+         if r['cluster'] in slugs])
+    for name, type, help, column in LAST_REFRESH:
+        exposition.metric(name, type, help,
+            [(slugs[r['cluster']], r[column]) for r in refreshes])
+
+    endpoints = RAPI_STATS.summary()
+    exposition.histogram('ganeti_rapi_request_seconds',
+        'Duration of RAPI requests made by this process',
+        [([('method', e.method), ('path', e.template)], e.timings['total']) \
+         for e in endpoints])
+    exposition.header('ganeti_rapi_request_errors_total', 'counter',
+        'Failed RAPI requests made by this process')
+    for e in endpoints:
+        exposition.sample('ganeti_rapi_request_errors_total', \
+                          [('method', e.method), ('path', e.template)], \
+                          e.errors)
+
+    return HttpResponse(exposition.render(), mimetype=CONTENT_TYPE)
+
+
+def milliseconds(value):
+    return value * 1000 if value is not None else None
+
+
+@login_required
+def rapi(request):
+    """
+    Summary of RAPI requests made by this process, per endpoint
+    """
+    if not request.user.is_superuser:
+        return render_403(request, 'Only a superuser may view RAPI statistics.')
+
+    if request.method == 'POST':
+        RAPI_STATS.reset()
+        return HttpResponseRedirect(request.path)
+
+    endpoints = []
+    for endpoint in RAPI_STATS.summary():
+        timings = endpoint.timings
+        total = timings['total']
+        endpoints.append(dict(
+            method = endpoint.method,
+            template = endpoint.template,
+            count = endpoint.count,
+            errors = endpoint.errors,
+            sum = total.sum,
+            mean = milliseconds(total.mean),
+            p50 = milliseconds(total.percentile(50)),
+            p95 = milliseconds(total.percentile(95)),
+            p99 = milliseconds(total.percentile(99)),
+            connect = milliseconds(timings['connect'].mean),
+            tls = milliseconds(timings['tls'].mean),
+            first_byte = milliseconds(timings['first_byte'].mean),
+            decode = milliseconds(timings['decode'].mean),
+            bytes_in = endpoint.bytes_in,
+            bytes_wire = endpoint.bytes_wire,
+            compression = endpoint.compression,
+            bytes_out = endpoint.bytes_out,
+        ))
+
+    return render_to_response('metrics/rapi.html', {
+            'endpoints':endpoints
+        },
+        context_instance=RequestContext(request),
+    )
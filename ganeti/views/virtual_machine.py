@@ -26,23 +26,27 @@ from time import sleep
 from django import forms
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect, \
-    HttpResponseNotAllowed, HttpResponseForbidden
+    HttpResponseNotAllowed, HttpResponseForbidden, HttpResponseNotModified, \
+    Http404
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 
 from object_permissions.views.permissions import view_users, view_permissions
-from object_permissions import get_users_any
 
 from logs.models import LogItem
 log_action = LogItem.objects.log_action
 
 from util.client import GanetiApiError
 from ganeti.models import Cluster, ClusterUser, Organization, VirtualMachine, \
-        Job, SSHKey
-from ganeti.views import render_403
+        Job, SSHKey, PortPoolExhausted, PortForwardingError
+from ganeti.versioning import make_etag, to_datetime, latest, \
+    permission_version, bump_permission_version, object_version, \
+    queryset_version, ssh_key_version
+from ganeti.views import render_403, condition
 
 empty_field = (u'', u'---------')
 
@@ -97,7 +101,10 @@ def vnc(request, cluster_slug, instance):
 
     if settings.VNC_PROXY:
         host = 'localhost'
-        port, password = instance.setup_vnc_forwarding()
+        try:
+            port, password = instance.setup_vnc_forwarding()
+        except (PortPoolExhausted, PortForwardingError, socket.error):
+            return HttpResponse('VNC proxy is not available', status=503)
 
     else:
         host = instance.info['pnode']
@@ -183,6 +190,71 @@ def reboot(request, cluster_slug, instance):
     return HttpResponseNotAllowed(['POST'])
 
 
+def ssh_key_sets(vms):
+    """
+    Returns the SSH keys of the admins of each VirtualMachine in a queryset.
+    Key sets are precomputed per VirtualMachine and cached under the
+    permission versions of the Users that have SSHKeys, so changing their
+    permissions or keys invalidates them.  Other Users do not affect them.
+
+    @return tuple of (ETag, {hostname: [(key, username), ...]})
+    """
+    generation = make_etag(*ssh_key_version())
+    vms = list(vms.order_by('id').values_list('id', 'hostname'))
+    etag = make_etag('keys', generation, *[id for id, hostname in vms])
+
+    prefix = 'webmgr.sshkeys.%s.' % generation
+    cached = cache.get_many(['%s%d' % (prefix, id) for id, hostname in vms])
+    missing = [id for id, hostname in vms if '%s%d' % (prefix, id) not in cached]
+    if missing:
+        computed = compute_ssh_key_sets(missing)
+        timeout = getattr(settings, 'SSH_KEYS_CACHE_TIMEOUT', 3600)
+        cache.set_many(dict(('%s%d' % (prefix, id), keys) \
+                            for id, keys in computed.items()), timeout)
+        cached.update(('%s%d' % (prefix, id), keys) \
+                      for id, keys in computed.items())
+
+    return etag, dict((hostname, cached['%s%d' % (prefix, id)]) \
+                      for id, hostname in vms)
+
+
+def compute_ssh_key_sets(vm_ids):
+    """
+    Computes the key sets for a list of VirtualMachine ids.  Permissions are
+    resolved once per User that has SSHKeys rather than once per
+    VirtualMachine.
+
+    @return dict of {id: [(key, username), ...]}
+    """
+    keys = defaultdict(list)
+    for user_id, key, username in SSHKey.objects \
+            .order_by('user__username', 'id') \
+            .values_list('user', 'key', 'user__username'):
+        keys[user_id].append((key, username))
+
+    sets = dict((id, []) for id in vm_ids)
+    for user in User.objects.filter(id__in=keys.keys()).order_by('username'):
+        admin = user.get_objects_any_perms(VirtualMachine, ['admin']) \
+            .filter(id__in=vm_ids).values_list('id', flat=True)
+        for id in admin:
+            sets[id].extend(keys[user.id])
+    return sets
+
+
+def keys_response(request, etag, data):
+    """
+    Returns a JSON response for SSH keys, or 304 if the client already has
+    the current version.
+    """
+    etag = '"%s"' % etag
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(json.dumps(data), mimetype="application/json")
+    response['ETag'] = etag
+    return response
+
+
 def ssh_keys(request, cluster_slug, instance, api_key):
     """
     Show all ssh keys which belong to users, who are specified vm's admin
@@ -191,24 +263,67 @@ def ssh_keys(request, cluster_slug, instance, api_key):
     if settings.WEB_MGR_API_KEY != api_key:
         return HttpResponseForbidden("You're not allowed to view keys.")
 
-    vm = get_object_or_404(VirtualMachine, hostname=instance, \
-                           cluster__slug=cluster_slug)
+    vms = VirtualMachine.objects.filter(hostname=instance, \
+                                        cluster__slug=cluster_slug)
+    etag, keys = ssh_key_sets(vms)
+    if instance not in keys:
+        raise Http404()
+    return keys_response(request, etag, keys[instance])
+
+
+def cluster_ssh_keys(request, cluster_slug, api_key):
+    """
+    Show the ssh keys for all of a cluster's virtual machines, or for the
+    virtual machines given as hostname parameters, keyed by hostname.
+    """
+    import settings
+    if settings.WEB_MGR_API_KEY != api_key:
+        return HttpResponseForbidden("You're not allowed to view keys.")
+
+    cluster = get_object_or_404(Cluster.objects.values('id'), slug=cluster_slug)
+    vms = VirtualMachine.objects.filter(cluster=cluster['id'])
+    hostnames = request.GET.getlist('hostname')
+    if hostnames:
+        vms = vms.filter(hostname__in=hostnames)
+    etag, keys = ssh_key_sets(vms)
+    return keys_response(request, etag, keys)
+
+
+def user_vms(user):
+    """
+    Returns the VirtualMachines a user may see in the list of VMs
+    """
+    if user.is_superuser:
+        return VirtualMachine.objects.all()
+    return user.get_objects_any_perms(VirtualMachine, ['admin', 'power','remove'])
+
+
+def list_etag(request):
+    """
+    ETag for the list of virtual machines visible to a user
+    """
+    perms, modified = permission_version(request.user)
+    return make_etag('vms', request.user.id, perms, \
+                     *queryset_version(user_vms(request.user)))
 
-    users = get_users_any(vm, ["admin",]).values_list("id",flat=True)
-    keys = SSHKey.objects.filter(user__in=users).values_list('key','user__username').order_by('user__username')
 
-    keys_list = list(keys)
-    return HttpResponse(json.dumps(keys_list), mimetype="application/json")
+def list_last_modified(request):
+    """
+    Last-Modified for the list of virtual machines visible to a user
+    """
+    count, mtime, cached = queryset_version(user_vms(request.user))
+    perms, modified = permission_version(request.user)
+    return latest(to_datetime(mtime), to_datetime(cached), modified)
 
 
 @login_required
+@condition(list_etag, list_last_modified)
 def list_(request):
     user = request.user
+    vms = user_vms(user)
     if user.is_superuser:
-        vms = VirtualMachine.objects.all()
         can_create = True
     else:
-        vms = user.get_objects_any_perms(VirtualMachine, ['admin', 'power','remove'])
         can_create = user.has_any_perms(Cluster, ['create_vm'])
     
     return render_to_response('virtual_machine/list.html', {
@@ -219,7 +334,27 @@ def list_(request):
     )
 
 
+# columns of a virtual machine displayed on its detail page
+VM_COLUMNS = ('hostname', 'owner', 'last_job', 'virtual_cpus', 'disk_size', \
+              'ram', 'operating_system', 'status')
+
+
+def detail_etag(request, cluster_slug, instance):
+    """
+    ETag for pages rendered from a virtual machine's cached info.  There is no
+    Last-Modified, edits and jobs do not change mtime or cached.
+    """
+    query = VirtualMachine.objects.filter(cluster__slug=cluster_slug, \
+                                          hostname=instance)
+    version = object_version(query, *VM_COLUMNS)
+    if version is None:
+        return None
+    perms, modified = permission_version(request.user)
+    return make_etag('vm', request.user.id, perms, *version)
+
+
 @login_required
+@condition(detail_etag)
 def detail(request, cluster_slug, instance):
     cluster = get_object_or_404(Cluster, slug=cluster_slug)
     vm = get_object_or_404(VirtualMachine, hostname=instance, cluster=cluster)
@@ -311,6 +446,7 @@ def permissions(request, cluster_slug, instance, user_id=None, group_id=None):
     
     # log changes if any.
     if modified:
+        bump_permission_version(user_id, group_id)
         # log information about creating the machine
         log_action(user, vm, "modified permissions")
     
@@ -418,7 +554,12 @@ def create(request, cluster_slug=None):
                 log_action(user, vm, "created")
 
                 # grant admin permissions to the owner
-                data['grantee'].grant('admin', vm)
+                grantee = data['grantee']
+                grantee.grant('admin', vm)
+                if isinstance(grantee, (Group,)):
+                    bump_permission_version(group_id=grantee.id)
+                else:
+                    bump_permission_version(user_id=grantee.id)
 
                 return HttpResponseRedirect( \
                 reverse('instance-detail', args=[cluster.slug, vm.hostname]))
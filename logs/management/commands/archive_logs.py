@@ -0,0 +1,118 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from datetime import datetime, timedelta
+import gzip
+import json
+from optparse import make_option
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from logs.models import LogItem
+
+
+class Command(BaseCommand):
+    help = 'Archives LogItems older than the retention period to gzipped ' \
+           'NDJSON and deletes them.'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int',
+            default=getattr(settings, 'LOG_RETENTION_DAYS', 365),
+            help='Archive LogItems older than this many days'),
+        make_option('--output-dir', dest='output_dir',
+            default=getattr(settings, 'LOG_ARCHIVE_DIR', '.'),
+            help='Directory archives are written to'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=getattr(settings, 'LOG_ARCHIVE_BATCH_SIZE', 1000),
+            help='LogItems archived and deleted per transaction'),
+        make_option('--no-archive', dest='archive', action='store_false',
+            default=True, help='Delete LogItems without archiving them'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('days and batch size must be positive')
+        cutoff = datetime.now() - timedelta(days=options['days'])
+
+        out = None
+        if options['archive']:
+            filename = 'logitems-%s.ndjson.gz' % cutoff.strftime('%Y%m%d%H%M%S')
+            path = os.path.join(options['output_dir'], filename)
+            out = gzip.open(path, 'ab')
+
+        count = 0
+        try:
+            while True:
+                archived = archive_batch(cutoff, options['batch_size'], out)
+                count += archived
+                if archived < options['batch_size']:
+                    break
+        finally:
+            if out is not None:
+                out.close()
+
+        if int(options['verbosity']):
+            print 'Archived %d LogItems older than %s' % (count, cutoff)
+
+
+def record(item):
+    """
+    Returns the archived form of a LogItem.  text is the LogItem's single line
+    representation.
+    """
+    return {
+        'id': item.id,
+        'timestamp': item.timestamp.isoformat(),
+        'user': item.user.username,
+        'action': item.action.name,
+        'object_type': item.object_type.model,
+        'object_id': item.object_id,
+        'object_repr': item.object_repr,
+        'log_message': item.log_message,
+        # repr() would encode to ascii and fail on non-ascii messages
+        'text': item.__repr__(),
+    }
+
+
+@transaction.commit_on_success()
+def archive_batch(cutoff, batch_size, out=None):
+    """
+    Archives and deletes up to batch_size of the oldest LogItems older than
+    cutoff.  Each batch is its own short transaction so that deletes never
+    hold locks on the table for long.  Rows are written to the archive before
+    they are deleted.
+
+    @return number of LogItems archived
+    """
+    items = list(LogItem.objects.filter(timestamp__lt=cutoff) \
+                 .select_related('user', 'action', 'object_type') \
+                 .order_by('id')[:batch_size])
+    if not items:
+        return 0
+
+    if out is not None:
+        for item in items:
+            out.write(json.dumps(record(item)))
+            out.write('\n')
+        out.flush()
+
+    LogItem.objects.filter(id__in=[item.id for item in items]).delete()
+    return len(items)
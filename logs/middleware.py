@@ -0,0 +1,46 @@
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from logs.models import LogItem
+
+
+class LogBufferMiddleware(object):
+    """
+    Buffers every LogItem logged during a request and writes them with a bulk
+    insert when the request ends, so that views logging once per object do
+    not insert row by row, and buffered entries are never delayed past the
+    request that created them.
+    """
+    def process_request(self, request):
+        LogItem.objects.start_buffering()
+        request._log_buffering = True
+
+    def process_response(self, request, response):
+        self.stop_buffering(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self.stop_buffering(request)
+
+    def stop_buffering(self, request):
+        if getattr(request, '_log_buffering', False):
+            request._log_buffering = False
+            LogItem.objects.stop_buffering()
+        else:
+            LogItem.objects.flush()
@@ -17,7 +17,16 @@
 # USA.
 
 
-from django.db import models
+import atexit
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import models, connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 
 #from ganeti.models import Profile
 from django.contrib.auth.models import User
@@ -35,22 +44,194 @@ class LogAction(models.Model):
     name = models.CharField(max_length=128, unique=True) #add, delete
 
 
+class LogBuffer(object):
+    """
+    Per process buffer of LogItem rows.  Rows are written with a single bulk
+    insert per database when the buffer holds `size` rows, when `interval`
+    seconds passed since the first buffered row, or when flush() is called.
+    A size of 0 disables both thresholds, rows are then only written by
+    flush().  There is no timer, the interval is only checked when a row is
+    added; rows are otherwise written by flush() at the end of each request
+    and when the process exits.
+    """
+    columns = ('action_id', 'timestamp', 'user_id', 'object_type_id',
+               'object_id', 'object_repr', 'log_message')
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.rows = {}
+        self.started = None
+        self.lock = threading.RLock()
+
+    def add(self, db, row):
+        self.lock.acquire()
+        try:
+            if self.started is None:
+                self.started = time.time()
+            self.rows.setdefault(db, []).append(row)
+            if self.size and (sum(map(len, self.rows.values())) >= self.size \
+                or time.time() - self.started >= self.interval):
+                    self.flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Writes all buffered rows.  If an insert fails the rows that were not
+        written are kept in the buffer and the error is raised.
+        """
+        self.lock.acquire()
+        try:
+            rows, started = self.rows, self.started
+            self.rows, self.started = {}, None
+            try:
+                for db in rows.keys():
+                    self.insert(db, rows[db])
+                    del rows[db]
+            except:
+                for db, db_rows in rows.items():
+                    self.rows[db] = db_rows + self.rows.get(db, [])
+                self.started = started
+                raise
+        finally:
+            self.lock.release()
+
+    def insert(self, db, rows):
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(LogItem._meta.db_table),
+            ', '.join([qn(c) for c in self.columns]),
+            ', '.join(['%s'] * len(self.columns)))
+        to_db = connection.ops.value_to_db_datetime
+        rows = [row[:1] + (to_db(row[1]),) + row[2:] for row in rows]
+        connection.cursor().executemany(sql, rows)
+        transaction.commit_unless_managed(using=db)
+
+
 class LogItemManager(models.Manager):
 
     # Cache to avoid re-looking up LogAction objects all over the place
     _cache = {}
 
-    # XXX: it doesn't refresh when any LogAction is changed or removed
+    # Cache of ContentType ids by model
+    _content_types = {}
+
+    # LogItems buffered for bulk inserts, see log_action()
+    _buffer = LogBuffer(getattr(settings, 'LOG_BUFFER_SIZE', 0),
+                        getattr(settings, 'LOG_BUFFER_INTERVAL', 5))
+    _local = threading.local()
+
     def clear_cache(self):
         """
         Clears out all LogAction cached objects
         """
         self.__class__._cache.clear()
 
+    def evict(self, action):
+        """
+        Removes a LogAction from the cache after it was changed or removed
+        """
+        for actions in self._cache.values():
+            for key, cached in actions.items():
+                if cached.pk == action.pk:
+                    del actions[key]
+
+    def get_content_type_id(self, model):
+        """
+        Returns the ContentType id of a model or instance, cached per process
+        """
+        opts = model._meta
+        key = (self.db, opts.app_label, opts.object_name)
+        try:
+            return self._content_types[key]
+        except KeyError:
+            id = ContentType.objects.get_for_model(model).id
+            self._content_types[key] = id
+            return id
+
+    @contextmanager
+    def buffered(self):
+        """
+        Buffers every log_action() in the block and flushes them with bulk
+        inserts when the block exits:
+
+            with LogItem.objects.buffered():
+                for vm in vms:
+                    LogItem.objects.log_action(user, vm, 'modified')
+        """
+        self.start_buffering()
+        try:
+            yield
+        finally:
+            self.stop_buffering()
+
+    def start_buffering(self):
+        """
+        Starts buffering log_action() in this thread, like entering a
+        buffered() block.  Every call must be paired with stop_buffering().
+        """
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def stop_buffering(self):
+        """
+        Stops buffering started by start_buffering().  Buffered LogItems are
+        written when the outermost block ends.
+        """
+        self._local.depth -= 1
+        if not self._local.depth:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered LogItems
+        """
+        self._buffer.flush()
+
+    def history(self, model=None, object_id=None, user=None, before=None):
+        """
+        Returns LogItems for an object and/or a User, newest first.  Results
+        are ordered by (timestamp, id) which matches the composite indexes in
+        sql/logitem.sql.
+
+        Pages are fetched with keyset pagination: pass the id of the last
+        LogItem of a page as before to get the next page.  Unlike offsets this
+        does not scan the skipped rows.
+
+        @param model        model instance, or model class with object_id
+        @param object_id    id of the object, defaults to model.pk
+        @param user         User or id
+        @param before       id of a LogItem
+        """
+        query = self.all()
+        if model is not None:
+            if object_id is None:
+                object_id = model.pk
+            query = query.filter(object_type=self.get_content_type_id(model),
+                                 object_id=object_id)
+        if user is not None:
+            query = query.filter(user=user)
+        if before is not None:
+            timestamp = self.filter(pk=before) \
+                .values_list('timestamp', flat=True)
+            if timestamp:
+                timestamp = timestamp[0]
+                query = query.filter(Q(timestamp__lt=timestamp) \
+                                     | Q(timestamp=timestamp, id__lt=before))
+            else:
+                query = query.filter(id__lt=before)
+        return query.order_by('-timestamp', '-id')
+
     def log_action(self, user, affected_object, key, log_message=None):
         """
         Creates new log entry
 
+        LogItems are written immediately unless buffering is enabled with the
+        LOG_BUFFER_SIZE setting or inside a buffered() block, which includes
+        every request (see LogBufferMiddleware).  Buffered
+        LogItems are written in bulk and None is returned instead of the id.
+
         @param user             Profile
         @param affected_object  any model
         @param key              string (LogAction.name)
@@ -72,15 +253,23 @@ class LogItemManager(models.Manager):
             # load into cache
             self._cache.setdefault(self.db, {})[key] = action
 
+        object_type_id = self.get_content_type_id(affected_object)
+        object_repr = force_unicode(affected_object)[:128]
+
+        if self._buffer.size or getattr(self._local, 'depth', 0):
+            self._buffer.add(self.db, (action.pk, datetime.now(), user.pk,
+                object_type_id, affected_object.pk, object_repr, log_message))
+            return None
+
         # now action is LogAction object
         m = self.model(
             id = None,
             action = action,
             timestamp = None,
             user = user,
-            object_type = ContentType.objects.get_for_model(affected_object),
+            object_type_id = object_type_id,
             object_id = affected_object.pk,
-            object_repr = force_unicode(affected_object),
+            object_repr = object_repr,
             log_message = log_message,
         )
         m.save()
@@ -134,3 +323,16 @@ class LogItem(models.Model):
             msg = msg,
         )
         return format % fields
+
+
+def evict_log_action(sender, instance, **kwargs):
+    """
+    Keeps the LogAction cache consistent when LogActions change
+    """
+    LogItem.objects.evict(instance)
+
+post_save.connect(evict_log_action, sender=LogAction)
+post_delete.connect(evict_log_action, sender=LogAction)
+
+# buffered LogItems must not be lost when the process exits
+atexit.register(LogItemManager._buffer.flush)
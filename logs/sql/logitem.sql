@@ -0,0 +1,4 @@
+-- Indexes for audit log history queries, see LogItemManager.history().  Both
+-- end in (timestamp, id) so that keyset pagination is served from the index.
+CREATE INDEX logs_logitem_object_history ON logs_logitem (object_type_id, object_id, timestamp, id);
+CREATE INDEX logs_logitem_user_history ON logs_logitem (user_id, timestamp, id);
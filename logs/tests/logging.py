@@ -17,15 +17,27 @@
 # USA.
 
 
+from __future__ import with_statement
+
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import force_unicode
 
 from django.conf import settings
 from django import db
+from django.http import HttpRequest, HttpResponse
 
 from ganeti.models import Profile
+from logs.middleware import LogBufferMiddleware
 from logs.models import LogItem, LogAction
 
 
@@ -127,3 +139,151 @@ class LoggingTest(TestCase):
         LogItem.objects.clear_cache()
         state = dict()
         self.assertEqual(state, cache)
+
+    def test_buffered(self):
+        """
+        Test buffering LogItems for bulk inserts
+
+        Verifies:
+            * LogItems are not written inside a buffered block
+            * LogItems are written when the block exits
+            * nested blocks only flush when the outer block exits
+        """
+        with LogItem.objects.buffered():
+            pk = LogItem.objects.log_action(user, user, "created")
+            self.assertEqual(None, pk)
+            with LogItem.objects.buffered():
+                LogItem.objects.log_action(user, user, "deleted",
+                                           log_message="buffered")
+            self.assertEqual(0, LogItem.objects.count())
+        self.assertEqual(2, LogItem.objects.count())
+
+        item = LogItem.objects.get(action__name="deleted")
+        self.assertEqual("buffered", item.log_message)
+        self.assertEqual(user, item.affected_object)
+        self.assertEqual(
+            "[%s] user testing deleted user \"testing\": buffered" % item.timestamp,
+            repr(item))
+
+        # synchronous again after the block
+        pk = LogItem.objects.log_action(user, user, "created")
+        self.assertNotEqual(None, pk)
+
+    def test_flush_error(self):
+        """
+        Test that buffered LogItems are kept when writing them fails
+        """
+        buffer = LogItem.objects._buffer
+        def fail(using, rows):
+            raise db.DatabaseError('failed')
+        buffer.insert = fail
+        try:
+            with LogItem.objects.buffered():
+                LogItem.objects.log_action(user, user, "created")
+                LogItem.objects.log_action(user, user, "deleted")
+            self.fail('DatabaseError was not raised')
+        except db.DatabaseError:
+            pass
+        finally:
+            del buffer.insert
+        self.assertEqual(0, LogItem.objects.count())
+        self.assertEqual(2, len(buffer.rows[LogItem.objects.db]))
+
+        LogItem.objects.flush()
+        self.assertEqual({}, buffer.rows)
+        self.assertEqual(2, LogItem.objects.count())
+
+    def test_middleware(self):
+        """
+        Test buffering LogItems for the duration of a request
+
+        Verifies:
+            * LogItems are not written during the request
+            * LogItems are written when the response is returned
+            * LogItems are written when the view raised an exception
+        """
+        middleware = LogBufferMiddleware()
+        request, response = HttpRequest(), HttpResponse()
+        middleware.process_request(request)
+        self.assertEqual(None, LogItem.objects.log_action(user, user, "created"))
+        LogItem.objects.log_action(user, user, "deleted")
+        self.assertEqual(0, LogItem.objects.count())
+        self.assertEqual(response, middleware.process_response(request, response))
+        self.assertEqual(2, LogItem.objects.count())
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        LogItem.objects.log_action(user, user, "created")
+        middleware.process_exception(request, Exception())
+        self.assertEqual(3, LogItem.objects.count())
+        middleware.process_response(request, response)
+        self.assertNotEqual(None, LogItem.objects.log_action(user, user, "created"))
+
+    def test_cache_invalidation(self):
+        """
+        Test that changed or removed LogActions are evicted from the cache
+        """
+        pk = LogItem.objects.log_action(user, user, "created")
+        action = LogItem.objects.get(pk=pk).action
+        action.name = "renamed"
+        action.save()
+        self.assertFalse("created" in LogItem.objects._cache[LogItem.objects.db])
+
+        pk = LogItem.objects.log_action(user, user, "created")
+        self.assertEqual("created", LogItem.objects.get(pk=pk).action.name)
+
+    def test_archive(self):
+        """
+        Test archiving old LogItems
+
+        Verifies:
+            * LogItems older than the retention period are archived in batches
+            * archived LogItems are deleted, newer LogItems are kept
+            * the archive contains the LogItem representation
+        """
+        for i in range(5):
+            LogItem.objects.log_action(user, user, "created")
+        pk = LogItem.objects.log_action(user, user, "deleted")
+        old = LogItem.objects.exclude(pk=pk)
+        old.update(timestamp=datetime.now()-timedelta(days=10))
+        texts = sorted([repr(item) for item in old])
+
+        path = tempfile.mkdtemp()
+        try:
+            call_command('archive_logs', days=5, output_dir=path, batch_size=2,
+                         verbosity=0)
+            self.assertEqual([pk], [i.pk for i in LogItem.objects.all()])
+
+            files = os.listdir(path)
+            self.assertEqual(1, len(files))
+            lines = gzip.open(os.path.join(path, files[0])).readlines()
+            records = [json.loads(line) for line in lines]
+            self.assertEqual(5, len(records))
+            self.assertEqual(texts, sorted([r['text'] for r in records]))
+            self.assertEqual("testing", records[0]['user'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_archive_unicode(self):
+        """
+        Test archiving LogItems with non-ascii messages
+        """
+        message = u"zmieniono has\u0142o \u017c\u00f3\u0142w"
+        LogItem.objects.log_action(user, user, "modified", log_message=message)
+        LogItem.objects.update(timestamp=datetime.now()-timedelta(days=10))
+        text = LogItem.objects.get().__repr__()
+
+        path = tempfile.mkdtemp()
+        try:
+            call_command('archive_logs', days=5, output_dir=path, verbosity=0)
+            self.assertEqual(0, LogItem.objects.count())
+
+            files = os.listdir(path)
+            lines = gzip.open(os.path.join(path, files[0])).readlines()
+            records = [json.loads(line) for line in lines]
+            self.assertEqual(1, len(records))
+            self.assertEqual(message, records[0]['log_message'])
+            self.assertEqual(text, records[0]['text'])
+            self.assertTrue(records[0]['text'].endswith(message))
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Benchmark for the port forwarder daemon.
+
+Starts an echo server and a forwarder daemon in separate processes, then
+opens a number of concurrent sessions through the forwarder.  Every session
+sends a message, waits for the echo and repeats until the duration is over.
+Reports throughput, round trip latency and forwarder CPU time per session:
+
+    bench_portforwarder.py [-s 1,10,100,500] [-d 5] [-m 4096]
+
+--min-mbps makes the benchmark exit with a non-zero status when any level is
+slower than the given throughput, for use in CI.
+"""
+
+import errno
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Event, Process
+from optparse import OptionParser
+from socket import *
+
+import portforwarder
+from portforwarder import Poller, READ, WRITE, RETRY, send_command
+
+LEVELS = (1, 10, 100, 500)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def cpu_time(pid):
+    """
+    Returns user + system CPU seconds used by a process, read from /proc.
+    Returns None where /proc is not available.
+    """
+    try:
+        stat = open('/proc/%d/stat' % pid).read()
+    except IOError:
+        return None
+    fields = stat[stat.rindex(')')+2:].split()
+    return (int(fields[11]) + int(fields[12])) \
+        / float(os.sysconf('SC_CLK_TCK'))
+
+
+def echo_server(port, ready):
+    """
+    Event driven echo server, runs until killed
+    """
+    raise_fd_limit()
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1024)
+    server.setblocking(0)
+    poller = Poller()
+    poller.register(server.fileno(), READ)
+    clients = {}
+    ready.set()
+
+    while True:
+        for fd, events in poller.poll(1):
+            if fd == server.fileno():
+                try:
+                    sock, address = server.accept()
+                except error:
+                    continue
+                sock.setblocking(0)
+                clients[sock.fileno()] = sock
+                poller.register(sock.fileno(), READ)
+                continue
+            sock = clients[fd]
+            try:
+                data = sock.recv(portforwarder.BUFFER)
+            except error:
+                data = ''
+            if not data:
+                poller.unregister(fd)
+                del clients[fd]
+                sock.close()
+                continue
+            # echo with a blocking send, messages are small
+            sock.setblocking(1)
+            sock.sendall(data)
+            sock.setblocking(0)
+
+
+def forwarder(control, ready):
+    raise_fd_limit()
+    f = portforwarder.Forwarder(control)
+    ready.set()
+    f.run()
+
+
+class Session(object):
+    def __init__(self, port, message):
+        self.sock = create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.message = message
+        self.outgoing = ''
+        self.pending = 0
+        self.sent = None
+
+    def start(self):
+        self.outgoing = self.message
+        self.pending = len(self.message)
+        self.sent = time.time()
+
+
+def measure(port, sessions, duration, size):
+    """
+    Runs the request/echo loop on a number of sessions
+
+    @return dict with bytes, messages, latencies and errors
+    """
+    message = 'x' * size
+    poller = Poller()
+    clients = {}
+    for i in xrange(sessions):
+        session = Session(port, message)
+        clients[session.fd] = session
+        session.start()
+        poller.register(session.fd, READ | WRITE)
+
+    results = dict(bytes=0, messages=0, latencies=[], errors=0)
+    deadline = time.time() + duration
+    while clients and time.time() < deadline:
+        for fd, events in poller.poll(0.1):
+            session = clients[fd]
+            try:
+                if events & WRITE and session.outgoing:
+                    sent = session.sock.send(session.outgoing)
+                    session.outgoing = session.outgoing[sent:]
+                if events & READ:
+                    data = session.sock.recv(portforwarder.BUFFER)
+                    if not data:
+                        raise error(errno.ECONNRESET, 'connection closed')
+                    session.pending -= len(data)
+                    results['bytes'] += len(data)
+                    if session.pending <= 0:
+                        results['messages'] += 1
+                        results['latencies'].append(time.time()-session.sent)
+                        session.start()
+            except error, e:
+                if e.args[0] in RETRY:
+                    continue
+                results['errors'] += 1
+                poller.unregister(fd)
+                del clients[fd]
+                session.sock.close()
+                continue
+            poller.modify(fd, READ | WRITE if session.outgoing else READ)
+
+    for session in clients.values():
+        session.sock.close()
+    return results
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * percent / 100.0))]
+
+
+def run(levels=LEVELS, duration=5, size=4096):
+    """
+    Runs the benchmark for each number of concurrent sessions
+
+    @return list of result dicts, one per level
+    """
+    raise_fd_limit()
+    echo_port = free_port()
+    control = tempfile.mktemp(prefix='portforwarder-bench-')
+    ready = Event(), Event()
+    echo = Process(target=echo_server, args=(echo_port, ready[0]))
+    daemon = Process(target=forwarder, args=(control, ready[1]))
+    echo.start()
+    daemon.start()
+    try:
+        for event in ready:
+            event.wait(10)
+
+        rows = []
+        for sessions in levels:
+            lport = free_port()
+            send_command('open %d 127.0.0.1 %d' % (lport, echo_port), control)
+            before = cpu_time(daemon.pid)
+            results = measure(lport, sessions, duration, size)
+            after = cpu_time(daemon.pid)
+            send_command('close %d' % lport, control)
+
+            latencies = results['latencies']
+            results.update(
+                sessions = sessions,
+                mbps = results['bytes'] / duration / 1048576.0,
+                p50 = percentile(latencies, 50) * 1000,
+                p99 = percentile(latencies, 99) * 1000,
+                cpu = (after - before) / sessions if before is not None \
+                      else None,
+            )
+            rows.append(results)
+        return rows
+    finally:
+        echo.terminate()
+        daemon.terminate()
+        if os.path.exists(control):
+            os.unlink(control)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sessions', default=','.join(map(str, LEVELS)),
+                      help='comma separated numbers of concurrent sessions')
+    parser.add_option('-d', '--duration', type='float', default=5,
+                      help='seconds to run each level')
+    parser.add_option('-m', '--message-size', type='int', default=4096,
+                      help='bytes per message')
+    parser.add_option('--min-mbps', type='float', default=None,
+                      help='fail if any level is slower than this')
+    options, args = parser.parse_args()
+    levels = [int(s) for s in options.sessions.split(',')]
+
+    rows = run(levels, options.duration, options.message_size)
+    print '%8s %10s %10s %10s %10s %12s %7s' % ('sessions', 'MB/s', \
+            'msgs/s', 'p50 ms', 'p99 ms', 'cpu s/sess', 'errors')
+    failed = False
+    for row in rows:
+        cpu = '%12.4f' % row['cpu'] if row['cpu'] is not None else '%12s' % '-'
+        print '%8d %10.2f %10.0f %10.3f %10.3f %s %7d' % (row['sessions'], \
+                row['mbps'], row['messages'] / options.duration, row['p50'], \
+                row['p99'], cpu, row['errors'])
+        if row['errors'] or (options.min_mbps is not None \
+                             and row['mbps'] < options.min_mbps):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
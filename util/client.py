@@ -53,8 +53,11 @@
 # be standalone.
 
 import logging
-import simplejson
+import math
+import random
+import re
 import socket
+import time
 import urllib
 import threading
 import pycurl
@@ -135,6 +138,443 @@ class GanetiApiError(Error):
     self.code = code
 
 
+class CircuitOpenError(GanetiApiError):
+  """Raised without contacting the cluster while its circuit breaker is open.
+
+  """
+  pass
+
+
+# Segments of RAPI paths that are followed by the name of an object
+_PATH_COLLECTIONS = frozenset(["instances", "nodes", "jobs", "groups"])
+
+# Encodings accepted when compression is enabled
+_ACCEPT_ENCODING = "gzip, deflate"
+
+# Timings reported to hooks and the pycURL info they are read from
+_CURL_TIMINGS = [
+  ("namelookup", "NAMELOOKUP_TIME"),
+  ("connect", "CONNECT_TIME"),
+  ("tls", "APPCONNECT_TIME"),
+  ("first_byte", "STARTTRANSFER_TIME"),
+  ("total", "TOTAL_TIME"),
+  ]
+
+
+def PathTemplate(path):
+  """Returns the template of a RAPI path.
+
+  Names of objects are replaced with C{%s}, e.g. C{/2/instances/foo/tags}
+  becomes C{/2/instances/%s/tags}.  Requests for different objects of the
+  same resource share a template, so they can be aggregated.
+
+  @type path: string
+  @param path: HTTP URL path, without query
+
+  """
+  parts = path.split("/")
+  for i in range(1, len(parts)):
+    if parts[i - 1] in _PATH_COLLECTIONS and parts[i]:
+      parts[i] = "%s"
+  return "/".join(parts)
+
+
+class RequestHook(object):
+  """Base class for hooks called around every RAPI request.
+
+  Both methods receive the same dict describing the request, with the keys
+  method, path, template, query, bytes_out and start.  After the request it also
+  contains code, bytes_in, bytes_wire, error and timings.  start is the time
+  the request was sent.  bytes_in is the
+  size of the decompressed response, bytes_wire the size transferred.
+  timings is a dict of seconds
+  since the start of the request for namelookup, connect, tls, first_byte and
+  total, plus decode, the seconds spent decoding the response.  Hooks must not
+  raise, errors are logged and ignored.
+
+  """
+  def BeforeRequest(self, request):
+    pass
+
+  def AfterRequest(self, request):
+    pass
+
+
+class CircuitBreaker(object):
+  """Stops sending requests to a cluster that keeps failing.
+
+  The breaker opens after C{failure_threshold} consecutive failures.  While
+  open, requests fail immediately with L{CircuitOpenError}.  After
+  C{reset_timeout} seconds a single probe request is let through (half-open);
+  the breaker closes if it succeeds and opens again if it fails.
+
+  Network errors and HTTP 5xx responses count as failures.  Other responses,
+  including 404, show that the cluster is reachable.
+
+  """
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"
+
+  def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.time):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened = None
+    self._clock = clock
+    self._probing = False
+    self._lock = threading.Lock()
+
+  def Allow(self):
+    """Returns whether a request may be sent.
+
+    """
+    self._lock.acquire()
+    try:
+      if self.state == self.CLOSED:
+        return True
+      if self.state == self.OPEN:
+        if self._clock() - self.opened < self.reset_timeout:
+          return False
+        self.state = self.HALF_OPEN
+        self._probing = False
+      # Half-open, only a single probe may be in flight
+      if self._probing:
+        return False
+      self._probing = True
+      return True
+    finally:
+      self._lock.release()
+
+  def RetryAfter(self):
+    """Returns the seconds until the next probe is allowed.
+
+    """
+    if self.state != self.OPEN:
+      return 0
+    return max(0, self.reset_timeout - (self._clock() - self.opened))
+
+  def RecordSuccess(self):
+    self._lock.acquire()
+    try:
+      self.state = self.CLOSED
+      self.failures = 0
+      self._probing = False
+    finally:
+      self._lock.release()
+
+  def RecordFailure(self):
+    self._lock.acquire()
+    try:
+      self.failures += 1
+      self._probing = False
+      if (self.state == self.HALF_OPEN or
+          self.failures >= self.failure_threshold):
+        self.state = self.OPEN
+        self.opened = self._clock()
+    finally:
+      self._lock.release()
+
+
+class AdaptiveTimeouts(object):
+  """Timeouts derived from the latency of recent successful requests.
+
+  The transfer timeout of a request is C{factor} times the C{percentile} of
+  the recent requests with the same path template, so a slow bulk listing
+  does not shorten the timeout of quick requests and vice versa.  The connect
+  timeout is derived from the connect times of all requests.  Timeouts are
+  kept between the minimum and the maximum, the maximum is used until
+  C{min_samples} requests were observed.
+
+  """
+  def __init__(self, connect_timeout=10, timeout=300, min_connect_timeout=1,
+               min_timeout=5, factor=4, percentile=99, samples=100,
+               min_samples=10):
+    self.connect_timeout = connect_timeout
+    self.timeout = timeout
+    self.min_connect_timeout = min_connect_timeout
+    self.min_timeout = min_timeout
+    self.factor = factor
+    self.percentile = percentile
+    self.samples = samples
+    self.min_samples = min_samples
+    self._connect = []
+    self._total = {}
+    self._lock = threading.Lock()
+
+  def _Percentile(self, values):
+    values = sorted(values)
+    return values[min(len(values) - 1,
+                      int(len(values) * self.percentile / 100.0))]
+
+  def _Derive(self, values, minimum, maximum):
+    if len(values) < self.min_samples:
+      return maximum
+    return max(minimum, min(maximum, self.factor * self._Percentile(values)))
+
+  def Get(self, template):
+    """Returns the (connect timeout, timeout) in seconds for a request.
+
+    """
+    return (self._Derive(self._connect, self.min_connect_timeout,
+                         self.connect_timeout),
+            self._Derive(self._total.get(template, ()), self.min_timeout,
+                         self.timeout))
+
+  def Observe(self, template, timings):
+    """Records the timings of a successful request.
+
+    """
+    self._lock.acquire()
+    try:
+      for values, value in ((self._connect, timings.get("connect")),
+                            (self._total.setdefault(template, []),
+                             timings.get("total"))):
+        if value is not None:
+          values.append(value)
+          if len(values) > self.samples:
+            del values[0]
+    finally:
+      self._lock.release()
+
+
+class RetryPolicy(object):
+  """Retries failed idempotent requests with jittered exponential backoff.
+
+  Only GET requests are retried.  Other methods submit jobs and are never
+  retried, as the job may have been submitted even though the request failed.
+  Network errors and HTTP 502, 503 and 504 responses are retried, up to
+  C{retries} times per request.  The delay before retry n is random between
+  zero and C{backoff * 2 ** n}, at most C{max_backoff} seconds.
+
+  Retries are limited by a budget so that they can not multiply the load on a
+  struggling master: every request adds C{budget_ratio} tokens, the budget is
+  refilled by C{min_per_second} tokens per second, and every retry costs one
+  token.  At most C{max_tokens} are kept.
+
+  """
+  RETRY_CODES = frozenset([502, 503, 504])
+
+  def __init__(self, retries=2, backoff=0.1, max_backoff=1,
+               budget_ratio=0.1, min_per_second=1, max_tokens=10,
+               clock=time.time, sleep=time.sleep, rand=random.random):
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.budget_ratio = budget_ratio
+    self.min_per_second = min_per_second
+    self.max_tokens = max_tokens
+    self.tokens = max_tokens
+    self._clock = clock
+    self._sleep = sleep
+    self._rand = rand
+    self._refilled = clock()
+    self._lock = threading.Lock()
+
+  def _Refill(self, tokens):
+    now = self._clock()
+    tokens += (now - self._refilled) * self.min_per_second
+    self._refilled = now
+    self.tokens = min(self.max_tokens, self.tokens + tokens)
+
+  def Deposit(self):
+    """Adds the tokens of a new request to the budget.
+
+    """
+    self._lock.acquire()
+    try:
+      self._Refill(self.budget_ratio)
+    finally:
+      self._lock.release()
+
+  def ShouldRetry(self, method, err, attempt):
+    """Returns whether a failed request should be retried.
+
+    A token is taken from the budget if the request is retried.
+
+    """
+    if (method != HTTP_GET or attempt >= self.retries or
+        isinstance(err, CircuitOpenError) or
+        (err.code is not None and err.code not in self.RETRY_CODES)):
+      return False
+
+    self._lock.acquire()
+    try:
+      self._Refill(0)
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+    finally:
+      self._lock.release()
+
+  def Wait(self, attempt):
+    """Sleeps before retry number C{attempt}, starting at 0.
+
+    """
+    self._sleep(self._rand() *
+                min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class JsonCodec(object):
+  """Encoding and decoding functions of a JSON implementation.
+
+  """
+  def __init__(self, name, dumps, loads, accelerated):
+    self.name = name
+    self.dumps = dumps
+    self.loads = loads
+    self.accelerated = accelerated
+
+  def __repr__(self):
+    return "<JsonCodec %s%s>" % (self.name,
+                                 not self.accelerated and " (python)" or "")
+
+
+def _FindJsonCodecs():
+  """Returns the available JSON implementations, the fastest first.
+
+  Implementations with C extensions are preferred: ujson, then simplejson and
+  the standard library json module.  Keys are not sorted when encoding, the
+  RAPI does not depend on their order.
+
+  """
+  codecs = []
+
+  try:
+    import ujson
+  except ImportError:
+    pass
+  else:
+    loads = ujson.loads
+    try:
+      # Parse floats such as mtimes exactly, if supported by this version
+      ujson.loads("0.1", precise_float=True)
+      loads = lambda text: ujson.loads(text, precise_float=True)
+    except TypeError:
+      pass
+    codecs.append(JsonCodec("ujson", ujson.dumps, loads, True))
+
+  for name in ("simplejson", "json"):
+    try:
+      module = __import__(name)
+    except ImportError:
+      continue
+    encoder = module.JSONEncoder(separators=(",", ":"))
+    # The C scanner is only used if the extension module is available
+    accelerated = getattr(module.decoder, "c_scanstring", None) is not None
+    codecs.append(JsonCodec(name, encoder.encode, module.loads, accelerated))
+
+  # sort is stable, the order of preference is kept within both groups
+  codecs.sort(key=lambda codec: not codec.accelerated)
+  return codecs
+
+
+JSON_CODECS = _FindJsonCodecs()
+
+
+def GetJsonCodec(name=None):
+  """Returns a JSON implementation.
+
+  @type name: string
+  @param name: ujson, simplejson or json, or None for the fastest available
+  @rtype: L{JsonCodec}
+
+  """
+  for codec in JSON_CODECS:
+    if name is None or codec.name == name:
+      return codec
+  raise Error("JSON implementation %s is not available" % (name or "(any)"))
+
+
+class JsonArraySplitter(object):
+  """Splits a JSON array into the text of its items, incrementally.
+
+  The array is fed in chunks of any size, e.g. from a cURL write callback.
+  Every call returns the items completed by the chunk, so only the text of the
+  current item is buffered.  Items are not decoded, only the nesting of
+  brackets outside of strings is tracked.
+
+  """
+  _SPECIAL = re.compile(r'[\[\]{}",\\]')
+
+  def __init__(self):
+    self._parts = []
+    self._depth = 0
+    self._in_string = False
+    self._escape = False
+    self._done = False
+
+  def _Emit(self, items, tail):
+    text = "".join(self._parts) + tail
+    self._parts = []
+    if text.strip():
+      items.append(text)
+
+  def Feed(self, data):
+    """Feeds a chunk of the array.
+
+    @rtype: list of str
+    @return: the text of the items completed by this chunk
+    @raises ValueError: If the data is not a JSON array
+
+    """
+    items = []
+    pos = start = 0
+    size = len(data)
+    if self._escape and size:
+      # Skip the character escaped at the end of the last chunk
+      self._escape = False
+      pos = 1
+
+    while not self._done:
+      match = self._SPECIAL.search(data, pos)
+      if match is None:
+        break
+      i = match.start()
+      char = data[i]
+      pos = i + 1
+
+      if self._in_string:
+        if char == "\\":
+          if pos < size:
+            pos += 1
+          else:
+            self._escape = True
+        elif char == '"':
+          self._in_string = False
+      elif char == '"':
+        self._in_string = True
+      elif char in "[{":
+        if self._depth == 0:
+          if char != "[" or data[:i].strip() or self._parts:
+            raise ValueError("Response is not a JSON array")
+          start = pos
+        self._depth += 1
+      elif char in "]}":
+        self._depth -= 1
+        if self._depth == 0:
+          self._Emit(items, data[start:i])
+          self._done = True
+      elif char == "," and self._depth == 1:
+        self._Emit(items, data[start:i])
+        start = pos
+
+    if self._depth and not self._done:
+      self._parts.append(data[start:])
+    return items
+
+  def Close(self):
+    """Checks that the whole array was fed.
+
+    @raises ValueError: If the array is incomplete
+
+    """
+    if not self._done:
+      raise ValueError("Incomplete JSON array")
+
+
 def UsesRapiClient(fn):
   """Decorator for code using RAPI client to initialize pycURL.
 
@@ -259,11 +699,12 @@ class GanetiRapiClient(object):
 
   """
   USER_AGENT = "Ganeti RAPI Client"
-  _json_encoder = simplejson.JSONEncoder(sort_keys=True)
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None, hooks=None,
+               circuit_breaker=None, timeouts=None, retry_policy=None,
+               compression=False, curl_multi_factory=None, json_codec=None):
     """Initializes this class.
 
     @type host: string
@@ -277,6 +718,23 @@ class GanetiRapiClient(object):
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
     @param logger: Logging object
+    @type hooks: list of L{RequestHook}
+    @param hooks: Hooks called before and after every request
+    @type circuit_breaker: L{CircuitBreaker}
+    @param circuit_breaker: Breaker failing requests fast while the cluster
+                            is unreachable
+    @type timeouts: L{AdaptiveTimeouts}
+    @param timeouts: Sets the cURL timeouts of every request
+    @type retry_policy: L{RetryPolicy}
+    @param retry_policy: Policy for retrying failed requests
+    @type compression: bool
+    @param compression: Whether to accept gzip or deflate compressed
+                        responses, they are decompressed transparently
+    @type curl_multi_factory: callable
+    @param curl_multi_factory: Creates the C{pycurl.CurlMulti} objects used
+                               for streaming responses
+    @type json_codec: L{JsonCodec}
+    @param json_codec: JSON implementation, the fastest available by default
 
     """
     self._username = username
@@ -284,6 +742,16 @@ class GanetiRapiClient(object):
     self._logger = logger
     self._curl_config_fn = curl_config_fn
     self._curl_factory = curl_factory
+    self._hooks = list(hooks or [])
+    self._circuit_breaker = circuit_breaker
+    self._timeouts = timeouts
+    self._retry_policy = retry_policy
+    self._compression = compression
+    self._curl_multi_factory = curl_multi_factory
+    self._json = json_codec or GetJsonCodec()
+
+    # Statistics of the last request, see RequestHook
+    self.last_request = None
 
     try:
       socket.inet_pton(socket.AF_INET6, host)
@@ -321,6 +789,9 @@ class GanetiRapiClient(object):
       "Accept: %s" % HTTP_APP_JSON,
       "Content-type: %s" % HTTP_APP_JSON,
       ])
+    if self._compression:
+      # Sets Accept-Encoding, cURL decompresses the response
+      curl.setopt(pycurl.ENCODING, _ACCEPT_ENCODING)
 
     assert ((self._username is None and self._password is None) ^
             (self._username is not None and self._password is not None))
@@ -337,6 +808,79 @@ class GanetiRapiClient(object):
 
     return curl
 
+  def _CreateCurlMulti(self):
+    """Creates a cURL multi object.
+
+    """
+    if self._curl_multi_factory:
+      return self._curl_multi_factory()
+    return pycurl.CurlMulti()
+
+  def AddHook(self, hook):
+    """Adds a L{RequestHook} called around every request.
+
+    """
+    self._hooks.append(hook)
+
+  def _RunHooks(self, name, request):
+    """Calls a method of all hooks, logging errors.
+
+    """
+    for hook in self._hooks:
+      try:
+        getattr(hook, name)(request)
+      except Exception, err: # pylint: disable-msg=W0703
+        self._logger.error("RAPI hook %r failed: %s", hook, err)
+
+  def _SetTimeouts(self, curl, template, stream=False):
+    """Sets the adaptive timeouts for a request.
+
+    The consumer of a streamed response runs between chunks of the transfer,
+    so a total timeout would include its time.  Streamed requests are instead
+    aborted when less than a byte per second was received for the timeout.
+
+    """
+    connect_timeout, timeout = self._timeouts.Get(template)
+    if stream:
+      curl.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+      curl.setopt(pycurl.LOW_SPEED_TIME, int(math.ceil(timeout)))
+      timeout = 0
+    else:
+      curl.setopt(pycurl.LOW_SPEED_LIMIT, 0)
+      curl.setopt(pycurl.LOW_SPEED_TIME, 0)
+    # Millisecond timeouts require libcurl 7.16.2
+    if hasattr(pycurl, "TIMEOUT_MS"):
+      curl.setopt(pycurl.CONNECTTIMEOUT_MS, int(connect_timeout * 1000))
+      curl.setopt(pycurl.TIMEOUT_MS, int(timeout * 1000))
+    else:
+      curl.setopt(pycurl.CONNECTTIMEOUT, int(math.ceil(connect_timeout)))
+      curl.setopt(pycurl.TIMEOUT, int(math.ceil(timeout)))
+
+  @staticmethod
+  def _GetWireSize(curl, default):
+    """Returns the number of bytes transferred, before decompression.
+
+    """
+    try:
+      return int(curl.getinfo(pycurl.SIZE_DOWNLOAD)) or default
+    except (pycurl.error, ValueError, TypeError):
+      return default
+
+  @staticmethod
+  def _GetTimings(curl):
+    """Reads the timings of a finished request from cURL.
+
+    """
+    timings = {}
+    for name, info in _CURL_TIMINGS:
+      # APPCONNECT_TIME requires pycURL 7.19.0
+      if hasattr(pycurl, info):
+        try:
+          timings[name] = curl.getinfo(getattr(pycurl, info))
+        except (pycurl.error, ValueError, TypeError):
+          pass
+    return timings
+
   @staticmethod
   def _EncodeQuery(query):
     """Encode query values for RAPI URL.
@@ -366,33 +910,51 @@ class GanetiRapiClient(object):
     return result
 
   def _SendRequest(self, method, path, query, content):
-    """Sends an HTTP request.
+    """Sends an HTTP request, retrying it according to the retry policy.
 
-    This constructs a full URL, encodes and decodes HTTP bodies, and
-    handles invalid responses in a pythonic way.
+    See L{_SendRequestOnce} for the parameters.
 
-    @type method: string
-    @param method: HTTP method to use
-    @type path: string
-    @param path: HTTP URL path
-    @type query: list of two-tuples
-    @param query: query arguments to pass to urllib.urlencode
-    @type content: str or None
-    @param content: HTTP body content
+    """
+    policy = self._retry_policy
+    if policy is None:
+      return self._SendRequestOnce(method, path, query, content)
 
-    @rtype: str
-    @return: JSON-Decoded response
+    policy.Deposit()
+    attempt = 0
+    while True:
+      try:
+        return self._SendRequestOnce(method, path, query, content)
+      except GanetiApiError, err:
+        if not policy.ShouldRetry(method, err, attempt):
+          raise
+        self._logger.warning("Retrying %s %s after error: %s",
+                             method, path, err)
+        policy.Wait(attempt)
+        attempt += 1
 
-    @raises CertificateError: If an invalid SSL certificate is found
-    @raises GanetiApiError: If an invalid response is returned
+  def _PrepareRequest(self, method, path, query, content, stream=False):
+    """Creates and configures a cURL object for a request.
+
+    Checks the circuit breaker and calls the BeforeRequest hooks.  The caller
+    must set the write function and report the outcome with
+    L{_RequestFailed} or L{_RequestDone}.
+
+    @type stream: bool
+    @param stream: Whether the response is consumed while it is received
+
+    @rtype: tuple
+    @return: the cURL object and the request dict passed to hooks
 
     """
     assert path.startswith("/")
 
+    template = PathTemplate(path)
     curl = self._CreateCurl()
+    if self._timeouts is not None:
+      self._SetTimeouts(curl, template, stream)
 
     if content is not None:
-      encoded_content = self._json_encoder.encode(content)
+      encoded_content = self._json.dumps(content)
     else:
       encoded_content = ""
 
@@ -407,13 +969,145 @@ class GanetiRapiClient(object):
     self._logger.debug("Sending request %s %s (content=%r)",
                        method, url, encoded_content)
 
-    # Buffer for response
-    encoded_resp_body = StringIO()
-
     # Configure cURL
     curl.setopt(pycurl.CUSTOMREQUEST, str(method))
     curl.setopt(pycurl.URL, str(url))
     curl.setopt(pycurl.POSTFIELDS, str(encoded_content))
+
+    breaker = self._circuit_breaker
+    if breaker is not None and not breaker.Allow():
+      raise CircuitOpenError("Not connecting to %s, too many failures. Retrying"
+                             " in %d seconds" % (self._base_url,
+                                                 breaker.RetryAfter()))
+
+    request = {
+      "method": method,
+      "path": path,
+      "template": template,
+      "query": query,
+      "bytes_out": len(encoded_content),
+      "bytes_in": 0,
+      "bytes_wire": 0,
+      "code": None,
+      "error": None,
+      "timings": {},
+      "start": time.time(),
+      }
+    self.last_request = request
+    self._RunHooks("BeforeRequest", request)
+    return curl, request
+
+  def _RequestFailed(self, request, err, consumer=0):
+    """Records a request that failed without a response.
+
+    @type err: pycurl.error
+    @param err: the error raised by cURL
+    @type consumer: float
+    @param consumer: Seconds spent by the consumer of a streamed response
+    @rtype: L{Error}
+    @return: the exception to raise
+
+    """
+    if self._circuit_breaker is not None:
+      self._circuit_breaker.RecordFailure()
+    request["error"] = str(err)
+    request["timings"] = {
+      "total": max(0, time.time() - request["start"] - consumer),
+      }
+    self._RunHooks("AfterRequest", request)
+
+    if err.args[0] in _CURL_SSL_CERT_ERRORS:
+      return CertificateError("SSL certificate error %s" % err)
+    return GanetiApiError(str(err))
+
+  def _RequestDone(self, curl, request, consumer=0):
+    """Records the response of a request, before it is decoded.
+
+    @type consumer: float
+    @param consumer: Seconds spent by the consumer of a streamed response,
+                     they are not counted in the total time observed by the
+                     adaptive timeouts
+    @rtype: int
+    @return: the HTTP response code
+
+    """
+    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+    timings = self._GetTimings(curl)
+    timings.setdefault("total", time.time() - request["start"])
+    if consumer:
+      timings["total"] = max(0, timings["total"] - consumer)
+      timings["consumer"] = consumer
+
+    # Server errors mean the cluster is not healthy, other responses show it
+    # is reachable
+    breaker = self._circuit_breaker
+    if http_code >= 500:
+      if breaker is not None:
+        breaker.RecordFailure()
+    else:
+      if breaker is not None:
+        breaker.RecordSuccess()
+      if self._timeouts is not None:
+        self._timeouts.Observe(request["template"], timings)
+
+    request.update(code=http_code, timings=timings)
+    if http_code != HTTP_OK:
+      request["error"] = "HTTP %s" % http_code
+    return http_code
+
+  @staticmethod
+  def _ResponseError(http_code, response_content):
+    """Creates the exception for an unsuccessful response.
+
+    """
+    if isinstance(response_content, dict):
+      msg = ("%s %s: %s" %
+             (response_content["code"],
+              response_content["message"],
+              response_content["explain"]))
+    else:
+      msg = str(response_content)
+
+    return GanetiApiError(msg, code=http_code)
+
+  def _DecodeErrorBody(self, body):
+    """Decodes the body of an unsuccessful response.
+
+    Proxies in front of the RAPI answer errors such as 502 with HTML, their
+    body is used as the message as is.
+
+    """
+    try:
+      return self._json.loads(body)
+    except ValueError:
+      return body
+
+  def _SendRequestOnce(self, method, path, query, content):
+    """Sends an HTTP request.
+
+    This constructs a full URL, encodes and decodes HTTP bodies, and
+    handles invalid responses in a pythonic way.
+
+    @type method: string
+    @param method: HTTP method to use
+    @type path: string
+    @param path: HTTP URL path
+    @type query: list of two-tuples
+    @param query: query arguments to pass to urllib.urlencode
+    @type content: str or None
+    @param content: HTTP body content
+
+    @rtype: str
+    @return: JSON-Decoded response
+
+    @raises CertificateError: If an invalid SSL certificate is found
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    curl, request = self._PrepareRequest(method, path, query, content)
+
+    # Buffer for response
+    encoded_resp_body = StringIO()
     curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.write)
 
     try:
@@ -421,38 +1115,161 @@ class GanetiRapiClient(object):
       try:
         curl.perform()
       except pycurl.error, err:
-        if err.args[0] in _CURL_SSL_CERT_ERRORS:
-          raise CertificateError("SSL certificate error %s" % err)
-
-        raise GanetiApiError(str(err))
+        raise self._RequestFailed(request, err)
     finally:
       # Reset settings to not keep references to large objects in memory
       # between requests
       curl.setopt(pycurl.POSTFIELDS, "")
       curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
 
-    # Get HTTP response code
-    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+    http_code = self._RequestDone(curl, request)
+    received = time.time()
 
     # Was anything written to the response buffer?
-    if encoded_resp_body.tell():
-      response_content = simplejson.loads(encoded_resp_body.getvalue())
+    size = encoded_resp_body.tell()
+    if size and http_code != HTTP_OK:
+      response_content = self._DecodeErrorBody(encoded_resp_body.getvalue())
+    elif size:
+      response_content = self._json.loads(encoded_resp_body.getvalue())
     else:
       response_content = None
 
-    if http_code != HTTP_OK:
-      if isinstance(response_content, dict):
-        msg = ("%s %s: %s" %
-               (response_content["code"],
-                response_content["message"],
-                response_content["explain"]))
-      else:
-        msg = str(response_content)
+    request["timings"]["decode"] = time.time() - received
+    request.update(bytes_in=size, bytes_wire=self._GetWireSize(curl, size))
+    self._RunHooks("AfterRequest", request)
 
-      raise GanetiApiError(msg, code=http_code)
+    if http_code != HTTP_OK:
+      raise self._ResponseError(http_code, response_content)
 
     return response_content
 
+  def _StreamRequest(self, method, path, query):
+    """Sends an HTTP request returning a JSON array, yielding its items.
+
+    The request is retried according to the retry policy, unless items were
+    already yielded.  See L{_StreamRequestOnce}.
+
+    """
+    policy = self._retry_policy
+    if policy is not None:
+      policy.Deposit()
+    attempt = 0
+    while True:
+      yielded = False
+      try:
+        for item in self._StreamRequestOnce(method, path, query):
+          yielded = True
+          yield item
+        return
+      except GanetiApiError, err:
+        if (yielded or policy is None or
+            not policy.ShouldRetry(method, err, attempt)):
+          raise
+        self._logger.warning("Retrying %s %s after error: %s",
+                             method, path, err)
+        policy.Wait(attempt)
+        attempt += 1
+
+  def _StreamRequestOnce(self, method, path, query):
+    """Sends an HTTP request returning a JSON array, yielding its items.
+
+    Items are decoded while the response is received, so only the items not
+    yet consumed are held in memory instead of the whole response and its
+    decoded form.  The transfer is driven with C{pycurl.CurlMulti}, which
+    returns control between chunks of the response.  Time spent by the
+    consumer between items is not counted in the observed timings, and the
+    transfer has a stall timeout instead of a total timeout, see
+    L{_SetTimeouts}.
+
+    @raises CertificateError: If an invalid SSL certificate is found
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    curl, request = self._PrepareRequest(method, path, query, None, True)
+
+    splitter = JsonArraySplitter()
+    items = []
+    error_body = StringIO()
+    state = {"code": None, "size": 0, "error": None}
+
+    def _Write(data):
+      state["size"] += len(data)
+      if state["code"] is None:
+        state["code"] = curl.getinfo(pycurl.RESPONSE_CODE)
+      if state["code"] != HTTP_OK:
+        error_body.write(data)
+        return None
+      try:
+        items.extend(splitter.Feed(data))
+      except ValueError, err:
+        # Aborts the transfer
+        state["error"] = err
+        return 0
+      return None
+
+    curl.setopt(pycurl.WRITEFUNCTION, _Write)
+    multi = self._CreateCurlMulti()
+    multi.add_handle(curl)
+    decode = 0.0
+    consumer = 0.0
+    done = False
+    try:
+      active = 1
+      while active:
+        ret, active = multi.perform()
+        if ret == pycurl.E_CALL_MULTI_PERFORM:
+          continue
+
+        pending, items[:] = items[:], []
+        for text in pending:
+          begin = time.time()
+          try:
+            item = self._json.loads(text)
+          except ValueError, err:
+            raise GanetiApiError("Invalid response: %s" % err)
+          decode += time.time() - begin
+          begin = time.time()
+          yield item
+          consumer += time.time() - begin
+
+        if active:
+          multi.select(1.0)
+
+      failed = multi.info_read()[2]
+      if failed and state["error"] is None:
+        raise self._RequestFailed(request, pycurl.error(*failed[0][1:]),
+                                  consumer)
+
+      http_code = self._RequestDone(curl, request, consumer)
+      done = True
+      request["timings"]["decode"] = decode
+      request.update(bytes_in=state["size"],
+                     bytes_wire=self._GetWireSize(curl, state["size"]))
+      self._RunHooks("AfterRequest", request)
+
+      if http_code != HTTP_OK:
+        if error_body.tell():
+          raise self._ResponseError(http_code,
+                                    self._DecodeErrorBody(error_body.getvalue()))
+        raise self._ResponseError(http_code, None)
+
+      try:
+        if state["error"] is not None:
+          raise state["error"]
+        splitter.Close()
+      except ValueError, err:
+        raise GanetiApiError("Invalid response: %s" % err)
+
+    finally:
+      if not done and request["code"] is None and request["error"] is None:
+        # The consumer stopped early or the response was invalid, the cluster
+        # was reachable
+        if self._circuit_breaker is not None:
+          self._circuit_breaker.RecordSuccess()
+      multi.remove_handle(curl)
+      multi.close()
+      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+
   def GetVersion(self):
     """Gets the Remote API version running on the cluster.
 
@@ -566,6 +1383,32 @@ class GanetiRapiClient(object):
     else:
       return [i["id"] for i in instances]
 
+  def GetInstancesIter(self, bulk=False):
+    """Iterates over the instances on the cluster.
+
+    Like L{GetInstances}, but instances are yielded while the response is
+    received and decoded, so memory use does not grow with the number of
+    instances.
+
+    @type bulk: bool
+    @param bulk: whether to return all information about all instances
+
+    @rtype: iterator of dict or str
+    @return: if bulk is True, info about the instances, else instance names
+
+    """
+    query = []
+    if bulk:
+      query.append(("bulk", 1))
+
+    for instance in self._StreamRequest(HTTP_GET,
+                                        "/%s/instances" % GANETI_RAPI_VERSION,
+                                        query):
+      if bulk:
+        yield instance
+      else:
+        yield instance["id"]
+
   def GetInstance(self, instance):
     """Gets information about an instance.
 
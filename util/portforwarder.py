@@ -18,21 +18,63 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+"""
+TCP port forwarder used for VNC consoles.
 
+The forwarder can run in two modes:
+
+    portforwarder.py <local_port> <remote_host:remote_port>
+        forwards a single connection to the remote host and exits.
+
+    portforwarder.py --daemon [control_socket]
+        runs a single event loop that serves any number of port mappings.
+        Mappings are opened and closed by sending line based commands to a
+        unix control socket:
+
+            open <local_port> <remote_host> <remote_port>
+            close <local_port>
+            list
+
+        Every command is answered with a single line starting with "ok" or
+        "error".  send_command() implements the client side.  Host names are
+        resolved on a helper thread, so the reply to an open command for a
+        host name arrives once the lookup finished.
+"""
+
+import errno
+import fcntl
 import os
+import select
 import sys
+import threading
+import time
 from socket import *
-from select import select
 
 ACCEPT_TIMEOUT = 30 # seconds
-BUFFER = 2048
+BUFFER = 65536
+HIGH_WATER = BUFFER * 4 # stop reading when this much is queued for the peer
+CONTROL_SOCKET = '/tmp/portforwarder.sock'
+LOG_FILE = '/tmp/koko.log'
+
+if hasattr(select, 'epoll'):
+    READ = select.EPOLLIN
+    WRITE = select.EPOLLOUT
+    ERROR = select.EPOLLERR | select.EPOLLHUP
+else:
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+CONNECTING = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+
 
 def handler(client, remote):
     server = socket(AF_INET, SOCK_STREAM)
     server.connect(remote)
-    
+
     while True:
-        rlist, wlist, xlist = select([client, server], [], [server, client])
+        rlist, wlist, xlist = select.select([client, server], [], [server, client])
         if xlist:
             client.close()
             server.close()
@@ -43,9 +85,17 @@ def handler(client, remote):
                 sys.exit(0)
 
             if end == server:
-                client.send(buff)
+                client.sendall(buff)
             elif end == client:
-                server.send(buff)
+                server.sendall(buff)
+
+
+def resolve(host, port, flags=0):
+    """
+    Returns the first IPv4 (address, port) tuple for host and port.  Passing
+    AI_NUMERICHOST in flags never queries DNS, host names raise gaierror.
+    """
+    return getaddrinfo(host, port, AF_INET, SOCK_STREAM, 0, flags)[0][4]
 
 
 def forward_port(lport, remote, accept_timeout=ACCEPT_TIMEOUT):
@@ -63,9 +113,542 @@ def forward_port(lport, remote, accept_timeout=ACCEPT_TIMEOUT):
         sys.exit(0)
 
 
+class Poller(object):
+    """
+    Thin wrapper around epoll, falling back to poll where epoll is not
+    available.  Timeouts are always in seconds.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+
+    def register(self, fd, events):
+        self._poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout=-1):
+        if timeout is not None and timeout >= 0:
+            timeout = timeout * self._scale
+        try:
+            return self._poller.poll(timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class Endpoint(object):
+    """
+    One side of a forwarded session.  Data received from the peer is queued in
+    buffer until this socket can accept it.
+    """
+    def __init__(self, sock, connecting=False):
+        sock.setblocking(0)
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.peer = None
+        self.buffer = ''
+        self.connecting = connecting
+        self.eof = False
+        self.events = 0
+
+    def wanted_events(self):
+        if self.connecting:
+            return WRITE
+        events = 0
+        if not self.eof and not self.peer.eof \
+            and len(self.peer.buffer) < HIGH_WATER:
+                events |= READ
+        if self.buffer:
+            events |= WRITE
+        return events
+
+
+class Listener(object):
+    """
+    Listening socket for a single port mapping.  Every accepted client is
+    connected to target, the resolved address of remote.
+    """
+    def __init__(self, lport, remote, target, address='0.0.0.0'):
+        self.lport = lport
+        self.remote = remote
+        self.target = target
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind((address, lport))
+        self.sock.listen(128)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.sessions = 0
+        self.last_active = time.time()
+
+
+class Control(object):
+    """
+    Connection to the control socket.  Commands are newline terminated and
+    handled in order, while a host name is being resolved for this connection
+    later commands wait in buffer.  Replies are queued in outgoing until the
+    socket is writable.
+    """
+    def __init__(self, sock):
+        sock.setblocking(0)
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.buffer = ''
+        self.outgoing = ''
+        self.pending = None
+        self.eof = False
+        self.events = READ
+
+    def wanted_events(self):
+        events = 0
+        if not self.eof:
+            events |= READ
+        if self.outgoing:
+            events |= WRITE
+        return events
+
+
+class Resolver(object):
+    """
+    Resolves host names on worker threads so that DNS lookups never block the
+    event loop.  Finished lookups are queued and announced by writing to a
+    pipe that the event loop polls.
+    """
+    def __init__(self):
+        self.fd, self._wakeup = os.pipe()
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._lock = threading.Lock()
+        self._results = []
+
+    def submit(self, key, host, port):
+        """
+        Starts resolving host and port, the result is returned by collect()
+        together with key.
+        """
+        thread = threading.Thread(target=self._resolve, args=(key, host, port))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _resolve(self, key, host, port):
+        try:
+            result = (key, resolve(host, port), None)
+        except error, e:
+            result = (key, None, e)
+        self._lock.acquire()
+        try:
+            self._results.append(result)
+        finally:
+            self._lock.release()
+        os.write(self._wakeup, 'x')
+
+    def collect(self):
+        """
+        Returns the finished lookups as a list of (key, address, error)
+        """
+        try:
+            while os.read(self.fd, BUFFER):
+                pass
+        except OSError, e:
+            if e.args[0] not in RETRY:
+                raise
+        self._lock.acquire()
+        try:
+            results, self._results = self._results, []
+        finally:
+            self._lock.release()
+        return results
+
+
+class Forwarder(object):
+    """
+    Event loop serving any number of port mappings from a single process.
+
+    Sockets are non-blocking and are only polled for the events they need.  An
+    endpoint stops being read while its peer has more than HIGH_WATER bytes
+    queued, so a slow client pushes back on the server instead of growing the
+    buffer without bound.  Partial sends leave the remainder queued until the
+    socket is writable again.
+    """
+    def __init__(self, control_path=None, buffer_size=BUFFER):
+        self.buffer_size = buffer_size
+        self.poller = Poller()
+        self.listeners = {}  # local port -> Listener
+        self.handlers = {}   # fd -> Listener, Endpoint, Control, Resolver or socket
+        self.resolver = Resolver()
+        self.handlers[self.resolver.fd] = self.resolver
+        self.poller.register(self.resolver.fd, READ)
+        self.control = None
+        if control_path:
+            if os.path.exists(control_path):
+                os.unlink(control_path)
+            self.control = socket(AF_UNIX, SOCK_STREAM)
+            # only the owner may send commands, the umask keeps the socket
+            # private from the moment it is created.
+            umask = os.umask(0177)
+            try:
+                self.control.bind(control_path)
+            finally:
+                os.umask(umask)
+            os.chmod(control_path, 0600)
+            self.control.listen(16)
+            self.control.setblocking(0)
+            self.handlers[self.control.fileno()] = self.control
+            self.poller.register(self.control.fileno(), READ)
+
+    def open(self, lport, remote, target=None):
+        """
+        Opens a mapping from a local port to a (host, port) tuple.  Reopening
+        a mapped port with the same remote is a no-op.
+
+        @param target: resolved address of remote.  If omitted remote is
+        resolved here, which blocks on DNS for host names.
+        """
+        listener = self.listeners.get(lport)
+        if listener is not None:
+            if listener.remote == remote:
+                return listener
+            self.close(lport)
+        if target is None:
+            target = resolve(*remote)
+        listener = Listener(lport, remote, target)
+        self.listeners[lport] = listener
+        self.handlers[listener.fd] = listener
+        self.poller.register(listener.fd, READ)
+        return listener
+
+    def close(self, lport):
+        """
+        Stops listening on a local port.  Established sessions are left open
+        until either end disconnects.
+        """
+        listener = self.listeners.pop(lport, None)
+        if listener is None:
+            return False
+        self.poller.unregister(listener.fd)
+        del self.handlers[listener.fd]
+        listener.sock.close()
+        return True
+
+    def run(self, timeout=1):
+        """
+        Runs the event loop forever
+        """
+        while True:
+            self.poll(timeout)
+
+    def poll(self, timeout=1):
+        """
+        Handles all events that are ready within timeout seconds
+        """
+        for fd, events in self.poller.poll(timeout):
+            handler = self.handlers.get(fd)
+            if handler is None:
+                continue
+            if isinstance(handler, (Endpoint,)):
+                self._handle_endpoint(handler, events)
+            elif isinstance(handler, (Listener,)):
+                self._accept(handler)
+            elif isinstance(handler, (Control,)):
+                self._handle_control(handler, events)
+            elif isinstance(handler, (Resolver,)):
+                self._resolved()
+            else:
+                self._accept_control()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                client, address = listener.sock.accept()
+            except error, e:
+                if e.args[0] in RETRY:
+                    return
+                raise
+            listener.sessions += 1
+            listener.last_active = time.time()
+
+            server = socket(AF_INET, SOCK_STREAM)
+            server.setblocking(0)
+            code = server.connect_ex(listener.target)
+            client = Endpoint(client)
+            server = Endpoint(server, connecting=code in CONNECTING)
+            client.peer, server.peer = server, client
+            for end in (client, server):
+                self.handlers[end.fd] = end
+                end.events = end.wanted_events()
+                self.poller.register(end.fd, end.events)
+            if code and code not in CONNECTING:
+                self._close_session(client)
+
+    def _handle_endpoint(self, end, events):
+        if end.connecting:
+            if end.sock.getsockopt(SOL_SOCKET, SO_ERROR):
+                self._close_session(end)
+                return
+            end.connecting = False
+        elif events & ERROR and not events & READ:
+            self._close_session(end)
+            return
+
+        if events & READ:
+            try:
+                data = end.sock.recv(self.buffer_size)
+            except error, e:
+                if e.args[0] not in RETRY:
+                    self._close_session(end)
+                    return
+                data = None
+            if data == '':
+                end.eof = True
+            elif data:
+                end.peer.buffer += data
+                if not self._flush(end.peer):
+                    return
+
+        if events & WRITE and end.buffer:
+            if not self._flush(end):
+                return
+
+        if end.eof and not end.peer.buffer:
+            self._close_session(end)
+            return
+        if end.peer.eof and not end.buffer:
+            self._close_session(end)
+            return
+        self._update(end)
+        self._update(end.peer)
+
+    def _flush(self, end):
+        """
+        Sends as much of the endpoint's buffer as the socket accepts
+
+        @return False if the session was closed
+        """
+        if end.connecting:
+            return True
+        while end.buffer:
+            try:
+                sent = end.sock.send(end.buffer)
+            except error, e:
+                if e.args[0] in RETRY:
+                    break
+                self._close_session(end)
+                return False
+            end.buffer = end.buffer[sent:]
+        return True
+
+    def _update(self, end):
+        events = end.wanted_events()
+        if events != end.events:
+            end.events = events
+            self.poller.modify(end.fd, events)
+
+    def _close_session(self, end):
+        for e in (end, end.peer):
+            if self.handlers.pop(e.fd, None) is not None:
+                self.poller.unregister(e.fd)
+            e.sock.close()
+
+    def _accept_control(self):
+        try:
+            sock, address = self.control.accept()
+        except error, e:
+            if e.args[0] in RETRY:
+                return
+            raise
+        control = Control(sock)
+        self.handlers[control.fd] = control
+        self.poller.register(control.fd, control.events)
+
+    def _handle_control(self, control, events):
+        if events & WRITE and not self._flush_control(control):
+            return
+        if events & ERROR and control.eof:
+            # hung up after sending its commands, nobody reads the replies
+            self._close_control(control)
+            return
+        if events & (READ | ERROR) and not control.eof:
+            try:
+                data = control.sock.recv(BUFFER)
+            except error, e:
+                if e.args[0] in RETRY:
+                    return
+                data = ''
+            if not data:
+                control.eof = True
+            control.buffer += data
+            self._process(control)
+        self._update_control(control)
+
+    def _process(self, control):
+        """
+        Executes the buffered commands of a control connection until one of
+        them has to wait for the resolver
+        """
+        while control.pending is None and '\n' in control.buffer \
+                and self.handlers.get(control.fd) is control:
+            line, control.buffer = control.buffer.split('\n', 1)
+            reply = self.command(line, control)
+            if reply is not None:
+                control.outgoing += '%s\n' % reply
+                self._flush_control(control)
+
+    def _flush_control(self, control):
+        """
+        Sends as much of the queued replies as the socket accepts
+
+        @return False if the connection was closed
+        """
+        while control.outgoing:
+            try:
+                sent = control.sock.send(control.outgoing)
+            except error, e:
+                if e.args[0] in RETRY:
+                    break
+                self._close_control(control)
+                return False
+            control.outgoing = control.outgoing[sent:]
+        return True
+
+    def _update_control(self, control):
+        if self.handlers.get(control.fd) is not control:
+            return
+        if control.eof and control.pending is None and not control.outgoing:
+            self._close_control(control)
+            return
+        events = control.wanted_events()
+        if events != control.events:
+            control.events = events
+            self.poller.modify(control.fd, events)
+
+    def _close_control(self, control):
+        if self.handlers.pop(control.fd, None) is not None:
+            self.poller.unregister(control.fd)
+        control.sock.close()
+
+    def _resolved(self):
+        """
+        Finishes open commands whose host name was resolved
+        """
+        for control, target, e in self.resolver.collect():
+            lport, remote = control.pending
+            control.pending = None
+            if self.handlers.get(control.fd) is not control:
+                # the client went away while waiting
+                continue
+            if e is None:
+                try:
+                    self.open(lport, remote, target)
+                    reply = 'ok'
+                except error, e:
+                    reply = 'error %s' % e
+            else:
+                reply = 'error %s' % e
+            control.outgoing += '%s\n' % reply
+            if self._flush_control(control):
+                self._process(control)
+                self._update_control(control)
+
+    def command(self, line, control=None):
+        """
+        Executes a single control command and returns the reply.  An open
+        command for a host name is handed to the resolver when control is
+        given, the reply is then sent to control later and None is returned.
+        """
+        args = line.split()
+        try:
+            if not args:
+                return 'error empty command'
+            if args[0] == 'open' and len(args) == 4:
+                lport, remote = int(args[1]), (args[2], int(args[3]))
+                try:
+                    target = resolve(remote[0], remote[1], AI_NUMERICHOST)
+                except gaierror:
+                    if control is None:
+                        target = None
+                    else:
+                        control.pending = (lport, remote)
+                        self.resolver.submit(control, *remote)
+                        return None
+                self.open(lport, remote, target)
+                return 'ok'
+            if args[0] == 'close' and len(args) == 2:
+                if self.close(int(args[1])):
+                    return 'ok'
+                return 'error port not mapped'
+            if args[0] == 'list' and len(args) == 1:
+                return 'ok %s' % ' '.join(['%d:%s:%d:%d:%d' % (
+                        l.lport, l.remote[0], l.remote[1], l.sessions,
+                        l.last_active) for l in self.listeners.values()])
+            return 'error unknown command %s' % args[0]
+        except (ValueError, error), e:
+            return 'error %s' % e
+
+
+def send_command(command, path=CONTROL_SOCKET, timeout=5):
+    """
+    Sends a command to a forwarder daemon and returns its reply
+
+    @raises socket.error if the daemon is not reachable
+    """
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall('%s\n' % command)
+        reply = ''
+        while not reply.endswith('\n'):
+            data = sock.recv(BUFFER)
+            if not data:
+                break
+            reply += data
+        return reply.strip()
+    finally:
+        sock.close()
+
+
+def daemonize(target, *args):
+    if os.fork() == 0:
+        os.setsid()
+        if os.fork() == 0:
+            for fd in range(0,10):
+                try:
+                    os.close(fd)
+                except:
+                    pass
+            i = os.open("/dev/null", os.O_RDONLY)
+            i = os.open(LOG_FILE, os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0600)
+            os.dup2(1,2)
+            target(*args)
+        else:
+            os._exit(0)
+    else:
+        sys.exit(0)
+
+
+def run_daemon(control_path):
+    Forwarder(control_path).run()
+
+
 if __name__ == '__main__':
+    if len(sys.argv) in (2, 3) and sys.argv[1] == '--daemon':
+        path = sys.argv[2] if len(sys.argv) == 3 else CONTROL_SOCKET
+        daemonize(run_daemon, path)
+        sys.exit(0)
+
     if len(sys.argv) != 3:
         print "Usage: %s <local_port> <remote_host:remote_port>" % sys.argv[0]
+        print "       %s --daemon [control_socket]" % sys.argv[0]
         sys.exit(127)
 
     try:
@@ -73,7 +656,7 @@ if __name__ == '__main__':
     except:
         print "Error, local port must be int"
         sys.exit(1)
-    
+
     if lport <= 0 or lport >= 65536:
         print "Error, invalid port specified: %d" % lport
         sys.exit(1)
@@ -90,19 +673,4 @@ if __name__ == '__main__':
         print "Error, invalid port specified: %d" % lport
         sys.exit(1)
 
-    if os.fork() == 0:
-        os.setsid()
-        if os.fork() == 0:
-            for fd in range(0,10):
-                try:
-                    os.close(fd)
-                except:
-                    pass
-            i = os.open("/dev/null", os.O_RDONLY)
-            i = os.open("/tmp/koko.log", os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0600)
-            os.dup2(1,2)
-            forward_port(lport, (rhost, rport))
-        else:
-            os._exit(0)
-    else:
-        sys.exit(0)
+    daemonize(forward_port, lport, (rhost, rport))
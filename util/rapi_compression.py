@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2010 Oregon State University et al.
+# Copyright (C) 2010 Greek Research and Technology Network
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Measures the savings of compressed RAPI responses for a cluster.
+
+Fetches the bulk instance list with and without compression and reports the
+size on the wire, the decompressed size and the request time of each:
+
+    rapi_compression.py [-P port] [-u user] [-p password] [-n 3] host
+
+Savings are only reported if the RAPI server, or a proxy in front of it,
+compresses responses.
+"""
+
+import sys
+from optparse import OptionParser
+
+import client
+
+
+def measure(rapi, repeat):
+    """
+    Fetches the bulk instance list
+
+    @return dict with the bytes and the mean seconds of the requests
+    """
+    total = decode = 0
+    for i in xrange(repeat):
+        rapi.GetInstances(bulk=True)
+        request = rapi.last_request
+        total += request['timings']['total']
+        decode += request['timings']['decode']
+    return dict(bytes_in=request['bytes_in'], bytes_wire=request['bytes_wire'],
+                total=total / repeat, decode=decode / repeat)
+
+
+def run(host, port=client.GANETI_RAPI_PORT, username=None, password=None,
+        repeat=3):
+    """
+    @return list of (name, results) for uncompressed and compressed requests
+    """
+    rows = []
+    for name, compression in (('plain', False), ('compressed', True)):
+        rapi = client.GanetiRapiClient(host, port, username, password,
+                                       compression=compression)
+        rows.append((name, measure(rapi, repeat)))
+    return rows
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] host')
+    parser.add_option('-P', '--port', type='int',
+                      default=client.GANETI_RAPI_PORT)
+    parser.add_option('-u', '--username')
+    parser.add_option('-p', '--password')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+                      help='requests per mode, timings are averaged')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a cluster host is required')
+
+    try:
+        rows = run(args[0], options.port, options.username, options.password,
+                   options.repeat)
+    except client.Error, e:
+        sys.stderr.write('error: %s\n' % e)
+        sys.exit(1)
+
+    print '%-12s %12s %12s %10s %10s' % ('', 'wire bytes', 'bytes', \
+                                         'total s', 'decode s')
+    for name, row in rows:
+        print '%-12s %12d %12d %10.3f %10.3f' % (name, row['bytes_wire'], \
+            row['bytes_in'], row['total'], row['decode'])
+
+    plain, compressed = rows[0][1], rows[1][1]
+    saved = plain['bytes_wire'] - compressed['bytes_wire']
+    print 'saved %d bytes (%.1f%%), %.3fs per request' % (saved, \
+        100.0 * saved / max(1, plain['bytes_wire']), \
+        plain['total'] - compressed['total'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import random
 import sys
+import tempfile
+import time
 from optparse import OptionParser
 import urllib2
 import json
@@ -15,23 +19,67 @@ class BadMimetype(BaseException):
 
 
 class Application:
-    def __init__(self, hostname, api_key, cluster_slug, vm_name, url="http://%s/cluster/%s/%s/keys/%s/"):
+    def __init__(self, hostname, api_key, cluster_slug, vm_name, url="http://%s/cluster/%s/%s/keys/%s/", cache=None):
         self.hostname = hostname
         self.key = api_key
         self.cluster_slug = cluster_slug
         self.vm_name = vm_name
         self.url = url
+        self.cache = cache
+
+    def load_cache(self):
+        """
+        Returns (etag, content) of the last response, or (None, None) if there
+        is no usable cache file
+        """
+        if not self.cache:
+            return None, None
+        try:
+            data = json.load(open(self.cache))
+            return data["etag"], data["content"]
+        except (IOError, ValueError, KeyError):
+            return None, None
+
+    def save_cache(self, etag, content):
+        """
+        Stores the last response and its ETag in the cache file
+        """
+        if self.cache:
+            write_file(self.cache, json.dumps({"etag": etag, "content": content}))
 
     def get(self):
         """
-        Gets the page specified in __init__
+        Gets the page specified in __init__.  The cached response is returned
+        if it is still current, or if the server can not be reached or fails
+        with a 5xx error.
         """
         url = self.url % (self.hostname, self.cluster_slug, self.vm_name, self.key)
-        content = urllib2.urlopen(url)
+        etag, cached = self.load_cache()
+        request = urllib2.Request(url)
+        if etag and cached is not None:
+            request.add_header("If-None-Match", etag)
+
+        try:
+            content = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return cached
+            if e.code < 500 or cached is None:
+                raise
+            sys.stderr.write("Server error from %s, using cached keys: %s\n" % (self.hostname, e))
+            return cached
+        except urllib2.URLError, e:
+            if cached is None:
+                raise
+            sys.stderr.write("Could not reach %s, using cached keys: %s\n" % (self.hostname, e))
+            return cached
+
         if content.info()["Content-Type"] != "application/json":
             raise BadMimetype("It's not JSON")
-        return content.read()
-    
+        data = content.read()
+        self.save_cache(content.info().get("ETag"), data)
+        return data
+
     def parse(self, content):
         """
         Parses returned results from JSON into Python list
@@ -49,43 +97,106 @@ class Application:
                     (i[0], i[1]))
         return "".join(s)
 
-    def run(self):
+    def run(self, output=None):
         """
-        Combines get, parse and printout methods.
+        Combines get, parse and printout methods.  Writes to output, if given,
+        otherwise to stdout.
+
+        @return True if the keys were retrieved
         """
         try:
             s = self.printout(self.parse(self.get()))
         except BaseException, e:
             sys.stderr.write("Errors occured, could not retrieve informations.\n")
             sys.stderr.write(str(e)+"\n")
+            return False
+        if output:
+            write_file(output, s)
         else:
             sys.stdout.write(s)
+        return True
 
+    def daemon(self, output, interval, jitter):
+        """
+        Runs forever, updating output every interval seconds.  The interval is
+        randomized by +/- jitter so that a fleet of VMs does not poll in step.
+        """
+        while True:
+            self.run(output)
+            time.sleep(max(0, interval * (1 + random.uniform(-jitter, jitter))))
+
+
+def write_file(path, content):
+    """
+    Atomically replaces a file's content by writing a temporary file in the
+    same directory and renaming it.  The file is left alone if the content did
+    not change.
+
+    @return True if the file was written
+    """
+    try:
+        if open(path).read() == content:
+            return False
+    except IOError:
+        pass
 
-def main():
-    if len(sys.argv)!=5:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".sshkeys")
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(tmp, 0600)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+USAGE = """%prog [options] HOSTNAME CLUSTER_SLUG VM_NAME API_KEY
+
+HOSTNAME\thost Ganeti is running on
+CLUSTER_SLUG\tcluster short name
+VM_NAME\t\tvirtual machine instance name
+API_KEY\t\tGaneti API key used to connect to the application"""
+
+
+def parser():
+    parser = OptionParser(usage=USAGE)
+    parser.add_option("-o", "--output", help="write keys to this authorized_keys file instead of stdout")
+    parser.add_option("-c", "--cache", help="cache the last response in this file")
+    parser.add_option("-d", "--daemon", action="store_true", default=False, help="keep running and poll for changes, requires --output")
+    parser.add_option("-i", "--interval", type="float", default=300, help="seconds between polls in daemon mode")
+    parser.add_option("-j", "--jitter", type="float", default=0.2, help="fraction the interval is randomized by")
+    return parser
+
+
+def main(argv=None):
+    options, args = parser().parse_args(argv)
+    if len(args)!=4:
         raise ArgumentException("Too much or too few arguments!")
+    if options.daemon and not options.output:
+        raise ArgumentException("--daemon requires --output")
 
-    options = dict(hostname=sys.argv[1], cluster_slug=sys.argv[2], vm_name=sys.argv[3], api_key=sys.argv[4])
+    kwargs = dict(hostname=args[0], cluster_slug=args[1], vm_name=args[2], api_key=args[3], cache=options.cache)
 
-    return options
+    return kwargs, options
 
 
 if __name__ == "__main__":
     try:
-        options = main()
+        kwargs, options = main()
     except ArgumentException, e:
         sys.stderr.write(str(e)+"\n"*2)
-        sys.stderr.write(
-"""Usage:   sshkeys.py  HOSTNAME  CLUSTER_SLUG  VM_NAME  API_KEY
-
-HOSTNAME\thost Ganeti is running on
-CLUSTER_SLUG\tcluster short name
-VM_NAME\t\tvirtual machine instance name
-API_KEY\t\tGaneti API key used to connect to the application
-""")
+        parser().print_help(sys.stderr)
         sys.exit(1)
     else:
-        a = Application(**options)
-        a.run()
-
+        a = Application(**kwargs)
+        if options.daemon:
+            a.daemon(options.output, options.interval, options.jitter)
+        elif not a.run(options.output):
+            sys.exit(1)